@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Допуск к БД: все вызовы db.py из HTTP и ботов идут через db_call.
+В полёте — не больше, чем соединений в пуле; остальные ждут в ограниченной очереди (FIFO) и по таймауту
+получают DbOverloaded (HTTP отвечает 503 + Retry-After) вместо PoolError / зависания на getconn.
+Лимит адаптивный: при PoolError / «too many connections» — вдвое меньше, после серии успешных вызовов — +1.
+
+Полосы приоритета (LANES, по убыванию): оплаты > /check > клиентский бот > админ-бот. Полоса берётся из контекста
+(set_lane / in_lane). Вложенное резервирование: полоса и все ниже неё вместе занимают не больше доли лимита
+из LANE_SHARES, так что админские выборки не забирают слоты у /check и оплат. Освободившийся слот — первому
+ожидающему из самой приоритетной полосы, которой он разрешён.
+"""
+import asyncio
+import contextlib
+import contextvars
+import logging
+import math
+import os
+import time
+from collections import deque
+
+import db
+import db_async
+
+log = logging.getLogger(__name__)
+
+try:
+    from psycopg2.pool import PoolError
+    from psycopg2 import OperationalError
+except ImportError:
+    PoolError = type("PoolError", (Exception,), {})
+    OperationalError = type("OperationalError", (Exception,), {})
+
+
+def _default_limit() -> int:
+    if db._USE_PG:
+        return db.pg_pool_sizes()["threaded"]  # больше вызовов в потоках — PoolError у пула db.py
+    return int(os.environ.get("THREAD_POOL_SIZE", "10"))
+
+
+MAX_LIMIT = max(1, int(os.environ.get("DB_ADMISSION_LIMIT", "0")) or _default_limit())
+QUEUE_MAX = int(os.environ.get("DB_ADMISSION_QUEUE", "100"))
+WAIT_TIMEOUT = int(os.environ.get("DB_ADMISSION_WAIT_MS", "2000")) / 1000
+RETRY_AFTER_MAX = 30  # сек
+
+LANE_PAYMENT, LANE_CHECK, LANE_CLIENT, LANE_ADMIN = LANES = ("payment", "check", "client", "admin")
+# Доля лимита на полосу вместе со всеми ниже неё: при лимите 8 — 8 / 7 / 4 / 2
+LANE_SHARES = {LANE_PAYMENT: 1.0, LANE_CHECK: 0.9, LANE_CLIENT: 0.6, LANE_ADMIN: 0.35}
+_lane: contextvars.ContextVar = contextvars.ContextVar("db_lane", default=LANE_CLIENT)
+
+_limit = MAX_LIMIT
+_inflight = 0
+_lane_inflight = {name: 0 for name in LANES}
+_ok_streak = 0
+_waiters = {name: deque() for name in LANES}  # полоса → (future, время постановки, полоса)
+_service_ms = 10.0  # EWMA длительности вызова — для Retry-After
+_recent_waits: deque = deque(maxlen=1024)
+_stats = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_timeout": 0, "overload_errors": 0, "idle_probes": 0}
+
+
+class DbOverloaded(Exception):
+    """Очередь к БД переполнена или ожидание дольше DB_ADMISSION_WAIT_MS. retry_after — через сколько секунд повторить."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def set_lane(lane: str):
+    """Полоса для всех следующих db_call в текущем контексте (задача asyncio / обработка апдейта)."""
+    return _lane.set(lane)
+
+
+@contextlib.contextmanager
+def in_lane(lane: str):
+    """Вызовы db_call внутри блока — в полосе lane."""
+    token = _lane.set(lane)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+def current_lane() -> str:
+    return _lane.get()
+
+
+def _queued() -> int:
+    return sum(len(q) for q in _waiters.values())
+
+
+def _lane_cap(lane: str) -> int:
+    """Слотов у полосы вместе с нижними. Гарантированный слот — только у оплат: при сжатом лимите
+    нижние полосы получают 0, а не по слоту каждая сверх лимита."""
+    cap = int(_limit * LANE_SHARES[lane])
+    return max(1, cap) if lane == LANE_PAYMENT else cap
+
+
+def _headroom(lane: str) -> int:
+    """Сколько вызовов полосы lane можно начать сейчас: минимум запаса по ней и всем полосам выше."""
+    free = _limit - _inflight
+    below = 0
+    for name in reversed(LANES):
+        below += _lane_inflight[name]
+        if LANES.index(name) <= LANES.index(lane):
+            free = min(free, _lane_cap(name) - below)
+    return max(0, free)
+
+
+def _retry_after() -> int:
+    """Оценка времени разбора очереди: (ожидающие + 1) × средний вызов / лимит."""
+    sec = (_queued() + 1) * _service_ms / 1000 / max(_limit, 1)
+    return max(1, min(RETRY_AFTER_MAX, math.ceil(sec)))
+
+
+def _is_overload_error(e: Exception) -> bool:
+    if isinstance(e, PoolError):
+        return True
+    return isinstance(e, OperationalError) and any(x in str(e).lower() for x in ("too many", "exhausted", "remaining connection slots"))
+
+
+def _take(lane: str):
+    global _inflight
+    _inflight += 1
+    _lane_inflight[lane] += 1
+
+
+def _probe_idle(lane: str):
+    """
+    В полёте ничего, а у полосы нулевая доля: успехов для AIMD не будет (оплат может не быть вовсе),
+    поэтому лимит растёт сразу — до первого слота у этой полосы.
+    """
+    global _limit, _ok_streak
+    while _inflight == 0 and _limit < MAX_LIMIT and _headroom(lane) == 0:
+        _limit += 1
+        _ok_streak = 0
+        _stats["idle_probes"] += 1
+
+
+def _wake():
+    """Передать освободившиеся слоты ожидающим по приоритету полос (слот переходит вместе с future)."""
+    for lane in LANES:
+        if _waiters[lane]:
+            _probe_idle(lane)
+        queue = _waiters[lane]
+        while queue and _headroom(lane) > 0:
+            fut, _, _ = queue.popleft()
+            if not fut.done():
+                _take(lane)
+                fut.set_result(None)
+
+
+async def _acquire(lane: str):
+    _probe_idle(lane)
+    # Без очереди — только если никто из этой и более приоритетных полос не ждёт
+    if _headroom(lane) > 0 and not any(_waiters[name] for name in LANES[:LANES.index(lane) + 1]):
+        _take(lane)
+        _stats["admitted"] += 1
+        _recent_waits.append(0.0)
+        return
+    if _queued() >= QUEUE_MAX:
+        _stats["rejected_queue_full"] += 1
+        raise DbOverloaded("queue_full", _retry_after())
+    fut = asyncio.get_running_loop().create_future()
+    entry = (fut, time.monotonic(), lane)
+    _waiters[lane].append(entry)
+    _stats["queued"] += 1
+    try:
+        await asyncio.wait({fut}, timeout=WAIT_TIMEOUT)
+    except asyncio.CancelledError:
+        _abandon(entry)
+        raise
+    if not fut.done():
+        _abandon(entry)
+        _stats["rejected_timeout"] += 1
+        raise DbOverloaded("wait_timeout", _retry_after())
+    _stats["admitted"] += 1
+    _recent_waits.append((time.monotonic() - entry[1]) * 1000)
+
+
+def _abandon(entry):
+    """Ожидающий ушёл (таймаут/отмена): убрать из очереди, а если слот уже передан — вернуть его."""
+    fut, _, lane = entry
+    if fut.done() and not fut.cancelled():
+        _release(lane)
+        return
+    fut.cancel()
+    try:
+        _waiters[lane].remove(entry)
+    except ValueError:
+        pass
+
+
+def _release(lane: str):
+    global _inflight
+    _inflight -= 1
+    _lane_inflight[lane] -= 1
+    _wake()
+
+
+def _record(elapsed_ms: float, error: Exception | None):
+    """AIMD: перегрузка пула — лимит вдвое, `_limit` успешных вызовов подряд — +1 (до MAX_LIMIT)."""
+    global _limit, _ok_streak, _service_ms
+    _service_ms += (elapsed_ms - _service_ms) * 0.1
+    if error is not None and _is_overload_error(error):
+        _stats["overload_errors"] += 1
+        _ok_streak = 0
+        if _limit > 1:
+            _limit = max(1, _limit // 2)
+            log.warning("DB admission: перегрузка пула (%s) — лимит %d", error, _limit)
+        return
+    if error is None and _limit < MAX_LIMIT:
+        _ok_streak += 1
+        if _ok_streak >= _limit:
+            _ok_streak = 0
+            _limit += 1
+            _wake()
+
+
+async def db_call(func, *args, **kwargs):
+    """Вызов функции db.py с допуском (в полосе из контекста): нативно через db_async (DB_ASYNC=1) или в пуле потоков."""
+    lane = _lane.get()
+    await _acquire(lane)
+    t0 = time.perf_counter()
+    error = None
+    try:
+        afunc = db_async.get_impl(func)
+        if afunc is not None:
+            return await afunc(*args, **kwargs)
+        return await asyncio.to_thread(func, *args, **kwargs)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        _record((time.perf_counter() - t0) * 1000, error)
+        _release(lane)
+
+
+def free_slots(lane: str = LANE_CLIENT) -> int:
+    """Сколько вызовов полосы lane можно начать сейчас без ожидания."""
+    waiting = sum(len(_waiters[name]) for name in LANES[:LANES.index(lane) + 1])
+    return max(0, _headroom(lane) - waiting)
+
+
+def get_stats() -> dict:
+    """Счётчики для /metrics: глубина очереди, ожидание, отказы."""
+    waits = sorted(_recent_waits)
+    pick = lambda p: round(waits[min(len(waits) - 1, int(len(waits) * p))], 1) if waits else 0.0
+    now = time.monotonic()
+    oldest = max(((now - q[0][1]) * 1000 for q in _waiters.values() if q), default=0.0)
+    return {
+        **_stats,
+        "limit": _limit,
+        "max_limit": MAX_LIMIT,
+        "inflight": _inflight,
+        "queue_depth": _queued(),
+        "queue_max": QUEUE_MAX,
+        "oldest_wait_ms": round(oldest, 1),
+        "wait_ms": {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(waits[-1], 1) if waits else 0.0},
+        "service_ms_avg": round(_service_ms, 2),
+        "lanes": {name: {"inflight": _lane_inflight[name], "queued": len(_waiters[name]),
+                         "cap": _lane_cap(name)} for name in LANES},
+    }
@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+"""Нагрузочные проверки и замеры. Запуск из deploy/: python -m bench.<модуль>."""
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Латентность /check: пул потоков (asyncio.to_thread + db.py) против db_async (asyncpg / aiosqlite).
+
+    python -m bench.async_vs_threaded --codes 2000 --requests 5000 --concurrency 50
+
+Кэш вердиктов выключен — меряем БД. Без DATABASE_URL — временная SQLite.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+
+def _percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def _run(call, items: list, concurrency: int) -> dict:
+    sem = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(item):
+        nonlocal errors
+        async with sem:
+            t0 = time.perf_counter()
+            try:
+                await call(*item)
+            except Exception:
+                errors += 1
+            latencies.append((time.perf_counter() - t0) * 1000)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in items))
+    elapsed = time.perf_counter() - t0
+    return {
+        "requests": len(items), "errors": errors, "rps": round(len(items) / elapsed, 1),
+        "p50_ms": round(_percentile(latencies, 0.50), 2), "p99_ms": round(_percentile(latencies, 0.99), 2),
+        "mean_ms": round(statistics.mean(latencies), 2),
+    }
+
+
+async def main_async(args) -> dict:
+    import db
+    import db_async
+
+    db.init_db()
+    items = []
+    for _ in range(args.codes):
+        code = db.create_code(30)
+        hwid = os.urandom(16).hex()
+        db.check_or_activate(code, hwid)
+        items.append((code, hwid, None))
+    load = [random.choice(items) for _ in range(args.requests)]
+
+    pool_size = int(os.environ.get("THREAD_POOL_SIZE", "10"))
+    asyncio.get_running_loop().set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=pool_size))
+
+    async def threaded(*item):
+        return await asyncio.to_thread(db.check_or_activate, *item)
+
+    result = {"backend": "postgres" if db._USE_PG else "sqlite", "concurrency": args.concurrency, "thread_pool": pool_size}
+    await _run(threaded, load[:200], args.concurrency)  # прогрев
+    result["threaded"] = await _run(threaded, load, args.concurrency)
+    await _run(db_async.check_or_activate, load[:200], args.concurrency)
+    result["async"] = await _run(db_async.check_or_activate, load, args.concurrency)
+    return result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--codes", type=int, default=2000)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    if not os.environ.get("DATABASE_URL"):
+        os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ["LICENSE_CACHE_SIZE"] = "0"
+    print(json.dumps(asyncio.run(main_async(args)), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
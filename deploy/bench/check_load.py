@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный тест POST /check: приложение из main.build_api_app() (без ботов), база с заданным объёмом,
+смесь запросов valid / expired / revoked / invalid / first (первая активация). Отчёт — JSON, удобно диффать прогоны.
+
+    python -m bench.check_load --codes 100000 --requests 20000 --concurrency 64 --out run.json
+    python -m bench.check_load --mix valid=60,expired=10,revoked=10,invalid=10,first=10 --no-cache
+    python -m bench.check_load --url http://127.0.0.1:5000   # живой сервер; db_ms тогда не меряется
+
+Без DATABASE_URL — временная SQLite (или --db-path). С DATABASE_URL — локальный PostgreSQL.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import secrets
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+
+CATEGORIES = ("valid", "expired", "revoked", "invalid", "first")
+# Ожидаемый ответ по категории: (HTTP статус, error)
+_EXPECTED = {
+    "valid": (200, None),
+    "expired": (400, "expired"),
+    "revoked": (400, "revoked"),
+    "invalid": (400, "invalid_code"),
+    "first": (200, None),
+}
+# 503 busy (admission: очередь к БД полна) — не ошибка логики, считается отдельно в statuses
+
+
+def _parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in CATEGORIES:
+            raise SystemExit(f"неизвестная категория в --mix: {name}")
+        mix[name] = float(weight)
+    return mix
+
+
+def _percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda p: round(values[min(len(values) - 1, int(len(values) * p))], 3)
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "mean": round(statistics.mean(values), 3)}
+
+
+def _seed(db, prefix: str, counts: dict) -> dict:
+    """Коды по категориям одной транзакцией на пачку. Возвращает {категория: [(code, hwid), ...]}."""
+    seeded = {name: [] for name in CATEGORIES}
+    plan = [("valid", "2099-01-01T00:00:00", 0, "active"), ("expired", "2000-01-01T00:00:00", 0, "expired"),
+            ("revoked", "2099-01-01T00:00:00", 1, "revoked"), ("first", None, None, "free")]
+    batch = 5000
+    for name, expires_at, revoked, status in plan:
+        for start in range(0, counts[name], batch):
+            rows = [(f"{prefix}{name[0].upper()}{i:010d}", f"hw-{prefix}-{i}") for i in range(start, min(counts[name], start + batch))]
+            with db.get_db() as conn:
+                cur = conn.cursor()
+                for code, hwid in rows:
+                    cur.execute("INSERT INTO codes (code, days, status) VALUES (?, 30, ?)", (code, status))
+                    if expires_at is not None:
+                        cur.execute(
+                            "INSERT INTO activations (code_id, hwid, expires_at, expires_ts, revoked) SELECT id, ?, ?, ?, ? FROM codes WHERE code = ?",
+                            (hwid, expires_at, db._epoch(datetime.fromisoformat(expires_at)), revoked, code),
+                        )
+            seeded[name].extend(rows)
+    seeded["invalid"] = [(f"{prefix}X{i:010d}", f"hw-{prefix}-x{i}") for i in range(max(counts["invalid"], 1))]
+    return seeded
+
+
+def _build_load(seeded: dict, mix: dict, requests: int) -> list:
+    """[(категория, code, hwid)]; first — каждый свободный код ровно один раз (забираем из seeded)."""
+    names = [n for n in CATEGORIES if mix.get(n)]
+    picks = random.choices(names, weights=[mix[n] for n in names], k=requests)
+    free = seeded["first"]
+    load = []
+    for name in picks:
+        if name == "first":
+            code, hwid = free.pop()
+        else:
+            code, hwid = random.choice(seeded[name])
+        load.append((name, code, hwid))
+    return load
+
+
+async def _drive(client, load: list, concurrency: int, db_times: list) -> dict:
+    per_cat = {name: [] for name in CATEGORIES}
+    statuses, unexpected = Counter(), Counter()
+    queue = iter(load)
+
+    async def worker():
+        for name, code, hwid in queue:
+            t0 = time.perf_counter()
+            try:
+                r = await client.post("/check", json={"code": code, "hwid": hwid})
+                status, error = r.status_code, (r.json().get("error") if r.status_code != 200 else None)
+            except Exception as e:
+                status, error = 0, type(e).__name__
+            per_cat[name].append((time.perf_counter() - t0) * 1000)
+            statuses[f"{status}:{error}" if error else str(status)] += 1
+            if (status, error) != _EXPECTED[name] and (status, error) != (503, "busy"):
+                unexpected[f"{name}->{status}:{error}"] += 1
+
+    db_times.clear()
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - t0
+    all_lat = [x for v in per_cat.values() for x in v]
+    return {
+        "requests": len(load),
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(len(load) / elapsed, 1),
+        "latency_ms": _percentiles(all_lat),
+        "db_ms": _percentiles(db_times),
+        "db_calls": len(db_times),
+        "by_category": {n: {"requests": len(v), "latency_ms": _percentiles(v)} for n, v in per_cat.items() if v},
+        "statuses": dict(statuses),
+        "unexpected": dict(unexpected),
+    }
+
+
+async def main_async(args, mix: dict) -> dict:
+    import httpx
+    import db
+    import main
+
+    if not args.verbose:
+        # 500-е и так видны в statuses; трейсбеки на каждый запрос только топят отчёт
+        logging.getLogger("main").setLevel(logging.CRITICAL)
+    db.init_db()
+    db.load_settings_cache()
+    prefix = "L" + secrets.token_hex(2).upper()
+    first_needed = int(args.requests * mix.get("first", 0) / sum(mix.values())) + args.requests // 50 + 10
+    counts = {"valid": args.codes, "expired": args.expired, "revoked": args.revoked,
+              "invalid": args.codes, "first": first_needed + args.warmup}
+    t0 = time.perf_counter()
+    seeded = _seed(db, prefix, counts)
+    seed_s = time.perf_counter() - t0
+    seeded_counts = {k: len(v) for k, v in seeded.items()}
+
+    # DB time: время внутри main._db_call (очередь пула потоков + кэш/запрос) — только для in-process прогона
+    db_times: list = []
+    orig_db_call = main._db_call
+
+    async def timed_db_call(func, *a, **kw):
+        t = time.perf_counter()
+        try:
+            return await orig_db_call(func, *a, **kw)
+        finally:
+            db_times.append((time.perf_counter() - t) * 1000)
+
+    headers = {"X-API-Secret": main.API_SECRET} if main.API_SECRET else {}
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, headers=headers, timeout=30,
+                                   limits=httpx.Limits(max_connections=args.concurrency))
+    else:
+        main._db_call = timed_db_call
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.build_api_app()), base_url="http://bench",
+                                   headers=headers, timeout=30)
+    async with client:
+        if args.warmup:
+            await _drive(client, _build_load(seeded, mix, args.warmup), args.concurrency, db_times)
+        result = await _drive(client, _build_load(seeded, mix, args.requests), args.concurrency, db_times)
+    main._db_call = orig_db_call
+
+    return {
+        "config": {
+            "backend": "postgres" if db._USE_PG else "sqlite",
+            "target": args.url or "in-process",
+            "db_async": bool(main.db_async.ENABLED),
+            "license_cache_size": db._LICENSE_CACHE_SIZE,
+            "thread_pool": args.thread_pool,
+            "concurrency": args.concurrency,
+            "mix": mix,
+            "seeded": seeded_counts,
+            "seed_s": round(seed_s, 1),
+            "python": platform.python_version(),
+        },
+        "result": result,
+        "metrics": main.get_license_cache_stats(),
+        "db_admission": main.admission.get_stats(),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--codes", type=int, default=10000, help="активированных действующих кодов")
+    parser.add_argument("--expired", type=int, default=1000)
+    parser.add_argument("--revoked", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--warmup", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--mix", default="valid=80,expired=5,revoked=5,invalid=5,first=5")
+    parser.add_argument("--thread-pool", type=int, default=int(os.environ.get("THREAD_POOL_SIZE", "10")))
+    parser.add_argument("--no-cache", action="store_true", help="LICENSE_CACHE_SIZE=0")
+    parser.add_argument("--db-path", default="", help="файл SQLite (по умолчанию — временный)")
+    parser.add_argument("--url", default="", help="бить в запущенный сервер вместо in-process приложения")
+    parser.add_argument("--seed", type=int, default=1, help="seed генератора нагрузки")
+    parser.add_argument("--out", default="", help="куда записать JSON (по умолчанию — stdout)")
+    parser.add_argument("--verbose", action="store_true", help="не глушить лог сервера")
+    args = parser.parse_args()
+    mix = _parse_mix(args.mix)
+    random.seed(args.seed)
+
+    # Окружение — до импорта db/main: они читают его при импорте
+    if not os.environ.get("DATABASE_URL"):
+        os.environ["DB_PATH"] = args.db_path or os.path.join(tempfile.mkdtemp(), "check_load.db")
+    if args.no_cache:
+        os.environ["LICENSE_CACHE_SIZE"] = "0"
+
+    async def runner():
+        import concurrent.futures
+        asyncio.get_running_loop().set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=args.thread_pool))
+        return await main_async(args, mix)
+
+    report = json.dumps(asyncio.run(runner()), indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+    print(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
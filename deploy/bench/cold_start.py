@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Холодный старт: import db + init_db() в новом процессе, как после рестарта на Railway.
+Сравнивает версионированные миграции (одно чтение schema_version) с прежним поведением —
+все CREATE/ALTER/_alter_safe на каждом старте (режим legacy).
+
+    python -m bench.cold_start --runs 20
+    python -m bench.cold_start --runs 20 --out cold.json
+
+Без DATABASE_URL — временная SQLite (или --db-path). С DATABASE_URL — эта база (схема будет создана/обновлена).
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def _child(mode: str) -> dict:
+    t0 = time.perf_counter()
+    import db
+    t1 = time.perf_counter()
+    if mode == "legacy":
+        # Как было до schema_version: все шаги схемы на каждом старте, одной транзакцией
+        with db.get_db() as conn:
+            cur = conn.cursor()
+            for _, _, migration in db._MIGRATIONS:
+                migration(conn, cur)
+            db._ensure_partner_admins_from_env(conn)
+        applied = []
+    else:
+        applied = db.init_db()
+    t2 = time.perf_counter()
+    return {"import_ms": (t1 - t0) * 1000, "init_ms": (t2 - t1) * 1000, "applied": len(applied)}
+
+
+def _spawn(mode: str) -> dict:
+    out = subprocess.run([sys.executable, "-m", "bench.cold_start", "--child", mode], capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def _summary(runs: list) -> dict:
+    init = sorted(r["init_ms"] for r in runs)
+    return {
+        "runs": len(runs),
+        "init_ms": {"p50": round(statistics.median(init), 2), "max": round(init[-1], 2), "mean": round(statistics.mean(init), 2)},
+        "import_ms_p50": round(statistics.median(r["import_ms"] for r in runs), 2),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--db-path", default="", help="файл SQLite (по умолчанию — временный)")
+    parser.add_argument("--out", default="", help="куда записать JSON (по умолчанию — stdout)")
+    parser.add_argument("--child", default="", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(_child(args.child)))
+        return 0
+
+    if not os.environ.get("DATABASE_URL"):
+        os.environ["DB_PATH"] = args.db_path or os.path.join(tempfile.mkdtemp(), "cold_start.db")
+    first = _spawn("versioned")  # новая база: все миграции
+    report = {
+        "backend": "postgres" if os.environ.get("DATABASE_URL") else "sqlite",
+        "first_boot": {"init_ms": round(first["init_ms"], 2), "migrations_applied": first["applied"]},
+        "versioned": _summary([_spawn("versioned") for _ in range(args.runs)]),
+        "legacy": _summary([_spawn("legacy") for _ in range(args.runs)]),
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Накладные расходы _PgCursorWrapper.execute без сети: переписывание SQL на каждом вызове
+(_pg_adapt_sql + поиск RETURNING) против реестра запросов (поиск в словаре).
+
+    python -m bench.pg_sql_overhead --calls 200000
+
+PostgreSQL не нужен — курсор-заглушка ничего не выполняет.
+"""
+import argparse
+import json
+import sys
+import time
+
+
+class _NullCursor:
+    rowcount = 1
+    lastrowid = None
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchone(self):
+        return (1,)
+
+
+class _AdaptEachCall:
+    """Прежний путь: SQL переписывается при каждом execute."""
+    def __init__(self, cur):
+        self._cur = cur
+
+    def execute(self, sql, params=None):
+        import db
+        sql = db._pg_adapt_sql(sql)
+        self._cur.execute(sql, params)
+        if "RETURNING" in sql.upper():
+            self._cur.fetchone()
+        return self
+
+
+def _measure(cur, statements: list, calls: int) -> float:
+    """нс на вызов"""
+    n = len(statements)
+    t0 = time.perf_counter_ns()
+    for i in range(calls):
+        sql, params = statements[i % n]
+        cur.execute(sql, params)
+    return (time.perf_counter_ns() - t0) / calls
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200000)
+    args = parser.parse_args()
+    import db
+
+    statements = [
+        (db._LICENSE_ROWS_SQL, ("CODE",)),
+        (db._ACTIVATION_INSERT_SQL, (1, "hwid", None, None, None)),
+        ("SELECT id, expires_at, revoked, is_developer FROM codes WHERE code = ?", ("CODE",)),
+        ("INSERT OR REPLACE INTO settings (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)", ("k", "v")),
+        ("INSERT OR IGNORE INTO users (telegram_id, username) VALUES (?, ?)", (1, "u")),
+        ("INSERT INTO payments (user_telegram_id, amount_usd, plan_days) VALUES (?, ?, ?) RETURNING id", (1, 1.0, 30)),
+    ]
+    before = _measure(_AdaptEachCall(_NullCursor()), statements, args.calls)
+    after = _measure(db._PgCursorWrapper(_NullCursor()), statements, args.calls)
+    print(json.dumps({
+        "calls": args.calls, "before_ns_per_call": round(before), "after_ns_per_call": round(after),
+        "speedup": round(before / after, 1),
+    }, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+/check под фоновым админ-экспортом: p99 /check без экспорта, с экспортом в полосе admin и с экспортом в той же полосе,
+что /check (одна общая FIFO-очередь — как до полос). Экспорт — циклы list_codes_and_activations + get_referral_stats,
+как при листании админ-бота.
+
+    python -m bench.priority_lanes --codes 20000 --requests 5000 --concurrency 32 --exporters 4
+
+Кэш вердиктов выключен — меряем БД. Без DATABASE_URL — временная SQLite.
+
+Замер (SQLite, Python 3.11, --codes 20000 --requests 20000 --exporters 4, лимит допуска 10), /check мс:
+
+    concurrency 32 (пул насыщен /check)   p50     p99    rps   экспортов / отказов DbOverloaded
+    baseline                              17.8    41.8   1749  —
+    export_with_lanes                     14.9    31.9   1948  4 / 17
+    export_without_lanes                 112.6   221.7    281  504 / 0
+
+    concurrency 8 (запас слотов)          p50     p99    rps
+    baseline                               4.8     9.9   1623  —
+    export_with_lanes                     31.0    85.6    238  524 / 0
+    export_without_lanes                  40.2   106.0    183  863 / 0
+
+При насыщении p99 /check с экспортом не растёт: экспорт ждёт свободной доли и получает быстрый отказ, а в общей
+очереди p99 ×5. При запасе слотов экспорт идёт, и на SQLite /check всё равно замедляется — сборка 20k строк в потоках
+того же процесса делит с /check GIL и CPU, это допуск не регулирует; полосы лишь ограничивают число экспортов сразу.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import random
+import secrets
+import sys
+import tempfile
+import time
+
+from bench.check_load import _percentiles, _seed
+
+
+async def _drive(client, load: list, concurrency: int) -> dict:
+    latencies, statuses = [], {}
+    queue = iter(load)
+
+    async def worker():
+        for code, hwid in queue:
+            t0 = time.perf_counter()
+            try:
+                status = (await client.post("/check", json={"code": code, "hwid": hwid})).status_code
+            except Exception as e:
+                status = type(e).__name__
+            latencies.append((time.perf_counter() - t0) * 1000)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - t0
+    return {"rps": round(len(load) / elapsed, 1), "latency_ms": _percentiles(latencies), "statuses": statuses}
+
+
+async def _export_loop(stop: asyncio.Event, done: list, lane: str):
+    import admission
+    import db
+
+    admission.set_lane(lane)
+    while not stop.is_set():
+        try:
+            await admission.db_call(db.list_codes_and_activations)
+            await admission.db_call(db.get_referral_stats)
+            done[0] += 1
+        except admission.DbOverloaded:
+            done[1] += 1
+            await asyncio.sleep(0.05)
+
+
+async def _scenario(client, load: list, args, exporters: int, lane: str = "admin") -> dict:
+    stop, done = asyncio.Event(), [0, 0]
+    tasks = [asyncio.create_task(_export_loop(stop, done, lane)) for _ in range(exporters)]
+    await asyncio.sleep(0.2 if exporters else 0)  # экспорт уже занял слоты к началу замера
+    try:
+        result = await _drive(client, load, args.concurrency)
+    finally:
+        stop.set()
+        await asyncio.gather(*tasks)
+    return {**result, "exports": done[0], "exports_rejected": done[1]}
+
+
+async def main_async(args) -> dict:
+    import httpx
+    import admission
+    import db
+    import main
+
+    db.init_db()
+    db.load_settings_cache()
+    prefix = "P" + secrets.token_hex(2).upper()
+    seeded = _seed(db, prefix, {"valid": args.codes, "expired": 0, "revoked": 0, "invalid": 0, "first": 0})
+    load = [random.choice(seeded["valid"]) for _ in range(args.requests)]
+
+    headers = {"X-API-Secret": main.API_SECRET} if main.API_SECRET else {}
+    report = {}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.build_api_app()), base_url="http://bench",
+                                 headers=headers, timeout=60) as client:
+        await _drive(client, load[:args.requests // 10], args.concurrency)  # прогрев
+        report["baseline"] = await _scenario(client, load, args, 0)
+        report["export_with_lanes"] = await _scenario(client, load, args, args.exporters, admission.LANE_ADMIN)
+        report["export_without_lanes"] = await _scenario(client, load, args, args.exporters, admission.LANE_CHECK)
+    report["config"] = {
+        "backend": "postgres" if db._USE_PG else "sqlite",
+        "codes": args.codes, "requests": args.requests, "concurrency": args.concurrency,
+        "exporters": args.exporters, "admission_limit": admission.MAX_LIMIT, "lane_shares": admission.LANE_SHARES,
+    }
+    return report
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--codes", type=int, default=20000)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--exporters", type=int, default=4, help="параллельных циклов админ-экспорта")
+    parser.add_argument("--thread-pool", type=int, default=int(os.environ.get("THREAD_POOL_SIZE", "10")))
+    parser.add_argument("--db-path", default="")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default="")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    if not os.environ.get("DATABASE_URL"):
+        os.environ["DB_PATH"] = args.db_path or os.path.join(tempfile.mkdtemp(), "priority_lanes.db")
+    os.environ["LICENSE_CACHE_SIZE"] = "0"
+
+    async def runner():
+        asyncio.get_running_loop().set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=args.thread_pool))
+        return await main_async(args)
+
+    text = json.dumps(asyncio.run(runner()), indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Пропускная способность check_license на SQLite с большим числом кодов (по умолчанию 1M, все активированы).
+
+    python -m bench.sqlite_check_license --codes 1000000 --requests 50000 --threads 8
+
+База создаётся во временном каталоге (или --db, чтобы переиспользовать между прогонами). Кэш вердиктов выключен.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _seed(path: str, codes: int):
+    """Коды и активации пачками напрямую через sqlite3 — create_code на 1M строк слишком долгий."""
+    conn = sqlite3.connect(path)
+    (have,) = conn.execute("SELECT COUNT(*) FROM codes").fetchone()
+    batch = 50000
+    for start in range(have, codes, batch):
+        ids = range(start + 1, min(codes, start + batch) + 1)
+        conn.executemany("INSERT INTO codes (id, code, days) VALUES (?, ?, 30)", ((i, f"B{i:015d}") for i in ids))
+        conn.executemany(
+            "INSERT INTO activations (code_id, hwid, expires_at, expires_ts) VALUES (?, ?, '2099-01-01T00:00:00', 4070908800)",
+            ((i, f"hw{i}") for i in ids),
+        )
+        conn.commit()
+    conn.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--codes", type=int, default=1000000)
+    parser.add_argument("--requests", type=int, default=50000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--db", default="")
+    args = parser.parse_args()
+
+    os.environ.pop("DATABASE_URL", None)
+    os.environ["DB_PATH"] = args.db or os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ["LICENSE_CACHE_SIZE"] = "0"
+    import db
+
+    db.init_db()
+    t0 = time.perf_counter()
+    _seed(db.DB_PATH, args.codes)
+    seed_s = time.perf_counter() - t0
+
+    ids = [random.randint(1, args.codes) for _ in range(args.requests)]
+
+    def one(i):
+        t = time.perf_counter()
+        result = db.check_license(f"B{i:015d}", f"hw{i}")
+        assert result["ok"], result
+        return (time.perf_counter() - t) * 1000
+
+    with ThreadPoolExecutor(max_workers=args.threads) as ex:
+        list(ex.map(one, ids[:2000]))  # прогрев
+        t0 = time.perf_counter()
+        latencies = sorted(ex.map(one, ids))
+        elapsed = time.perf_counter() - t0
+    print(json.dumps({
+        "codes": args.codes, "requests": args.requests, "threads": args.threads, "seed_s": round(seed_s, 1),
+        "rps": round(args.requests / elapsed), "p50_ms": round(latencies[len(latencies) // 2], 3),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)], 3),
+    }, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Стресс-тест активации: сотни параллельных /check с разными HWID на один код.
+Должна победить ровно одна активация, остальные — code_already_used.
+
+    python -m bench.stress_activation --threads 300
+
+Без DATABASE_URL работает на временной SQLite.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=300)
+    parser.add_argument("--rounds", type=int, default=3, help="сколько кодов прогнать подряд")
+    args = parser.parse_args()
+
+    if not os.environ.get("DATABASE_URL"):
+        os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "stress.db")
+    os.environ["LICENSE_CACHE_SIZE"] = "0"  # проверяем БД, а не кэш
+    import db
+
+    db.init_db()
+    failed = False
+    for n in range(args.rounds):
+        code = db.create_code(30)
+        barrier = threading.Barrier(args.threads)
+
+        def worker(i):
+            barrier.wait()
+            for _ in range(200):
+                try:
+                    return db.check_or_activate(code, f"{i:032x}").get("error", "ok")
+                except Exception as e:
+                    if type(e).__name__ != "PoolError":  # пул PG исчерпан — клиент повторит
+                        return type(e).__name__
+                    time.sleep(0.01)
+            return "PoolError"
+
+        with ThreadPoolExecutor(max_workers=args.threads) as ex:
+            results = Counter(ex.map(worker, range(args.threads)))
+        with db.get_db() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM activations a JOIN codes c ON c.id = a.code_id WHERE c.code = ? AND a.revoked = 0", (code,))
+            live = cur.fetchone()[0]
+        ok = results.get("ok", 0) == 1 and live == 1 and results.get("code_already_used", 0) == args.threads - 1
+        failed |= not ok
+        print(f"round {n + 1}: {dict(results)} live_activations={live} {'OK' if ok else 'FAIL'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
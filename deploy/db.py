@@ -3,8 +3,11 @@
 import sqlite3
 import os
 import re
+import threading
 import time
+from collections import OrderedDict
 from contextlib import contextmanager
+from contextvars import ContextVar
 
 # Без семафора — как в первых версиях. Пул сам блокирует при исчерпании.
 _CRITICAL_ERRORS = []
@@ -13,6 +16,15 @@ _CRITICAL_THRESHOLD = int(os.environ.get("RESTART_ON_ERRORS_COUNT", "0"))  # 0 =
 
 _DATABASE_URL = os.environ.get("DATABASE_URL", "").strip()
 _USE_PG = bool(_DATABASE_URL and "postgres" in _DATABASE_URL.lower())
+# Реплика для get_db(readonly=True): тяжёлые выборки админки и профилей не нагружают primary
+_DATABASE_READ_URL = os.environ.get("DATABASE_READ_URL", "").strip()
+_USE_PG_REPLICA = _USE_PG and bool(_DATABASE_READ_URL)
+_REPLICA_RETRY_SEC = int(os.environ.get("DB_READ_RETRY_SEC", "30"))  # после отказа реплики столько читаем с primary
+_replica_down_until = 0.0
+# Асинхронный бэкенд горячих путей (db_async) — здесь, т.к. его пул входит в общий бюджет соединений
+DB_ASYNC = os.environ.get("DB_ASYNC", "").strip().lower() in ("1", "true", "yes")
+# Бюджет соединений процесса к PostgreSQL (Railway Free ~10): пул потоков, пул asyncpg и пул реплики делят его
+PG_CONN_BUDGET = max(3, int(os.environ.get("DB_CONN_BUDGET", "0")) or min(int(os.environ.get("DB_POOL_SIZE", "8")), 8))
 
 # DB_PATH: для SQLite — явно задай или используй Railway Volume (RAILWAY_VOLUME_MOUNT_PATH)
 def _get_db_path() -> str:
@@ -26,54 +38,86 @@ def _get_db_path() -> str:
 DB_PATH = _get_db_path()
 
 
+# ON CONFLICT для INSERT OR IGNORE / INSERT OR REPLACE: (режим, таблица) → хвост PostgreSQL
+_PG_ON_CONFLICT = {
+    ("IGNORE", "settings"): "ON CONFLICT (key) DO NOTHING",
+    ("IGNORE", "pending_users"): "ON CONFLICT (username) DO NOTHING",
+    ("IGNORE", "users"): "ON CONFLICT (telegram_id) DO NOTHING",
+    ("IGNORE", "referrals"): "ON CONFLICT (referred_id) DO NOTHING",
+    ("IGNORE", "referrer_stats"): "ON CONFLICT (referrer_id) DO NOTHING",
+    ("REPLACE", "settings"): "ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value, updated_at=CURRENT_TIMESTAMP",
+    ("REPLACE", "admins"): "ON CONFLICT (telegram_id) DO UPDATE SET username=EXCLUDED.username, added_by=EXCLUDED.added_by",
+    ("REPLACE", "pending_code_assign"): "ON CONFLICT (admin_id) DO UPDATE SET code=EXCLUDED.code, created_at=EXCLUDED.created_at",
+}
+_INSERT_OR_RE = re.compile(r"INSERT OR (IGNORE|REPLACE) INTO (\w+)", re.IGNORECASE)
+
+
 def _pg_adapt_sql(sql: str) -> str:
     """Преобразует SQLite-синтаксис в PostgreSQL."""
     sql = sql.replace("?", "%s")
     sql = sql.replace("datetime('now')", "CURRENT_TIMESTAMP")
     sql = re.sub(r"datetime\('now',\s*'-1 hour'\)", "CURRENT_TIMESTAMP - INTERVAL '1 hour'", sql)
-    # INSERT OR IGNORE
-    if "INSERT OR IGNORE" in sql.upper():
-        sql = sql.replace("INSERT OR IGNORE", "INSERT")
-        if "INTO settings " in sql:
-            sql = re.sub(r"\)\s*$", ") ON CONFLICT (key) DO NOTHING", sql)
-        elif "INTO pending_users " in sql:
-            sql = re.sub(r"\)\s*$", ") ON CONFLICT (username) DO NOTHING", sql)
-        elif "INTO users " in sql:
-            sql = re.sub(r"\)\s*$", ") ON CONFLICT (telegram_id) DO NOTHING", sql)
-        elif "INTO referrals " in sql:
-            sql = re.sub(r"\)\s*$", ") ON CONFLICT (referred_id) DO NOTHING", sql)
-    # INSERT OR REPLACE
-    if "INSERT OR REPLACE" in sql.upper():
-        sql = sql.replace("INSERT OR REPLACE", "INSERT")
-        if "INTO settings " in sql:
-            sql = re.sub(r"\)\s*$", ") ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value, updated_at=CURRENT_TIMESTAMP", sql)
-        elif "INTO admins " in sql:
-            sql = re.sub(r"\)\s*$", ") ON CONFLICT (telegram_id) DO UPDATE SET username=EXCLUDED.username, added_by=EXCLUDED.added_by", sql)
-        elif "INTO pending_code_assign " in sql:
-            sql = re.sub(r"\)\s*$", ") ON CONFLICT (admin_id) DO UPDATE SET code=EXCLUDED.code, created_at=EXCLUDED.created_at", sql)
+    m = _INSERT_OR_RE.search(sql)
+    if m:
+        sql = sql[:m.start()] + "INSERT INTO " + m.group(2) + sql[m.end():]
+        clause = _PG_ON_CONFLICT.get((m.group(1).upper(), m.group(2)))
+        if clause:
+            sql = re.sub(r"\)\s*$", ") " + clause, sql)
+    return sql
+
+
+# Реестр запросов: SQL в синтаксисе SQLite → (SQL для PostgreSQL, есть ли RETURNING).
+# Горячие запросы регистрируются через _q() при импорте, остальные — при первом выполнении.
+_SQL_REGISTRY: dict = {}
+_SQL_REGISTRY_MAX = 4096  # защита от разрастания на динамическом SQL
+
+
+def _compile_sql(sql: str) -> tuple[str, bool]:
+    compiled = _SQL_REGISTRY.get(sql)
+    if compiled is None:
+        pg = _pg_adapt_sql(sql)
+        compiled = (pg, "RETURNING" in pg.upper())
+        if len(_SQL_REGISTRY) < _SQL_REGISTRY_MAX:
+            _SQL_REGISTRY[sql] = compiled
+    return compiled
+
+
+def _q(sql: str) -> str:
+    """Объявление запроса: компилирует PostgreSQL-форму сразу, возвращает SQL как есть (он же ключ)."""
+    _compile_sql(sql)
     return sql
 
 
 class _PgCursorWrapper:
-    """Обёртка курсора для PostgreSQL: конвертирует ? в %s и INSERT OR IGNORE/REPLACE."""
-    def __init__(self, cur):
+    """Обёртка курсора для PostgreSQL: SQL берётся из реестра (? → %s, INSERT OR IGNORE/REPLACE → ON CONFLICT)."""
+    def __init__(self, cur, owner=None):
         self._cur = cur
+        self._owner = owner  # _PgConnWrapper: отметить запись (statusmessage не SELECT)
         self._last_inserted_id = None
 
     def execute(self, sql, params=None):
         self._last_inserted_id = None
-        sql = _pg_adapt_sql(sql)
+        sql, returning = _SQL_REGISTRY.get(sql) or _compile_sql(sql)
         if params:
             self._cur.execute(sql, params)
         else:
             self._cur.execute(sql)
+        if self._owner is not None and not (self._cur.statusmessage or "").startswith("SELECT"):
+            self._owner.wrote = True
         # Для INSERT с RETURNING сохраняем id
-        if "RETURNING" in sql.upper():
+        if returning:
             row = self._cur.fetchone()
             if row:
                 self._last_inserted_id = row[0]
         return self
 
+    def execute_values(self, sql, rows, **kwargs):
+        """psycopg2.extras.execute_values (многострочный VALUES %s): SQL уже в синтаксисе PostgreSQL, всегда запись."""
+        from psycopg2.extras import execute_values
+        if self._owner is not None:
+            self._owner.wrote = True
+        return execute_values(self._cur, sql, rows, **kwargs)
+
     def fetchone(self):
         return self._cur.fetchone()
 
@@ -96,9 +140,10 @@ class _PgConnWrapper:
     def __init__(self, conn, pool=None):
         self._conn = conn
         self._pool = pool  # если задан — возвращаем в пул, иначе close()
+        self.wrote = False
 
     def cursor(self):
-        return _PgCursorWrapper(self._conn.cursor())
+        return _PgCursorWrapper(self._conn.cursor(), self)
 
     def commit(self):
         self._conn.commit()
@@ -114,23 +159,139 @@ class _PgConnWrapper:
 
 
 _PG_POOL = None
+_PG_READ_POOL = None
+# Здоровье соединений пула: 0 — проверка выключена
+_PG_CONN_MAX_LIFETIME = int(os.environ.get("PG_CONN_MAX_LIFETIME_SEC", "1800"))
+_PG_CONN_MAX_IDLE = int(os.environ.get("PG_CONN_MAX_IDLE_SEC", "300"))
+_PG_PREPING_IDLE = float(os.environ.get("PG_PREPING_IDLE_SEC", "5"))  # SELECT 1 при выдаче, если простаивало дольше
+
+def _new_pg_pool_stats() -> dict:
+    return {"connects": 0, "checkouts": 0, "pings": 0, "ping_failed": 0, "recycled_lifetime": 0,
+            "recycled_idle": 0, "discarded_broken": 0}
+
+
+_pg_pool_stats = _new_pg_pool_stats()
+_pg_read_pool_stats = _new_pg_pool_stats()
+_pg_read_routing = {"replica": 0, "primary_after_write": 0, "replica_unavailable": 0, "replica_skipped": 0,
+                    "replica_pool_full": 0}
+
+
+def _healthy_pool_class(base, stats: dict):
+    """
+    Пул поверх psycopg2 ThreadedConnectionPool: при выдаче соединение старше PG_CONN_MAX_LIFETIME_SEC или
+    простоявшее дольше PG_CONN_MAX_IDLE_SEC закрывается, после простоя PG_PREPING_IDLE_SEC — пингуется;
+    закрытое / оборванное (в т.ч. вернувшееся после ошибки связи) выбрасывается. Взамен пул открывает новое,
+    так что обрыв связи с PG стоит одного упавшего запроса, а не перезапуска процесса.
+    """
+    class HealthyPool(base):
+        def __init__(self, *args, **kwargs):
+            self._conn_times = {}  # id(conn) → [создано, возвращено в пул]
+            super().__init__(*args, **kwargs)
+
+        def _connect(self, key=None):
+            live = set(self._rused) | {id(c) for c in self._pool}
+            self._conn_times = {k: v for k, v in self._conn_times.items() if k in live}
+            conn = super()._connect(key)
+            now = time.monotonic()
+            self._conn_times[id(conn)] = [now, now]
+            stats["connects"] += 1
+            return conn
+
+        def _unhealthy(self, conn):
+            """Причина выбросить соединение (ключ stats) или None."""
+            if conn.closed:
+                return "discarded_broken"
+            now = time.monotonic()
+            created, returned = self._conn_times.get(id(conn), (now, now))
+            if _PG_CONN_MAX_LIFETIME and now - created > _PG_CONN_MAX_LIFETIME:
+                return "recycled_lifetime"
+            if _PG_CONN_MAX_IDLE and now - returned > _PG_CONN_MAX_IDLE:
+                return "recycled_idle"
+            if now - returned >= _PG_PREPING_IDLE:
+                stats["pings"] += 1
+                try:
+                    cur = conn.cursor()
+                    cur.execute("SELECT 1")  # транзакцию не закрываем — в ней же пойдут запросы get_db
+                    cur.fetchone()
+                    cur.close()
+                except Exception:
+                    return "ping_failed"
+            return None
+
+        def getconn(self, key=None):
+            for _ in range(self.maxconn):
+                conn = super().getconn(key)
+                reason = self._unhealthy(conn)
+                if reason is None:
+                    break
+                stats[reason] += 1
+                self.putconn(conn, key, close=True)
+            else:
+                conn = super().getconn(key)  # все выданные оказались мёртвыми — это уже новое соединение
+            stats["checkouts"] += 1
+            return conn
+
+        def putconn(self, conn=None, key=None, close=False):
+            import psycopg2.extensions
+            if not close and (conn.closed or conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN):
+                stats["discarded_broken"] += 1
+                close = True
+            times = self._conn_times.pop(id(conn), None) if close else self._conn_times.get(id(conn))
+            if times is not None:
+                times[1] = time.monotonic()
+            super().putconn(conn, key, close)
+
+    return HealthyPool
+
+
+def pg_pool_sizes() -> dict:
+    """
+    Размеры пулов в пределах PG_CONN_BUDGET: {"threaded", "async", "replica"}, 0 — пула нет.
+    Реплике — четверть, asyncpg (DB_ASYNC=1) — половина остатка, пулу потоков — всё прочее.
+    """
+    replica = max(1, PG_CONN_BUDGET // 4) if _USE_PG_REPLICA else 0
+    async_ = max(1, (PG_CONN_BUDGET - replica) // 2) if DB_ASYNC else 0
+    return {"threaded": PG_CONN_BUDGET - replica - async_, "async": async_, "replica": replica}
+
+
+def _new_pg_pool(url: str, stats: dict, maxconn: int):
+    import psycopg2.pool
+    return _healthy_pool_class(psycopg2.pool.ThreadedConnectionPool, stats)(
+        min(2, maxconn), maxconn, url,
+        connect_timeout=15  # не висеть при недоступной БД
+    )
 
 
 def _get_pg_pool():
     global _PG_POOL
     if _PG_POOL is None and _USE_PG:
-        import psycopg2.pool
-        minconn = 2
-        # Railway Free ~10 соединений — пул не больше 8, чтобы не крашить БД при очереди
-        maxconn = int(os.environ.get("DB_POOL_SIZE", "8"))
-        maxconn = min(maxconn, 8)  # жёсткий лимит под Railway
-        _PG_POOL = psycopg2.pool.ThreadedConnectionPool(
-            minconn, maxconn, _DATABASE_URL,
-            connect_timeout=15  # не висеть при недоступной БД
-        )
+        _PG_POOL = _new_pg_pool(_DATABASE_URL, _pg_pool_stats, pg_pool_sizes()["threaded"])
     return _PG_POOL
 
 
+def _get_pg_read_pool():
+    global _PG_READ_POOL
+    if _PG_READ_POOL is None and _USE_PG_REPLICA:
+        _PG_READ_POOL = _new_pg_pool(_DATABASE_READ_URL, _pg_read_pool_stats, pg_pool_sizes()["replica"])
+    return _PG_READ_POOL
+
+
+def _pool_stats(pool, stats: dict) -> dict:
+    return {**stats, "idle": len(pool._pool), "used": len(pool._used),
+            "max_lifetime_s": _PG_CONN_MAX_LIFETIME, "max_idle_s": _PG_CONN_MAX_IDLE}
+
+
+def get_pg_pool_stats() -> dict:
+    """Счётчики пула PostgreSQL (проверки, пересоздания) — для /metrics. Пусто для SQLite."""
+    if _PG_POOL is None:
+        return {}
+    stats = {**_pool_stats(_PG_POOL, _pg_pool_stats), "budget": PG_CONN_BUDGET, "sizes": pg_pool_sizes()}
+    if _USE_PG_REPLICA:
+        stats["replica"] = _pool_stats(_PG_READ_POOL, _pg_read_pool_stats) if _PG_READ_POOL is not None else {}
+        stats["read_routing"] = dict(_pg_read_routing)
+    return stats
+
+
 def _on_critical_db_error():
     """При серии критических ошибок — выход процесса, Railway перезапустит контейнер."""
     global _CRITICAL_ERRORS
@@ -162,25 +323,127 @@ def _db_health_check() -> bool:
         return False
 
 
-def _get_conn():
+# SQLite: одно долгоживущее соединение на поток (пул потоков asyncio.to_thread, боты) вместо connect/close на каждый get_db
+_SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+_SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",  # читатели не ждут писателя
+    "PRAGMA synchronous=NORMAL",  # в WAL безопасно, fsync только на checkpoint
+    f"PRAGMA mmap_size={int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))}",
+    f"PRAGMA cache_size=-{int(os.environ.get('SQLITE_CACHE_KB', '65536'))}",
+    f"PRAGMA busy_timeout={_SQLITE_BUSY_TIMEOUT_MS}",
+)
+_sqlite_local = threading.local()
+
+
+def _sqlite_connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, timeout=_SQLITE_BUSY_TIMEOUT_MS / 1000, cached_statements=256)
+    for pragma in _SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _sqlite_drop_conn():
+    """Закрыть соединение потока — следующий get_db откроет новое."""
+    conn = getattr(_sqlite_local, "conn", None)
+    _sqlite_local.conn = None
+    if conn is not None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def _get_conn(readonly: bool = False):
     if _USE_PG:
-        pool = _get_pg_pool()
+        pool = _get_pg_read_pool() if readonly else _get_pg_pool()
         if pool:
             conn = pool.getconn()
             return _PgConnWrapper(conn, pool)
         import psycopg2
-        return _PgConnWrapper(psycopg2.connect(_DATABASE_URL), pool=None)
-    return sqlite3.connect(DB_PATH)
+        return _PgConnWrapper(psycopg2.connect(_DATABASE_READ_URL if readonly else _DATABASE_URL), pool=None)
+    conn = getattr(_sqlite_local, "conn", None)
+    if conn is None:
+        conn = _sqlite_local.conn = _sqlite_connect()
+    return conn
+
+
+# Сессия чтения (HTTP-запрос / апдейт бота): после записи её readonly-чтения идут в primary — читаем свои записи.
+# Словарь изменяемый: asyncio.to_thread копирует контекст, но объект сессии общий.
+_read_session: ContextVar = ContextVar("db_read_session", default=None)
+_pg_local = threading.local()  # depth — открытые get_db на primary в этом потоке
+
+
+def start_read_session():
+    """Новая сессия чтения в текущем контексте (до конца задачи / обработки апдейта)."""
+    return _read_session.set({"wrote": False})
+
+
+@contextmanager
+def read_session():
+    """get_db(readonly=True) внутри блока читает с реплики, пока в блоке не было записи."""
+    token = start_read_session()
+    try:
+        yield
+    finally:
+        _read_session.reset(token)
+
+
+def note_session_write():
+    """Запись в обход get_db (db_async): дальнейшие чтения сессии — с primary."""
+    session = _read_session.get()
+    if session is not None:
+        session["wrote"] = True
+
+
+def _use_replica(readonly: bool) -> bool:
+    if not (readonly and _USE_PG_REPLICA):
+        return False
+    session = _read_session.get()
+    if getattr(_pg_local, "depth", 0) or (session is not None and session["wrote"]):
+        _pg_read_routing["primary_after_write"] += 1
+        return False
+    if time.monotonic() < _replica_down_until:
+        _pg_read_routing["replica_skipped"] += 1  # реплика недавно не ответила — не ждём connect_timeout
+        return False
+    _pg_read_routing["replica"] += 1
+    return True
 
 
 @contextmanager
-def get_db():
+def get_db(readonly: bool = False):
+    """
+    Соединение в транзакции. readonly=True — функция только читает: при DATABASE_READ_URL запрос идёт в реплику,
+    кроме вложенного get_db и сессии, в которой уже была запись (тогда primary). Если реплика не выдала
+    соединение — DB_READ_RETRY_SEC читаем с primary. SQLite readonly не различает.
+    """
+    global _replica_down_until
+    if not _USE_PG:
+        with _get_db_sqlite() as conn:
+            yield conn
+        return
+    replica = _use_replica(readonly)
     conn = None
+    if replica:
+        try:
+            conn = _get_conn(readonly=True)
+        except Exception as e:
+            import psycopg2.pool
+            if isinstance(e, psycopg2.pool.PoolError):
+                _pg_read_routing["replica_pool_full"] += 1  # пул реплики меньше числа читателей — это не отказ реплики
+            else:
+                _pg_read_routing["replica_unavailable"] += 1  # реплика недоступна — читаем с primary
+                _replica_down_until = time.monotonic() + _REPLICA_RETRY_SEC
+            replica = False
+    if not replica:
+        _pg_local.depth = getattr(_pg_local, "depth", 0) + 1
     try:
-        conn = _get_conn()
+        if conn is None:
+            conn = _get_conn()
         yield conn
         conn.commit()
         _reset_critical_errors()
+        if conn.wrote:
+            note_session_write()
     except Exception:
         if conn is not None:
             try:
@@ -189,13 +452,65 @@ def get_db():
                 pass
         raise
     finally:
+        if not replica:
+            _pg_local.depth -= 1
         if conn is not None:
             try:
-                conn.close()  # для PG — putconn в пул; для SQLite — close
+                conn.close()  # putconn в пул
             except Exception:
                 pass  # не маскируем исходную ошибку, но соединение могло уйти в пул
 
 
+@contextmanager
+def _get_db_sqlite():
+    """
+    get_db для SQLite на соединении потока. Вложенный get_db в том же потоке — SAVEPOINT на том же соединении
+    (раньше это было второе соединение и ожидание собственной блокировки записи).
+    """
+    depth = getattr(_sqlite_local, "depth", 0)
+    conn = _get_conn()
+    if depth:
+        savepoint = f"get_db_{depth}"
+        conn.execute(f"SAVEPOINT {savepoint}")
+        _sqlite_local.depth = depth + 1
+        try:
+            yield conn
+        except BaseException:
+            conn.execute(f"ROLLBACK TO SAVEPOINT {savepoint}")
+            conn.execute(f"RELEASE SAVEPOINT {savepoint}")
+            raise
+        else:
+            conn.execute(f"RELEASE SAVEPOINT {savepoint}")
+        finally:
+            _sqlite_local.depth = depth
+        return
+    _sqlite_local.depth = 1
+    try:
+        yield conn
+        conn.commit()
+        _reset_critical_errors()
+    except BaseException as e:
+        try:
+            conn.rollback()
+        except Exception:
+            _sqlite_drop_conn()
+        else:
+            # Ошибка самой БД (кроме нарушения уникальности) — соединение не переиспользуем
+            if isinstance(e, sqlite3.DatabaseError) and not isinstance(e, sqlite3.IntegrityError):
+                _sqlite_drop_conn()
+        raise
+    finally:
+        _sqlite_local.depth = 0
+
+
+def _integrity_errors() -> tuple:
+    """Классы ошибок нарушения уникальности для текущего бэкенда."""
+    if _USE_PG:
+        import psycopg2
+        return (sqlite3.IntegrityError, psycopg2.IntegrityError)
+    return (sqlite3.IntegrityError,)
+
+
 def _pg_column_exists(cur, table: str, column: str) -> bool:
     """Проверка: есть ли колонка в таблице (PostgreSQL). Не пишет в лог при отсутствии."""
     cur.execute(
@@ -205,8 +520,8 @@ def _pg_column_exists(cur, table: str, column: str) -> bool:
     return cur.fetchone() is not None
 
 
-def _alter_safe(conn, cur, sql):
-    """Выполнить ALTER TABLE, игнорируя ошибку «колонка уже есть»."""
+def _alter_safe(conn, cur, sql, quiet: bool = True):
+    """Выполнить ALTER TABLE, игнорируя ошибку «колонка уже есть». quiet=False — ошибку пишем в лог."""
     if _USE_PG and "ADD COLUMN" in sql.upper():
         # PostgreSQL: проверяем до ALTER — не будет ошибки в логах
         import re
@@ -216,7 +531,10 @@ def _alter_safe(conn, cur, sql):
     try:
         cur.execute("SAVEPOINT alter_safe")
         cur.execute(sql)
-    except (sqlite3.OperationalError, Exception):
+    except (sqlite3.OperationalError, Exception) as e:
+        if not quiet:
+            import logging
+            logging.getLogger(__name__).warning("Схема: %s — %s", sql.strip().splitlines()[0], e)
         try:
             cur.execute("ROLLBACK TO SAVEPOINT alter_safe")
         except Exception:
@@ -228,19 +546,76 @@ def _alter_safe(conn, cur, sql):
             pass
 
 
-def init_db():
+def init_db() -> list:
+    """
+    Схема по _MIGRATIONS. Актуальная база — одно чтение schema_version, без CREATE/ALTER.
+    Возвращает применённые миграции [(version, name, ms)].
+    """
     with get_db() as conn:
         cur = conn.cursor()
-        if _USE_PG:
-            _init_db_pg(conn, cur)
-        else:
-            _init_db_sqlite(conn, cur)
+        applied = _migrate(conn, cur)
         _ensure_partner_admins_from_env(conn)
         conn.commit()
+    return applied
+
+
+def _schema_version(conn, cur) -> int:
+    """Версия схемы; 0 — schema_version ещё нет (новая база или созданная до версионирования)."""
+    try:
+        cur.execute("SELECT MAX(version) FROM schema_version")
+        return cur.fetchone()[0] or 0
+    except Exception:
+        conn.rollback()
+        return 0
+
+
+_MIGRATE_LOCK_ID = 7807001  # pg_advisory_lock: два инстанса при деплое не мигрируют одновременно
+
+
+def _migrate(conn, cur) -> list:
+    """Применить миграции новее текущей версии, каждую своим коммитом."""
+    current = _schema_version(conn, cur)
+    if current >= _MIGRATIONS[-1][0]:
+        return []
+    import logging
+    log = logging.getLogger(__name__)
+    if _USE_PG:
+        # До CREATE TABLE: параллельный CREATE TABLE IF NOT EXISTS в PG падает на уникальности pg_type
+        cur.execute("SELECT pg_advisory_lock(?)", (_MIGRATE_LOCK_ID,))
+    applied = []
+    try:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                duration_ms INTEGER,
+                applied_at {"TIMESTAMP" if _USE_PG else "TEXT"} DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.commit()
+        current = _schema_version(conn, cur)  # другой инстанс мог успеть, пока ждали блокировку
+        for version, name, migration in _MIGRATIONS:
+            if version <= current:
+                continue
+            t0 = time.perf_counter()
+            migration(conn, cur)
+            ms = int((time.perf_counter() - t0) * 1000)
+            cur.execute("INSERT INTO schema_version (version, name, duration_ms) VALUES (?, ?, ?)", (version, name, ms))
+            conn.commit()
+            applied.append((version, name, ms))
+            log.info("Схема: миграция %d (%s) — %d мс", version, name, ms)
+    except BaseException:
+        conn.rollback()  # PG: иначе unlock ниже упадёт на прерванной транзакции
+        raise
+    finally:
+        if _USE_PG:
+            cur.execute("SELECT pg_advisory_unlock(?)", (_MIGRATE_LOCK_ID,))
+            conn.commit()
+    return applied
 
 
 def _init_db_sqlite(conn, cur):
-    """Схема для SQLite."""
+    """Миграция 1: исходная схема SQLite (до версионирования создавалась при каждом старте)."""
     cur.execute("""
         CREATE TABLE IF NOT EXISTS codes (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -369,7 +744,7 @@ def _init_db_sqlite(conn, cur):
 
 
 def _init_db_pg(conn, cur):
-    """Схема для PostgreSQL."""
+    """Миграция 1: исходная схема PostgreSQL."""
     cur.execute("""
         CREATE TABLE IF NOT EXISTS codes (
             id SERIAL PRIMARY KEY,
@@ -491,6 +866,206 @@ def _init_db_pg(conn, cur):
     """)
 
 
+# Нормализованный username (без @, нижний регистр) — тот же, что _norm_username, но в SQL
+_USERNAME_NORM_SQL = "LOWER(REPLACE(TRIM({}), '@', ''))"
+
+
+def _norm_username(username: str | None) -> str:
+    return (username or "").strip().replace("@", "").lower()
+
+
+def _ensure_username_norm(conn, cur):
+    """users.username_norm и codes.username_norm (от assigned_username) с индексами; дозаполнение старых строк."""
+    _alter_safe(conn, cur, "ALTER TABLE users ADD COLUMN username_norm TEXT")
+    _alter_safe(conn, cur, "ALTER TABLE codes ADD COLUMN username_norm TEXT")
+    _backfill_username_norm(cur)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_username_norm ON users(username_norm)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_codes_username_norm ON codes(username_norm)")
+
+
+def _backfill_username_norm(cur) -> int:
+    """username_norm для строк, где он NULL (в т.ч. записанных прежней версией). Возвращает число строк."""
+    cur.execute("UPDATE users SET username_norm = " + _USERNAME_NORM_SQL.format("COALESCE(username, '')") + " WHERE username_norm IS NULL")
+    n = max(cur.rowcount, 0)
+    cur.execute("UPDATE codes SET username_norm = " + _USERNAME_NORM_SQL.format("assigned_username")
+                + " WHERE username_norm IS NULL AND assigned_username IS NOT NULL")
+    return n + max(cur.rowcount, 0)
+
+
+# Срок активации в секундах UTC (activations.expires_ts): сравнения и «дней осталось» — в SQL и по индексу
+_NOW_TS_SQL = "CAST(EXTRACT(EPOCH FROM NOW()) AS BIGINT)" if _USE_PG else "CAST(strftime('%s', 'now') AS INTEGER)"
+# Дней до конца активации (целых, не меньше 0) — в SQL, чтобы не разбирать даты в Python
+# (NULL, если expires_ts не заполнен; GREATEST в PG пропускает NULL, поэтому CASE)
+_DAYS_LEFT_SQL = (
+    f"CASE WHEN a.expires_ts > {_NOW_TS_SQL} THEN (a.expires_ts - {_NOW_TS_SQL}) / 86400 WHEN a.expires_ts IS NOT NULL THEN 0 END"
+)
+
+
+def _epoch(dt) -> int:
+    """datetime (naive = UTC, как utcnow()) → секунды UTC."""
+    from datetime import timezone
+    return int((dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)).timestamp())
+
+
+def _ensure_expires_ts(conn, cur):
+    """activations.expires_ts из ISO-строк expires_at (только незаполненные) и индекс для выборок по сроку."""
+    _alter_safe(conn, cur, "ALTER TABLE activations ADD COLUMN expires_ts " + ("BIGINT" if _USE_PG else "INTEGER"))
+    _backfill_expires_ts(cur)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_activations_expires_ts ON activations(expires_ts)")
+
+
+def _backfill_expires_ts(cur) -> int:
+    """expires_ts из expires_at для активаций, где он NULL. Возвращает число заполненных строк."""
+    if _USE_PG:
+        cur.execute("""
+            UPDATE activations SET expires_ts = CAST(EXTRACT(EPOCH FROM CAST(expires_at AS TIMESTAMP)) AS BIGINT)
+            WHERE expires_ts IS NULL AND expires_at ~ '^\\d{4}-\\d{2}-\\d{2}'
+        """)
+    else:
+        cur.execute("UPDATE activations SET expires_ts = CAST(strftime('%s', expires_at) AS INTEGER) WHERE expires_ts IS NULL AND expires_at IS NOT NULL")
+    n = max(cur.rowcount, 0)
+    # Что не разобрал SQL (нестандартный формат) — через _to_datetime; совсем битые остаются NULL
+    cur.execute("SELECT id, expires_at FROM activations WHERE expires_ts IS NULL AND expires_at IS NOT NULL AND expires_at != ''")
+    for act_id, expires_at in cur.fetchall():
+        try:
+            cur.execute("UPDATE activations SET expires_ts = ? WHERE id = ?", (_epoch(_to_datetime(expires_at)), act_id))
+            n += 1
+        except ValueError:
+            pass
+    return n
+
+
+# codes.status — состояние кода вместо анти-join NOT EXISTS по activations:
+#   active / expired — есть неотозванная активация (expired проставляет sweep по expires_ts);
+#   assigned — живой активации нет, код привязан к @username;
+#   revoked — живой активации нет, были отозванные; free — ни привязки, ни активаций.
+CODE_STATUSES = ("free", "assigned", "active", "expired", "revoked")
+# Статус кода codes.id «с нуля» по activations — для пересчёта после записи и для проверки согласованности
+_CODE_STATUS_EXPR = f"""
+    CASE
+        WHEN EXISTS (SELECT 1 FROM activations sa WHERE sa.code_id = codes.id AND sa.revoked = 0 AND sa.expires_ts < {_NOW_TS_SQL})
+            THEN 'expired'
+        WHEN EXISTS (SELECT 1 FROM activations sa WHERE sa.code_id = codes.id AND sa.revoked = 0) THEN 'active'
+        WHEN codes.username_norm IS NOT NULL AND codes.username_norm != '' THEN 'assigned'
+        WHEN EXISTS (SELECT 1 FROM activations sa WHERE sa.code_id = codes.id) THEN 'revoked'
+        ELSE 'free'
+    END
+"""
+
+
+def _refresh_code_status(cur, code_id: int):
+    """Пересчитать codes.status одного кода (в транзакции записи)."""
+    cur.execute(f"UPDATE codes SET status = {_CODE_STATUS_EXPR} WHERE id = ?", (code_id,))
+
+
+def _ensure_code_status(conn, cur):
+    """codes.status с заполнением по activations и индексами под выборки по статусу."""
+    _alter_safe(conn, cur, "ALTER TABLE codes ADD COLUMN status TEXT NOT NULL DEFAULT 'free'")
+    cur.execute(f"UPDATE codes SET status = {_CODE_STATUS_EXPR}")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_codes_status ON codes(status, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_codes_assigned_username ON codes(username_norm) WHERE status = 'assigned'")
+
+
+# Коды, у которых codes.status расходится с activations/привязкой явно (запись в обход _refresh_code_status —
+# например, прежним инстансом во время перекрывающегося деплоя). Без полного пересчёта по всем кодам.
+_CODE_STATUS_DRIFT_SQL = """
+    (status IN ('free', 'assigned', 'revoked') AND id IN (SELECT code_id FROM activations WHERE revoked = 0))
+    OR (status IN ('active', 'expired') AND id NOT IN (SELECT code_id FROM activations WHERE revoked = 0))
+    OR (status IN ('free', 'revoked') AND username_norm IS NOT NULL AND username_norm != '')
+    OR (status = 'free' AND id IN (SELECT code_id FROM activations))
+"""
+
+
+def _ensure_referrer_stats(conn, cur):
+    """Таблица referrer_stats с индексом для экрана статистики; пустая при существующих рефералах — заполняем."""
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS referrer_stats (
+            referrer_id {"BIGINT" if _USE_PG else "INTEGER"} PRIMARY KEY,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            pending_usd REAL NOT NULL DEFAULT 0,
+            paid_usd REAL NOT NULL DEFAULT 0,
+            updated_at {"TIMESTAMP" if _USE_PG else "TEXT"} DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_referrer_stats_count ON referrer_stats(ref_count)")
+    cur.execute("SELECT 1 FROM referrer_stats LIMIT 1")
+    if cur.fetchone() is None:
+        _rebuild_referrer_stats_on_cursor(cur)
+
+
+def _migration_base(conn, cur):
+    if _USE_PG:
+        _init_db_pg(conn, cur)
+    else:
+        _init_db_sqlite(conn, cur)
+
+
+def _migration_live_code_index(conn, cur):
+    # Одна неотозванная активация на код — гонку параллельных /check решает БД. Дубли в старых данных сначала
+    # отзываем (остаётся самая новая активация кода); если индекс всё же не создаётся — миграция падает, версия не пишется.
+    cur.execute("""
+        UPDATE activations SET revoked = 1
+        WHERE revoked = 0 AND id < (SELECT MAX(a2.id) FROM activations a2 WHERE a2.code_id = activations.code_id AND a2.revoked = 0)
+    """)
+    if cur.rowcount > 0:
+        import logging
+        logging.getLogger(__name__).warning("Схема: отозвано %d лишних живых активаций (по одной на код)", cur.rowcount)
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_activations_live_code ON activations(code_id) WHERE revoked = 0")
+
+
+def _migration_revocation_epoch(conn, cur):
+    cur.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ("revocation_epoch", "0"))
+
+
+def _migration_payments_order_index(conn, cur):
+    # Один платёж на заказ провайдера (NULL — ручные платежи — не ограничены). У дублей в старых данных остаётся самая
+    # ранняя строка, остальным к номеру заказа дописывается ":dup<id>"; если индекс всё же не создаётся — миграция падает.
+    cur.execute("""
+        UPDATE payments SET merchant_order_id = merchant_order_id || ':dup' || CAST(id AS TEXT)
+        WHERE merchant_order_id IS NOT NULL
+        AND id > (SELECT MIN(p2.id) FROM payments p2 WHERE p2.merchant_order_id = payments.merchant_order_id)
+    """)
+    if cur.rowcount > 0:
+        import logging
+        logging.getLogger(__name__).warning("Схема: %d повторных платежей по одному заказу отвязаны от номера заказа", cur.rowcount)
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_order ON payments(merchant_order_id)")
+
+
+def _migration_list_indexes(conn, cur):
+    """Индексы списков кодов/клиентов и профиля клиента."""
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_first_seen ON users(first_seen)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_activations_user ON activations(user_telegram_id)")
+    if _USE_PG:
+        # Поиск по префиксу (LIKE 'x%') в PG идёт по индексу только с text_pattern_ops при не-C локали
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_codes_username_norm_prefix ON codes(username_norm text_pattern_ops)")
+
+
+def _migration_drop_username_prefix_index(conn, cur):
+    # Поиск кодов снова по подстроке (LIKE '%x%') — префиксный индекс text_pattern_ops ему не помогает
+    if _USE_PG:
+        cur.execute("DROP INDEX IF EXISTS idx_codes_username_norm_prefix")
+
+
+# Миграции схемы по порядку: (версия, имя, функция(conn, cur)). Только дописывать в конец; версии не менять.
+# База без schema_version проходит все с начала — шаги идемпотентны (IF NOT EXISTS / _alter_safe / WHERE ... IS NULL).
+_MIGRATIONS = [
+    (1, "base", _migration_base),
+    (2, "activations_live_code", _migration_live_code_index),
+    (3, "revocation_epoch", _migration_revocation_epoch),
+    (4, "username_norm", _ensure_username_norm),
+    (5, "payments_order_unique", _migration_payments_order_index),
+    (6, "referrer_stats", _ensure_referrer_stats),
+    (7, "list_indexes", _migration_list_indexes),
+    (8, "expires_ts", _ensure_expires_ts),
+    (9, "code_status", _ensure_code_status),
+    # Базы, где версия 2 записалась, а индекс не создался из-за дублей (раньше это было лишь предупреждение)
+    (10, "activations_live_code_repair", _migration_live_code_index),
+    # То же для версии 5
+    (11, "payments_order_repair", _migration_payments_order_index),
+    (12, "drop_username_prefix_index", _migration_drop_username_prefix_index),
+]
+
+
 def _ensure_partner_admins_from_env(conn):
     """Добавить партнёров из PARTNER_USER_IDS в admins (полные права как у владельца)."""
     ids_str = os.environ.get("PARTNER_USER_IDS", "").strip()
@@ -562,6 +1137,114 @@ def is_appointed_admin(telegram_id: int) -> bool:
         return cur.fetchone() is not None
 
 
+# --- Кэш вердиктов /check ---
+# exe проверяет лицензию при каждом запуске — одинаковые (code, hwid, installation_id) не ходят в БД.
+# Кэшируются только окончательные ответы; любое изменение кода сбрасывает его записи.
+_LICENSE_CACHE_SIZE = int(os.environ.get("LICENSE_CACHE_SIZE", "10000"))  # 0 = выключен
+_LICENSE_CACHE_TTL = int(os.environ.get("LICENSE_CACHE_TTL", "300"))  # секунд
+_LICENSE_CACHEABLE_ERRORS = ("invalid_code", "revoked", "expired")
+_license_cache: OrderedDict = OrderedDict()  # key -> (deadline_monotonic, verdict)
+_license_cache_by_code: dict = {}  # code -> set(key) для точечной инвалидации
+_license_cache_lock = threading.Lock()
+_license_cache_epoch = 0  # растёт при каждой инвалидации — не кладём вердикт, прочитанный до неё
+_license_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+
+def _license_cache_key(code: str, hwid: str, installation_id: str | None) -> tuple:
+    return (code, hwid, installation_id or None)
+
+
+def _license_cache_drop(key):
+    """Удалить запись (под локом)."""
+    _license_cache.pop(key, None)
+    _license_cache_unindex(key)
+
+
+def _license_cache_unindex(key):
+    keys = _license_cache_by_code.get(key[0])
+    if keys is not None:
+        keys.discard(key)
+        if not keys:
+            del _license_cache_by_code[key[0]]
+
+
+def _license_cache_get(key) -> dict | None:
+    if _LICENSE_CACHE_SIZE <= 0:
+        return None
+    with _license_cache_lock:
+        item = _license_cache.get(key)
+        if item is None:
+            _license_cache_stats["misses"] += 1
+            return None
+        if item[0] <= time.monotonic():
+            _license_cache_drop(key)
+            _license_cache_stats["misses"] += 1
+            return None
+        _license_cache.move_to_end(key)
+        _license_cache_stats["hits"] += 1
+        return dict(item[1])
+
+
+def _license_cache_put(key, verdict: dict, epoch: int):
+    """Сохранить вердикт, если он окончательный и за время запроса код не менялся."""
+    if _LICENSE_CACHE_SIZE <= 0:
+        return
+    if not verdict.get("ok") and verdict.get("error") not in _LICENSE_CACHEABLE_ERRORS:
+        return
+    ttl = float(_LICENSE_CACHE_TTL)
+    if verdict.get("ok") and verdict.get("expires_ts") and not verdict.get("is_developer"):
+        # Не держим «ok» дольше срока лицензии
+        ttl = min(ttl, verdict["expires_ts"] - time.time())
+    if ttl <= 0:
+        return
+    with _license_cache_lock:
+        if epoch != _license_cache_epoch:
+            return
+        _license_cache_drop(key)
+        _license_cache[key] = (time.monotonic() + ttl, dict(verdict))
+        _license_cache_by_code.setdefault(key[0], set()).add(key)
+        while len(_license_cache) > _LICENSE_CACHE_SIZE:
+            old_key, _ = _license_cache.popitem(last=False)
+            _license_cache_unindex(old_key)
+            _license_cache_stats["evictions"] += 1
+
+
+def invalidate_license_cache(code: str | None = None):
+    """Сбросить вердикты кода (или все при code=None)."""
+    if code is None:
+        global _license_cache_epoch
+        with _license_cache_lock:
+            _license_cache_epoch += 1
+            _license_cache_stats["invalidations"] += 1
+            _license_cache.clear()
+            _license_cache_by_code.clear()
+        return
+    invalidate_license_cache_codes((code,))
+
+
+def invalidate_license_cache_codes(codes):
+    """Сбросить вердикты набора кодов одним сбросом (одна эпоха на всю пачку)."""
+    global _license_cache_epoch
+    with _license_cache_lock:
+        _license_cache_epoch += 1
+        _license_cache_stats["invalidations"] += 1
+        for code in codes:
+            for key in list(_license_cache_by_code.get(code, ())):
+                _license_cache_drop(key)
+
+
+def get_license_cache_stats() -> dict:
+    """Счётчики кэша вердиктов — для подбора LICENSE_CACHE_SIZE/TTL."""
+    with _license_cache_lock:
+        stats = dict(_license_cache_stats)
+        stats["size"] = len(_license_cache)
+    stats["max_size"] = _LICENSE_CACHE_SIZE
+    stats["ttl"] = _LICENSE_CACHE_TTL
+    total = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = round(stats["hits"] / total, 4) if total else 0.0
+    return stats
+
+
 def create_code(days: int, is_developer: bool = False) -> str:
     import secrets
     code = secrets.token_hex(8).upper()[:16]
@@ -571,11 +1254,74 @@ def create_code(days: int, is_developer: bool = False) -> str:
             "INSERT INTO codes (code, days, is_developer) VALUES (?, ?, ?)",
             (code, 0 if is_developer else days, 1 if is_developer else 0)
         )
+    invalidate_license_cache(code)  # мог быть закэширован как invalid_code
     return code
 
 
 def create_codes_batch(count: int, days: int = 0, is_developer: bool = False) -> list:
-    return [create_code(days, is_developer) for _ in range(count)]
+    return list(generate_codes_bulk(count, days, is_developer))
+
+
+# Кодов в одной пачке: один INSERT и одна транзакция. Потолок — лимит переменных SQLite (3 на строку)
+_BULK_CODES_CHUNK = max(1, min(int(os.environ.get("BULK_CODES_CHUNK", "1000")), 10000))
+_BULK_CODES_MAX_MISSES = 5
+
+
+def _insert_codes_chunk(cur, codes: list, days: int, is_developer: bool) -> list:
+    """Пачка кодов одним запросом; возвращает вставленные (уже занятые пропускаются)."""
+    rows = [(c, 0 if is_developer else days, 1 if is_developer else 0) for c in codes]
+    if _USE_PG:
+        inserted = cur.execute_values(
+            "INSERT INTO codes (code, days, is_developer) VALUES %s ON CONFLICT (code) DO NOTHING RETURNING code",
+            rows, page_size=len(rows), fetch=True,
+        )
+        return [r[0] for r in inserted]
+    cur.execute(
+        "INSERT OR IGNORE INTO codes (code, days, is_developer) VALUES " + ", ".join(["(?, ?, ?)"] * len(rows)) + " RETURNING code",
+        [v for r in rows for v in r],
+    )
+    return [r[0] for r in cur.fetchall()]
+
+
+def bulk_codes_chunk_size(chunk_size: int | None = None) -> int:
+    """Размер пачки /bulkcodes: chunk_size или BULK_CODES_CHUNK, в пределах 1..10000."""
+    return max(1, min(chunk_size or _BULK_CODES_CHUNK, 10000))
+
+
+def create_codes_chunk(count: int, days: int = 0, is_developer: bool = False) -> list:
+    """
+    Одна пачка из count новых кодов (не больше BULK_CODES_CHUNK за раз) в одной транзакции: коллизии
+    перевыпускаются в ней же. Кэш вердиктов сбрасывается один раз на пачку.
+    """
+    import secrets
+    codes, misses = [], 0
+    with get_db() as conn:
+        cur = conn.cursor()
+        while len(codes) < count:
+            batch = list({secrets.token_hex(8).upper() for _ in range(count - len(codes))})
+            inserted = _insert_codes_chunk(cur, batch, days, is_developer)
+            if not inserted:
+                misses += 1
+                if misses >= _BULK_CODES_MAX_MISSES:
+                    raise RuntimeError(f"create_codes_chunk: {misses} попыток подряд без новых кодов")
+                continue
+            misses = 0
+            codes.extend(inserted)
+    invalidate_license_cache_codes(codes)  # коды могли быть закэшированы как invalid_code
+    return codes
+
+
+def generate_codes_bulk(count: int, days: int = 0, is_developer: bool = False, chunk_size: int | None = None):
+    """
+    Генератор count уникальных кодов для больших партий: пачки по chunk_size (BULK_CODES_CHUNK) через
+    create_codes_chunk, каждая в своей транзакции. Коды отдаются по мере коммита пачек.
+    """
+    chunk_size = bulk_codes_chunk_size(chunk_size)
+    left = count
+    while left > 0:
+        inserted = create_codes_chunk(min(left, chunk_size), days, is_developer)
+        left -= len(inserted)
+        yield from inserted
 
 
 def get_code_by_value(code: str) -> dict | None:
@@ -612,7 +1358,7 @@ def clear_pending_code_assign(admin_id: int):
 
 def ensure_pending_user(username: str) -> None:
     """Создать запись в pending_users при выдаче кода (если ещё нет в users)."""
-    un = (username or "").strip().lstrip("@").lower()
+    un = _norm_username(username)
     if not un:
         return
     with get_db() as conn:
@@ -621,7 +1367,7 @@ def ensure_pending_user(username: str) -> None:
 
 
 def get_pending_user(username: str) -> dict | None:
-    un = (username or "").strip().lstrip("@").lower()
+    un = _norm_username(username)
     if not un:
         return None
     with get_db() as conn:
@@ -636,7 +1382,7 @@ def get_pending_user(username: str) -> dict | None:
 
 def set_pending_blocked(username: str, is_blocked: bool) -> bool:
     ensure_pending_user(username)
-    un = (username or "").strip().lstrip("@").lower()
+    un = _norm_username(username)
     with get_db() as conn:
         cur = conn.cursor()
         cur.execute("UPDATE pending_users SET is_blocked = ? WHERE username = ?", (1 if is_blocked else 0, un))
@@ -645,7 +1391,7 @@ def set_pending_blocked(username: str, is_blocked: bool) -> bool:
 
 def set_pending_partner(username: str, is_partner: bool) -> bool:
     ensure_pending_user(username)
-    un = (username or "").strip().lstrip("@").lower()
+    un = _norm_username(username)
     with get_db() as conn:
         cur = conn.cursor()
         cur.execute("UPDATE pending_users SET is_partner = ?, is_gift = 0 WHERE username = ?", (1 if is_partner else 0, un))
@@ -654,7 +1400,7 @@ def set_pending_partner(username: str, is_partner: bool) -> bool:
 
 def set_pending_gift(username: str, is_gift: bool) -> bool:
     ensure_pending_user(username)
-    un = (username or "").strip().lstrip("@").lower()
+    un = _norm_username(username)
     with get_db() as conn:
         cur = conn.cursor()
         cur.execute("UPDATE pending_users SET is_gift = ?, is_partner = 0 WHERE username = ?", (1 if is_gift else 0, un))
@@ -663,7 +1409,7 @@ def set_pending_gift(username: str, is_gift: bool) -> bool:
 
 def set_pending_discount(username: str, percent: float | None) -> bool:
     ensure_pending_user(username)
-    un = (username or "").strip().lstrip("@").lower()
+    un = _norm_username(username)
     with get_db() as conn:
         cur = conn.cursor()
         cur.execute("UPDATE pending_users SET custom_discount_pct = ? WHERE username = ?", (percent, un))
@@ -672,15 +1418,15 @@ def set_pending_discount(username: str, percent: float | None) -> bool:
 
 def merge_pending_to_user(telegram_id: int, username: str) -> None:
     """При первом заходе: скопировать pending → users, удалить pending."""
-    un = (username or "").strip().lstrip("@").lower()
+    un = _norm_username(username)
     if not un:
         return
     pend = get_pending_user(un)
     if pend:
         with get_db() as conn:
             cur = conn.cursor()
-            cur.execute("UPDATE users SET is_blocked = ?, is_partner = ?, is_gift = ?, custom_discount_pct = ? WHERE telegram_id = ?",
-                        (1 if pend["is_blocked"] else 0, 1 if pend["is_partner"] else 0, 1 if pend["is_gift"] else 0, pend.get("custom_discount_pct"), telegram_id))
+            cur.execute("UPDATE users SET is_blocked = ?, is_partner = ?, is_gift = ?, custom_discount_pct = ?, username_norm = COALESCE(NULLIF(username_norm, ''), ?) WHERE telegram_id = ?",
+                        (1 if pend["is_blocked"] else 0, 1 if pend["is_partner"] else 0, 1 if pend["is_gift"] else 0, pend.get("custom_discount_pct"), un, telegram_id))
             cur.execute("DELETE FROM pending_users WHERE username = ?", (un,))
 
 
@@ -693,7 +1439,9 @@ def set_code_assigned(code: str, username: str | None) -> bool:
         un = un.split("t.me/")[-1].split("/")[0].split("?")[0]
     with get_db() as conn:
         cur = conn.cursor()
-        cur.execute("UPDATE codes SET assigned_username = ? WHERE id = ?", (un if un else None, rec["id"]))
+        cur.execute("UPDATE codes SET assigned_username = ?, username_norm = ? WHERE id = ?",
+                    (un if un else None, _norm_username(un) or None, rec["id"]))
+        _refresh_code_status(cur, rec["id"])
     if un:
         ensure_pending_user(un)
     return True
@@ -706,7 +1454,9 @@ def delete_code(code: str) -> bool:
     with get_db() as conn:
         cur = conn.cursor()
         cur.execute("DELETE FROM activations WHERE code_id = ?", (rec["id"],))
+        cur.execute("UPDATE payments SET code_id = NULL WHERE code_id = ?", (rec["id"],))  # платёж остаётся, FK в PG не мешает
         cur.execute("DELETE FROM codes WHERE id = ?", (rec["id"],))
+    invalidate_license_cache(code)
     return True
 
 
@@ -716,74 +1466,196 @@ def delete_all_codes() -> int:
         cur.execute("SELECT COUNT(*) FROM codes")
         n = cur.fetchone()[0]
         cur.execute("DELETE FROM activations")
+        cur.execute("UPDATE payments SET code_id = NULL WHERE code_id IS NOT NULL")
         cur.execute("DELETE FROM codes")
-        return n
-
-
-def get_activation_by_code_and_hwid(code: str, hwid: str, installation_id: str | None = None) -> dict | None:
-    with get_db() as conn:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT a.id, a.expires_at, a.revoked, c.is_developer, a.installation_id
-            FROM activations a JOIN codes c ON c.id = a.code_id
-            WHERE c.code = ? AND a.hwid = ?
-        """, (code, hwid))
-        row = cur.fetchone()
-        if not row:
-            return None
-        act_installation_id = row[4] if len(row) > 4 else None
-        if act_installation_id and installation_id and act_installation_id != installation_id:
-            return None
-        return {"id": row[0], "expires_at": row[1], "revoked": bool(row[2]), "is_developer": bool(row[3])}
-
-
-def activate_code(code: str, hwid: str, installation_id: str | None = None, user_telegram_id: int | None = None) -> dict:
-    rec = get_code_by_value(code)
-    if not rec:
-        return {"ok": False, "error": "invalid_code"}
-    existing = get_activation_by_code_and_hwid(code, hwid, installation_id)
+    invalidate_license_cache()
+    return n
+
+
+# Код и все его активации одним запросом — вся логика /check на одном соединении
+# Последняя колонка — истёк ли срок (по expires_ts, в SQL); NULL — expires_ts не заполнен
+_LICENSE_EXPIRED_SQL = f"CASE WHEN a.expires_ts IS NULL THEN NULL WHEN a.expires_ts < {_NOW_TS_SQL} THEN 1 ELSE 0 END"
+_LICENSE_ROWS_SQL = _q(f"""
+    SELECT c.id, c.days, c.is_developer, a.hwid, a.installation_id, a.expires_at, a.revoked, a.expires_ts, {_LICENSE_EXPIRED_SQL}
+    FROM codes c LEFT JOIN activations a ON a.code_id = c.id
+    WHERE c.code = ?
+    ORDER BY a.id
+""")
+_ACTIVATION_INSERT_SQL = _q(
+    "INSERT INTO activations (code_id, hwid, installation_id, user_telegram_id, expires_at, expires_ts) VALUES (?, ?, ?, ?, ?, ?)"
+)
+
+_CODE_ACTIVE_SQL = _q("UPDATE codes SET status = 'active' WHERE id = ?")
+
+_LICENSE_ROWS_BATCH_SQL = f"""
+    SELECT c.code, c.id, c.days, c.is_developer, a.hwid, a.installation_id, a.expires_at, a.revoked, a.expires_ts, {_LICENSE_EXPIRED_SQL}
+    FROM codes c LEFT JOIN activations a ON a.code_id = c.id
+    WHERE c.code IN ({{marks}})
+    ORDER BY c.code, a.id
+"""
+
+
+def _resolve_license(rows: list, hwid: str, installation_id: str | None) -> tuple[dict, dict | None]:
+    """
+    Решение по строкам _LICENSE_ROWS_SQL. Возвращает (verdict, code_rec).
+    verdict.error == "not_activated" — активации нет и код свободен, можно вставлять.
+    """
+    if not rows:
+        return {"ok": False, "error": "invalid_code"}, None
+    rec = {"id": rows[0][0], "days": rows[0][1], "is_developer": bool(rows[0][2])}
+    acts = [r for r in rows if r[3] is not None]
+    existing = next((r for r in acts if r[3] == hwid), None)
+    if existing and existing[4] and installation_id and existing[4] != installation_id:
+        existing = None
     if existing:
-        if existing["revoked"]:
-            return {"ok": False, "error": "revoked"}
-        if not existing["is_developer"] and existing["expires_at"]:
-            from datetime import datetime
-            if datetime.fromisoformat(existing["expires_at"]) < datetime.utcnow():
-                return {"ok": False, "error": "expired"}
-        return {"ok": True, "expires_at": existing["expires_at"], "is_developer": existing["is_developer"]}
+        expires_at = existing[5]
+        if existing[6]:
+            return {"ok": False, "error": "revoked"}, rec
+        if rec["is_developer"] or not expires_at:
+            return {"ok": True, "expires_at": None, "expires_ts": None, "is_developer": rec["is_developer"]}, rec
+        expired, expires_ts = existing[8], existing[7]
+        if expired is None:
+            # expires_ts не заполнен (строку записала версия до expires_ts) — разбираем строку
+            expires_ts = _epoch(_to_datetime(expires_at))
+            expired = expires_ts < time.time()
+        if expired:
+            return {"ok": False, "error": "expired"}, rec
+        return {"ok": True, "expires_at": expires_at, "expires_ts": expires_ts, "is_developer": rec["is_developer"]}, rec
+    if any(not r[6] for r in acts):
+        return {"ok": False, "error": "code_already_used"}, rec
+    return {"ok": False, "error": "not_activated"}, rec
+
+
+def _new_expiry(rec: dict) -> tuple:
+    """(expires_at ISO, expires_ts) новой активации; для вечных кодов — (None, None)."""
+    if rec["is_developer"]:
+        return None, None
+    from datetime import datetime, timedelta
+    exp = datetime.utcnow() + timedelta(days=rec["days"])
+    return exp.isoformat(), _epoch(exp)
+
+
+def _activate_on_cursor(cur, code: str, rows: list, hwid: str, installation_id: str | None,
+                        user_telegram_id: int | None) -> tuple[dict, list | None]:
+    """
+    Решение + при необходимости INSERT на уже открытом курсоре.
+    Возвращает (verdict, new_rows): new_rows — строки кода после активации (None, если вставки не было).
+    """
+    verdict, rec = _resolve_license(rows, hwid, installation_id)
+    if verdict.get("error") != "not_activated":
+        return verdict, None
+    expires_at, expires_ts = _new_expiry(rec)
+    cur.execute("SAVEPOINT activate")
+    try:
+        cur.execute(_ACTIVATION_INSERT_SQL, (rec["id"], hwid, installation_id or None, user_telegram_id, expires_at, expires_ts))
+    except _integrity_errors():
+        # Параллельный запрос активировал код раньше (idx_activations_live_code) — решаем заново
+        cur.execute("ROLLBACK TO SAVEPOINT activate")
+        cur.execute(_LICENSE_ROWS_SQL, (code,))
+        verdict, _ = _resolve_license(cur.fetchall(), hwid, installation_id)
+        if verdict.get("error") == "not_activated":
+            verdict = {"ok": False, "error": "code_already_used"}
+        return verdict, None
+    # Статус — до RELEASE: на SQLite без внешней транзакции RELEASE сам коммитит, и статус остался бы за её пределами
+    cur.execute(_CODE_ACTIVE_SQL, (rec["id"],))
+    cur.execute("RELEASE SAVEPOINT activate")
+    new_row = (rec["id"], rec["days"], rec["is_developer"], hwid, installation_id or None, expires_at, 0, expires_ts, 0)
+    verdict = {"ok": True, "expires_at": expires_at, "expires_ts": expires_ts, "is_developer": rec["is_developer"]}
+    return verdict, [r for r in rows if r[3] is not None] + [new_row]
+
+
+def check_or_activate(code: str, hwid: str, installation_id: str | None = None, user_telegram_id: int | None = None) -> dict:
+    """
+    Проверка и при необходимости активация: один запрос на одном соединении + максимум один INSERT.
+    Ответ как у activate_code: ok/expires_at/is_developer или error.
+    """
+    key = _license_cache_key(code, hwid, installation_id)
+    cached = _license_cache_get(key)
+    if cached is not None:
+        return cached
+    epoch = _license_cache_epoch
     with get_db() as conn:
         cur = conn.cursor()
-        cur.execute("SELECT a.id FROM activations a JOIN codes c ON c.id = a.code_id WHERE c.code = ? AND a.revoked = 0", (code,))
-        if cur.fetchone():
-            return {"ok": False, "error": "code_already_used"}
-    from datetime import datetime, timedelta
-    now = datetime.utcnow()
-    expires_at = None if rec["is_developer"] else (now + timedelta(days=rec["days"])).isoformat()
+        cur.execute(_LICENSE_ROWS_SQL, (code,))
+        verdict, new_rows = _activate_on_cursor(cur, code, cur.fetchall(), hwid, installation_id, user_telegram_id)
+    if new_rows is not None:
+        invalidate_license_cache(code)
+        epoch = _license_cache_epoch
+    _license_cache_put(key, verdict, epoch)
+    return verdict
+
+
+CHECK_BATCH_MAX = int(os.environ.get("CHECK_BATCH_MAX", "100"))
+_BATCH_IN_CHUNK = 500  # не упираемся в лимит параметров SQLite
+
+
+def check_or_activate_batch(items: list) -> list:
+    """
+    Пакетный check_or_activate: items — [(code, hwid, installation_id), ...], ответы в том же порядке.
+    Коды читаются одним запросом WHERE code IN (...); активации — как в check_or_activate, по порядку items.
+    """
+    results: list = [None] * len(items)
+    pending = []  # (index, key)
+    for i, (code, hwid, installation_id) in enumerate(items):
+        key = _license_cache_key(code, hwid, installation_id)
+        cached = _license_cache_get(key)
+        if cached is not None:
+            results[i] = cached
+        else:
+            pending.append((i, key))
+    if not pending:
+        return results
+    epoch = _license_cache_epoch
+    codes = sorted({key[0] for _, key in pending})
+    activated = set()
     with get_db() as conn:
         cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO activations (code_id, hwid, installation_id, user_telegram_id, expires_at) VALUES (?, ?, ?, ?, ?)",
-            (rec["id"], hwid, installation_id or None, user_telegram_id, expires_at)
-        )
-    return {"ok": True, "expires_at": expires_at, "is_developer": rec["is_developer"]}
+        by_code: dict = {c: [] for c in codes}
+        for n in range(0, len(codes), _BATCH_IN_CHUNK):
+            chunk = codes[n:n + _BATCH_IN_CHUNK]
+            cur.execute(_LICENSE_ROWS_BATCH_SQL.format(marks=",".join("?" * len(chunk))), tuple(chunk))
+            for row in cur.fetchall():
+                by_code[row[0]].append(tuple(row[1:]))
+        for i, key in pending:
+            code, hwid, installation_id = key
+            verdict, new_rows = _activate_on_cursor(cur, code, by_code[code], hwid, installation_id, None)
+            if new_rows is not None:
+                by_code[code] = new_rows  # следующий элемент с тем же кодом видит эту активацию
+                activated.add(code)
+            results[i] = verdict
+    for code in activated:
+        invalidate_license_cache(code)
+    if activated:
+        epoch = _license_cache_epoch
+    for i, key in pending:
+        _license_cache_put(key, results[i], epoch)
+    return results
+
+
+def activate_code(code: str, hwid: str, installation_id: str | None = None, user_telegram_id: int | None = None) -> dict:
+    return check_or_activate(code, hwid, installation_id, user_telegram_id)
 
 
 def check_license(code: str, hwid: str, installation_id: str | None = None) -> dict:
-    rec = get_code_by_value(code)
-    if not rec:
-        return {"ok": False, "error": "invalid_code"}
-    act = get_activation_by_code_and_hwid(code, hwid, installation_id)
-    if not act:
+    """Проверка лицензии через кэш вердиктов (см. _license_cache_*)."""
+    key = _license_cache_key(code, hwid, installation_id)
+    cached = _license_cache_get(key)
+    if cached is not None:
+        return cached
+    epoch = _license_cache_epoch
+    result = _check_license_db(code, hwid, installation_id)
+    _license_cache_put(key, result, epoch)
+    return result
+
+
+def _check_license_db(code: str, hwid: str, installation_id: str | None = None) -> dict:
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(_LICENSE_ROWS_SQL, (code,))
+        verdict, _ = _resolve_license(cur.fetchall(), hwid, installation_id)
+    if verdict.get("error") == "code_already_used":
         return {"ok": False, "error": "not_activated"}
-    if act["revoked"]:
-        return {"ok": False, "error": "revoked"}
-    if act["is_developer"]:
-        return {"ok": True, "expires_at": None, "is_developer": True}
-    if not act["expires_at"]:
-        return {"ok": True, "expires_at": None, "is_developer": False}
-    from datetime import datetime
-    if datetime.fromisoformat(act["expires_at"]) < datetime.utcnow():
-        return {"ok": False, "error": "expired"}
-    return {"ok": True, "expires_at": act["expires_at"], "is_developer": False}
+    return verdict
 
 
 def revoke_code(code: str) -> bool:
@@ -793,9 +1665,32 @@ def revoke_code(code: str) -> bool:
     with get_db() as conn:
         cur = conn.cursor()
         cur.execute("UPDATE activations SET revoked = 1 WHERE code_id = ?", (rec["id"],))
+        _refresh_code_status(cur, rec["id"])
+        epoch = _bump_revocation_epoch(cur)
+    invalidate_license_cache(code)
+    _settings_cache["revocation_epoch"] = str(epoch[0])
+    _settings_cache["revocation_epoch_at"] = str(epoch[1])
     return True
 
 
+def _bump_revocation_epoch(cur) -> tuple[int, int]:
+    """+1 к эпохе отзывов (в транзакции отзыва). Возвращает (epoch, unix-время)."""
+    now = int(time.time())
+    cur.execute("UPDATE settings SET value = CAST(CAST(value AS INTEGER) + 1 AS TEXT), updated_at = CURRENT_TIMESTAMP WHERE key = 'revocation_epoch'")
+    cur.execute("SELECT value FROM settings WHERE key = 'revocation_epoch'")
+    row = cur.fetchone()
+    cur.execute("INSERT OR REPLACE INTO settings (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)", ("revocation_epoch_at", str(now)))
+    return int(row[0]) if row and row[0] else 0, now
+
+
+def get_revocation_epoch() -> tuple[int, int]:
+    """(эпоха отзывов, unix-время последнего отзыва) из кэша настроек."""
+    try:
+        return int(get_setting_cached("revocation_epoch", "0")), int(get_setting_cached("revocation_epoch_at", "0"))
+    except ValueError:
+        return 0, 0
+
+
 def get_code_activation_status(code: str) -> dict | None:
     rec = get_code_by_value(code)
     if not rec:
@@ -816,24 +1711,28 @@ def ensure_user(telegram_id: int, username: str | None = None, referred_by: int
     if referred_by:
         with get_db() as conn:
             cur = conn.cursor()
-            cur.execute("INSERT OR IGNORE INTO users (telegram_id, username, referred_by) VALUES (?, ?, ?)", (referred_by, "", None))
+            cur.execute("INSERT OR IGNORE INTO users (telegram_id, username, referred_by, username_norm) VALUES (?, ?, ?, ?)", (referred_by, "", None, ""))
     with get_db() as conn:
         cur = conn.cursor()
         cur.execute("SELECT telegram_id, referred_by, is_partner, custom_discount_pct FROM users WHERE telegram_id = ?", (telegram_id,))
         row = cur.fetchone()
         if row:
             if referred_by and not row[1]:
-                cur.execute("UPDATE users SET referred_by = ?, username = COALESCE(NULLIF(username,''), ?) WHERE telegram_id = ?", (referred_by, username or "", telegram_id))
+                cur.execute("UPDATE users SET referred_by = ?, username = COALESCE(NULLIF(username,''), ?), username_norm = COALESCE(NULLIF(username_norm,''), ?) WHERE telegram_id = ?",
+                            (referred_by, username or "", _norm_username(username), telegram_id))
                 cur.execute("INSERT OR IGNORE INTO referrals (referrer_id, referred_id) VALUES (?, ?)", (referred_by, telegram_id))
+                if cur.rowcount == 1:
+                    _referrer_stats_add(cur, referred_by, ref_count=1)
             elif username:
-                cur.execute("UPDATE users SET username = ? WHERE telegram_id = ?", (username, telegram_id))
+                cur.execute("UPDATE users SET username = ?, username_norm = ? WHERE telegram_id = ?", (username, _norm_username(username), telegram_id))
             return {"telegram_id": row[0], "referred_by": row[1], "is_partner": bool(row[2]), "custom_discount_pct": row[3]}
         cur.execute(
-            "INSERT INTO users (telegram_id, username, referred_by) VALUES (?, ?, ?)",
-            (telegram_id, username or "", referred_by if referred_by else None)
+            "INSERT INTO users (telegram_id, username, referred_by, username_norm) VALUES (?, ?, ?, ?)",
+            (telegram_id, username or "", referred_by if referred_by else None, _norm_username(username))
         )
         if referred_by:
             cur.execute("INSERT INTO referrals (referrer_id, referred_id) VALUES (?, ?)", (referred_by, telegram_id))
+            _referrer_stats_add(cur, referred_by, ref_count=1)
     return {"telegram_id": telegram_id, "referred_by": referred_by, "is_partner": False, "custom_discount_pct": None}
 
 
@@ -881,13 +1780,18 @@ def set_custom_discount(telegram_id: int, percent: float | None) -> bool:
 
 def get_user_by_username(username: str) -> dict | None:
     """Поиск по @username (без @)."""
-    un = (username or "").strip().lstrip("@").lower()
+    un = _norm_username(username)
     if not un:
         return None
     with get_db() as conn:
         cur = conn.cursor()
-        cur.execute("SELECT telegram_id, username, referred_by, is_partner, custom_discount_pct FROM users WHERE LOWER(REPLACE(username, '@', '')) = ?", (un,))
+        cur.execute("SELECT telegram_id, username, referred_by, is_partner, custom_discount_pct FROM users WHERE username_norm = ?", (un,))
         row = cur.fetchone()
+        if not row:
+            # Строка без username_norm (ещё не дозаполнена backfill_denormalized) — по индексу на IS NULL
+            cur.execute("SELECT telegram_id, username, referred_by, is_partner, custom_discount_pct FROM users WHERE username_norm IS NULL AND "
+                        + _USERNAME_NORM_SQL.format("COALESCE(username, '')") + " = ?", (un,))
+            row = cur.fetchone()
         if not row:
             return None
         return {"telegram_id": row[0], "username": row[1], "referred_by": row[2], "is_partner": bool(row[3]), "custom_discount_pct": row[4]}
@@ -944,7 +1848,7 @@ def get_user_status_label(telegram_id: int) -> str:
 
 
 def list_referrals(referrer_id: int) -> list:
-    with get_db() as conn:
+    with get_db(readonly=True) as conn:
         cur = conn.cursor()
         cur.execute("""
             SELECT r.referred_id, u.username, r.created_at
@@ -985,65 +1889,201 @@ def add_payment(user_telegram_id: int, amount_usd: float, plan_days: int, code_i
                 (user_telegram_id, amount_usd, plan_days, code_id, merchant_order_id, payment_system)
             )
             pid = cur.lastrowid
-        u = get_user(user_telegram_id)
-        if u and u.get("referred_by"):
-            referrer_id = u["referred_by"]
-            pct = get_referral_percent(referrer_id)
-            amount = round(amount_usd * pct / 100, 2)
-            if amount > 0:
-                cur.execute(
-                    "INSERT INTO referral_payouts (referrer_id, payment_id, amount_usd, percent) VALUES (?, ?, ?, ?)",
-                    (referrer_id, pid, amount, pct)
-                )
+        _referral_payout_on_cursor(cur, user_telegram_id, pid, amount_usd)
         conn.commit()
     return pid
 
 
-def get_referral_stats() -> list:
-    """Статистика по всем рефералам: кто сколько привёл, ставка, сколько должны."""
+_PAYMENT_INSERT_SQL = (
+    "INSERT INTO payments (user_telegram_id, amount_usd, plan_days, code_id, merchant_order_id, payment_system) VALUES (?, ?, ?, ?, ?, ?)"
+)
+# Вставка, если заказа ещё нет: выигравший вызов получает строку, повтор провайдера — ничего (idx_payments_order)
+_PAYMENT_INSERT_ORDER_SQL = _q(
+    _PAYMENT_INSERT_SQL + " ON CONFLICT (merchant_order_id) DO NOTHING RETURNING id" if _USE_PG
+    else _PAYMENT_INSERT_SQL.replace("INSERT INTO", "INSERT OR IGNORE INTO")
+)
+_REFERRER_SQL = _q("""
+    SELECT u.referred_by, r.is_partner, r.custom_discount_pct
+    FROM users u LEFT JOIN users r ON r.telegram_id = u.referred_by
+    WHERE u.telegram_id = ?
+""")
+
+
+def _referral_payout_on_cursor(cur, user_telegram_id: int, payment_id: int, amount_usd: float):
+    """Реферальная выплата по платежу в текущей транзакции (ставка — как get_referral_percent)."""
+    cur.execute(_REFERRER_SQL, (user_telegram_id,))
+    row = cur.fetchone()
+    if not row or not row[0]:
+        return
+    referrer_id, is_partner, custom_pct = row
+    pct = float(custom_pct) if custom_pct is not None else (20.0 if is_partner else 10.0)
+    amount = round(amount_usd * pct / 100, 2)
+    if amount > 0:
+        cur.execute("INSERT INTO referral_payouts (referrer_id, payment_id, amount_usd, percent) VALUES (?, ?, ?, ?)",
+                    (referrer_id, payment_id, amount, pct))
+        _referrer_stats_add(cur, referrer_id, pending_usd=amount)
+
+
+def record_paid_order(user_telegram_id: int, amount_usd: float, plan_days: int, merchant_order_id: str,
+                      payment_system: str) -> str | None:
+    """
+    Оплаченный заказ провайдера одной транзакцией: платёж (если заказа ещё нет) + новый код + реферальная выплата.
+    Возвращает код или None, если заказ уже записан (повтор webhook'а) — код тогда не создаётся.
+    """
+    import secrets
+    code = secrets.token_hex(8).upper()[:16]
     with get_db() as conn:
         cur = conn.cursor()
-        try:
-            cur.execute("""
-                SELECT u.telegram_id, u.username, u.is_partner, COALESCE(u.is_gift,0), u.custom_discount_pct,
-                       (SELECT COUNT(*) FROM referrals r WHERE r.referrer_id = u.telegram_id) as ref_count,
-                       (SELECT COALESCE(SUM(amount_usd), 0) FROM referral_payouts rp WHERE rp.referrer_id = u.telegram_id AND rp.status = 'pending') as pending
-                FROM users u
-                WHERE u.telegram_id IN (SELECT referrer_id FROM referrals)
-                ORDER BY ref_count DESC
-            """)
-        except (sqlite3.OperationalError, Exception):
-            cur.execute("""
-                SELECT u.telegram_id, u.username, u.is_partner, u.custom_discount_pct,
-                       (SELECT COUNT(*) FROM referrals r WHERE r.referrer_id = u.telegram_id) as ref_count,
-                       (SELECT COALESCE(SUM(amount_usd), 0) FROM referral_payouts rp WHERE rp.referrer_id = u.telegram_id AND rp.status = 'pending') as pending
-                FROM users u
-                WHERE u.telegram_id IN (SELECT referrer_id FROM referrals)
-                ORDER BY ref_count DESC
-            """)
+        cur.execute(_PAYMENT_INSERT_ORDER_SQL, (user_telegram_id, amount_usd, plan_days, None, merchant_order_id, payment_system))
+        if cur.rowcount != 1:
+            return None
+        pid = cur.lastrowid
+        cur.execute("INSERT INTO codes (code, days, is_developer) VALUES (?, ?, 0)", (code, plan_days))
+        cur.execute("UPDATE payments SET code_id = (SELECT id FROM codes WHERE code = ?) WHERE id = ?", (code, pid))
+        _referral_payout_on_cursor(cur, user_telegram_id, pid, amount_usd)
+    invalidate_license_cache(code)
+    return code
+
+
+# --- referrer_stats: агрегаты по рефереру, обновляются в тех же транзакциях, что referrals / referral_payouts ---
+
+_REFERRER_STATS_INIT_SQL = _q("INSERT OR IGNORE INTO referrer_stats (referrer_id) VALUES (?)")
+_REFERRER_STATS_ADD_SQL = _q("""
+    UPDATE referrer_stats
+    SET ref_count = ref_count + ?, pending_usd = pending_usd + ?, paid_usd = paid_usd + ?, updated_at = CURRENT_TIMESTAMP
+    WHERE referrer_id = ?
+""")
+# Колонка referrer_stats под статус выплаты (прочие статусы в агрегатах не учитываются)
+_PAYOUT_STATUS_COLUMN = {"pending": "pending_usd", "paid": "paid_usd"}
+
+
+def _referrer_stats_add(cur, referrer_id: int, ref_count: int = 0, pending_usd: float = 0.0, paid_usd: float = 0.0):
+    cur.execute(_REFERRER_STATS_INIT_SQL, (referrer_id,))
+    cur.execute(_REFERRER_STATS_ADD_SQL, (ref_count, pending_usd, paid_usd, referrer_id))
+
+
+def _rebuild_referrer_stats_on_cursor(cur) -> int:
+    cur.execute("DELETE FROM referrer_stats")
+    cur.execute("""
+        INSERT INTO referrer_stats (referrer_id, ref_count, pending_usd, paid_usd)
+        SELECT referrer_id, SUM(n), SUM(pending), SUM(paid) FROM (
+            SELECT referrer_id, 1 AS n, 0.0 AS pending, 0.0 AS paid FROM referrals
+            UNION ALL
+            SELECT referrer_id, 0, CASE WHEN status = 'pending' THEN amount_usd ELSE 0.0 END,
+                   CASE WHEN status = 'paid' THEN amount_usd ELSE 0.0 END
+            FROM referral_payouts
+        ) t
+        GROUP BY referrer_id
+    """)
+    return cur.rowcount
+
+
+def rebuild_referrer_stats() -> int:
+    """Пересчитать referrer_stats с нуля из referrals и referral_payouts. Возвращает число рефереров."""
+    with get_db() as conn:
+        return _rebuild_referrer_stats_on_cursor(conn.cursor())
+
+
+def backfill_denormalized() -> dict:
+    """
+    Дозаполнить username_norm, expires_ts и codes.status у строк, записанных в обход текущей версии (миграции
+    выполняются один раз, а прежний инстанс ещё пишет во время деплоя). Только WHERE ... IS NULL и явные расхождения.
+    """
+    with get_db() as conn:
+        cur = conn.cursor()
+        result = {"username_norm": _backfill_username_norm(cur), "expires_ts": _backfill_expires_ts(cur)}
+        cur.execute(f"UPDATE codes SET status = {_CODE_STATUS_EXPR} WHERE {_CODE_STATUS_DRIFT_SQL}")
+        result["code_status"] = max(cur.rowcount, 0)
+        return result
+
+
+def mark_expired_codes() -> int:
+    """active → expired для кодов, у которых живая активация истекла (expires_ts). Возвращает число кодов."""
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            UPDATE codes SET status = 'expired'
+            WHERE status = 'active' AND id IN (
+                SELECT code_id FROM activations WHERE revoked = 0 AND expires_ts < {_NOW_TS_SQL}
+            )
+        """)
+        return cur.rowcount
+
+
+def check_code_status(fix: bool = False) -> dict:
+    """Сверить codes.status с activations. fix=True — исправить расхождения. {"checked", "mismatched", "by_status"}."""
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT status, {_CODE_STATUS_EXPR} AS actual FROM codes")
+        checked, by_status = 0, {}
+        for status, actual in cur.fetchall():
+            checked += 1
+            if status != actual:
+                key = f"{status}→{actual}"
+                by_status[key] = by_status.get(key, 0) + 1
+        if fix and by_status:
+            cur.execute(f"UPDATE codes SET status = {_CODE_STATUS_EXPR} WHERE status != {_CODE_STATUS_EXPR}")
+        return {"checked": checked, "mismatched": sum(by_status.values()), "by_status": by_status}
+
+
+def set_payout_status(payout_id: int, status: str) -> bool:
+    """Сменить статус реферальной выплаты (pending/paid/cancelled) и перенести сумму в referrer_stats."""
+    if status not in ("pending", "paid", "cancelled"):
+        raise ValueError(f"unknown payout status: {status}")
+    from datetime import datetime
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT referrer_id, amount_usd, status FROM referral_payouts WHERE id = ?", (payout_id,))
+        row = cur.fetchone()
+        if not row:
+            return False
+        referrer_id, amount, old = row
+        if old == status:
+            return True
+        # Условие на старый статус — параллельная смена не посчитается дважды
+        cur.execute("UPDATE referral_payouts SET status = ?, paid_at = ? WHERE id = ? AND status = ?",
+                    (status, datetime.utcnow().isoformat() if status == "paid" else None, payout_id, old))
+        if cur.rowcount != 1:
+            return False
+        delta = {"pending_usd": 0.0, "paid_usd": 0.0}
+        if old in _PAYOUT_STATUS_COLUMN:
+            delta[_PAYOUT_STATUS_COLUMN[old]] -= amount
+        if status in _PAYOUT_STATUS_COLUMN:
+            delta[_PAYOUT_STATUS_COLUMN[status]] += amount
+        _referrer_stats_add(cur, referrer_id, **delta)
+    return True
+
+
+def get_referral_stats() -> list:
+    """Статистика по всем рефералам: кто сколько привёл, ставка, сколько должны (из referrer_stats)."""
+    with get_db(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT s.referrer_id, u.username, COALESCE(u.is_partner,0), COALESCE(u.is_gift,0), u.custom_discount_pct,
+                   s.ref_count, s.pending_usd, s.paid_usd
+            FROM referrer_stats s LEFT JOIN users u ON u.telegram_id = s.referrer_id
+            WHERE s.ref_count > 0
+            ORDER BY s.ref_count DESC
+        """)
         rows = cur.fetchall()
-    result = []
-    n_cols = len(rows[0]) if rows else 0
-    for r in rows:
-        if n_cols >= 7:
-            pct = r[4] if r[4] is not None else (20.0 if r[2] else 10.0)
-            result.append({
-                "telegram_id": r[0], "username": r[1], "is_partner": bool(r[2]), "is_gift": bool(r[3]),
-                "custom_discount_pct": r[4], "ref_count": r[5], "pending_usd": round(float(r[6] or 0), 2),
-                "percent": pct
-            })
-        else:
-            pct = r[3] if r[3] is not None else (20.0 if r[2] else 10.0)
-            result.append({
-                "telegram_id": r[0], "username": r[1], "is_partner": bool(r[2]), "is_gift": False,
-                "custom_discount_pct": r[3], "ref_count": r[4], "pending_usd": round(float(r[5] or 0), 2),
-                "percent": pct
-            })
-    return result
+    return [{
+        "telegram_id": r[0], "username": r[1], "is_partner": bool(r[2]), "is_gift": bool(r[3]),
+        "custom_discount_pct": r[4], "ref_count": r[5], "pending_usd": round(float(r[6] or 0), 2),
+        "paid_usd": round(float(r[7] or 0), 2),
+        "percent": r[4] if r[4] is not None else (20.0 if r[2] else 10.0),
+    } for r in rows]
+
+
+def list_referrer_ids() -> list:
+    """telegram_id всех, кто кого-то привёл (рассылка «Рефералам»)."""
+    with get_db(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT referrer_id FROM referrer_stats WHERE ref_count > 0")
+        return [r[0] for r in cur.fetchall()]
 
 
 def get_user_payouts(telegram_id: int) -> list:
-    with get_db() as conn:
+    with get_db(readonly=True) as conn:
         cur = conn.cursor()
         cur.execute("""
             SELECT rp.id, rp.amount_usd, rp.percent, rp.status, rp.created_at, p.plan_days
@@ -1057,14 +2097,14 @@ def get_user_payouts(telegram_id: int) -> list:
 
 
 def get_user_total_pending(telegram_id: int) -> float:
-    with get_db() as conn:
+    with get_db(readonly=True) as conn:
         cur = conn.cursor()
         cur.execute("SELECT COALESCE(SUM(amount_usd), 0) FROM referral_payouts WHERE referrer_id = ? AND status = 'pending'", (telegram_id,))
         return round(float(cur.fetchone()[0] or 0), 2)
 
 
 def list_all_users() -> list:
-    with get_db() as conn:
+    with get_db(readonly=True) as conn:
         cur = conn.cursor()
         try:
             cur.execute("SELECT telegram_id, username, referred_by, is_partner, COALESCE(is_gift,0), COALESCE(is_blocked,0), first_seen FROM users ORDER BY first_seen DESC")
@@ -1074,79 +2114,143 @@ def list_all_users() -> list:
         return [{"telegram_id": r[0], "username": r[1], "referred_by": r[2], "is_partner": bool(r[3]), "is_gift": bool(r[4]) if len(r) > 4 else False, "is_blocked": bool(r[5]) if len(r) > 5 else False, "first_seen": r[6] if len(r) > 6 else None} for r in cur.fetchall()]
 
 
+# Юзернеймы с привязанными кодами без активной активации, которых ещё нет в users
+_ASSIGNED_ONLY_SQL = """
+    SELECT DISTINCT c.username_norm
+    FROM codes c
+    WHERE c.status = 'assigned'
+    AND NOT EXISTS (SELECT 1 FROM users u WHERE u.username_norm = c.username_norm)
+"""
+
+
 def list_assigned_usernames_not_in_users() -> list:
     """Юзернеймы с привязанными кодами, которых ещё нет в users."""
-    with get_db() as conn:
+    with get_db(readonly=True) as conn:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT DISTINCT LOWER(REPLACE(COALESCE(c.assigned_username,''), '@', ''))
-            FROM codes c
-            WHERE c.assigned_username IS NOT NULL AND c.assigned_username != ''
-            AND NOT EXISTS (SELECT 1 FROM activations a WHERE a.code_id = c.id AND a.revoked = 0)
-            AND NOT EXISTS (SELECT 1 FROM users u WHERE LOWER(REPLACE(COALESCE(u.username,''), '@', '')) = LOWER(REPLACE(c.assigned_username, '@', '')))
-        """)
+        cur.execute(_ASSIGNED_ONLY_SQL)
         return [r[0] for r in cur.fetchall() if r[0]]
 
 
-def list_clients_with_extended(sort_by: str = "date") -> list:
-    """Все клиенты: из users + assigned (ещё не заходили). sort_by: date|name|status."""
-    users = list_all_users()
-    assigned = list_assigned_usernames_not_in_users()
-    seen = {str(u.get("username") or "").lower().lstrip("@") for u in users if u.get("username")}
-    for un in assigned:
-        if un and un not in seen:
-            users.append({"telegram_id": 0, "username": un, "referred_by": None, "is_partner": False, "is_gift": False, "is_blocked": False, "first_seen": None, "_assigned_only": True})
-    if sort_by == "name":
-        users.sort(key=lambda u: (u.get("username") or str(u["telegram_id"])).lower())
-    elif sort_by == "status":
-        def _st(u):
-            if u.get("is_blocked"): return 0
-            if u.get("is_partner"): return 1
-            if u.get("is_gift"): return 2
-            return 3
-        users.sort(key=_st)
-    else:
-        users.sort(key=lambda u: str(u.get("first_seen") or ""), reverse=True)
-    return users
+# Клиенты: users + ещё не заходившие (только привязанный код, telegram_id = 0)
+_CLIENTS_SQL = f"""
+    WITH clients AS (
+        SELECT telegram_id, username, username_norm, COALESCE(is_partner, 0) AS is_partner,
+               COALESCE(is_gift, 0) AS is_gift, COALESCE(is_blocked, 0) AS is_blocked, first_seen
+        FROM users
+        UNION ALL
+        SELECT 0, username_norm, username_norm, 0, 0, 0, NULL FROM ({_ASSIGNED_ONLY_SQL}) assigned
+    )
+"""
+_CLIENTS_ORDER = {
+    "date": "first_seen IS NULL, first_seen DESC, telegram_id DESC",
+    "name": "LOWER(COALESCE(username, CAST(telegram_id AS TEXT))), telegram_id",
+    "status": "CASE WHEN is_blocked = 1 THEN 0 WHEN is_partner = 1 THEN 1 WHEN is_gift = 1 THEN 2 ELSE 3 END, "
+              "first_seen IS NULL, first_seen DESC, telegram_id DESC",
+}
+
+
+def list_clients_page(page: int = 0, limit: int = 10, sort_by: str = "date", search: str = "") -> dict:
+    """
+    Страница списка клиентов: сортировка (date|name|status), поиск по части @username или точному ID,
+    счётчики по статусам — всё в SQL, в Python приходит только одна страница.
+    Возвращает {"rows", "total", "page", "clients", "partners", "gifts", "paid"}; page — приведённый в диапазон номер.
+    """
+    where, params = "", ()
+    term = search.strip().lstrip("@")
+    if term:
+        where = " WHERE username_norm LIKE ? ESCAPE '\\' OR CAST(telegram_id AS TEXT) = ?"
+        params = ("%" + _like_escape(_norm_username(term)) + "%", term)
+    with get_db(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(f"{_CLIENTS_SQL} SELECT is_partner, is_gift, COUNT(*) FROM clients{where} GROUP BY is_partner, is_gift", params)
+        groups = cur.fetchall()
+        total = sum(n for _, _, n in groups)
+        page = max(0, min(page, (max(total, 1) - 1) // limit)) if limit > 0 else 0
+        cur.execute(f"""
+            {_CLIENTS_SQL}
+            SELECT telegram_id, username, is_partner, is_gift, is_blocked, first_seen,
+                   CASE WHEN telegram_id != 0 AND EXISTS (SELECT 1 FROM payments p WHERE p.user_telegram_id = clients.telegram_id)
+                        THEN 1 ELSE 0 END
+            FROM clients{where}
+            ORDER BY {_CLIENTS_ORDER.get(sort_by, _CLIENTS_ORDER["date"])}
+            LIMIT ? OFFSET ?
+        """, params + (limit, page * limit))
+        rows = cur.fetchall()
+        cur.execute("SELECT COUNT(DISTINCT user_telegram_id) FROM payments")
+        paid = cur.fetchone()[0]
+    return {
+        "rows": [{
+            "telegram_id": r[0], "username": r[1], "is_partner": bool(r[2]), "is_gift": bool(r[3]), "is_blocked": bool(r[4]),
+            "first_seen": r[5], "paid": bool(r[6]), "_assigned_only": r[0] == 0,
+        } for r in rows],
+        "total": total,
+        "page": page,
+        "clients": sum(n for p, g, n in groups if not p and not g),
+        "partners": sum(n for p, _, n in groups if p),
+        "gifts": sum(n for _, g, n in groups if g),
+        "paid": paid,
+    }
 
 
 def get_client_full_info(telegram_id: int, username: str | None = None) -> dict | None:
-    """Полная информация о клиенте."""
+    """Полная информация о клиенте: профиль, рефералы (referrer_stats), реферер и подписка — одним запросом."""
     if telegram_id == 0 and username:
         return _get_client_info_assigned_only(username)
-    u = get_user(telegram_id)
-    if not u:
+    with get_db(readonly=True) as conn:
+        cur = conn.cursor()
+        # Подписка как в get_user_subscription_info: последняя живая активация, иначе последний выданный код
+        cur.execute(f"""
+            SELECT u.telegram_id, u.username, u.referred_by, u.is_partner, u.custom_discount_pct, u.first_seen,
+                   COALESCE(u.is_gift, 0), COALESCE(u.is_blocked, 0),
+                   COALESCE(rs.ref_count, 0), COALESCE(rs.pending_usd, 0), ru.telegram_id, ru.username,
+                   ca.code, ca.days, ca.is_developer, a.expires_at, a.revoked, {_DAYS_LEFT_SQL},
+                   cs.code, cs.days, cs.is_developer
+            FROM users u
+            LEFT JOIN referrer_stats rs ON rs.referrer_id = u.telegram_id
+            LEFT JOIN users ru ON ru.telegram_id = u.referred_by
+            LEFT JOIN activations a ON a.id = (
+                SELECT a2.id FROM activations a2
+                WHERE a2.user_telegram_id = u.telegram_id AND a2.revoked = 0
+                ORDER BY a2.activated_at DESC LIMIT 1
+            )
+            LEFT JOIN codes ca ON ca.id = a.code_id
+            LEFT JOIN codes cs ON a.id IS NULL AND cs.id = (
+                SELECT c2.id FROM codes c2
+                WHERE c2.username_norm = u.username_norm AND c2.status = 'assigned'
+                ORDER BY c2.id DESC LIMIT 1
+            )
+            WHERE u.telegram_id = ?
+        """, (telegram_id,))
+        r = cur.fetchone()
+    if not r:
         return None
-    sub = get_user_subscription_info(telegram_id, u.get("username"))
-    ref_count = len(list_referrals(telegram_id))
-    pending = get_user_total_pending(telegram_id)
-    pct = get_referral_percent(telegram_id)
-    referrer = None
-    if u.get("referred_by"):
-        ref_u = get_user(u["referred_by"])
-        if ref_u:
-            referrer = f"@{ref_u.get('username') or ref_u['telegram_id']}"
-    days_left = None
-    if sub:
+    sub, days_left = None, None
+    if r[12] is not None:
+        sub = {"code": r[12], "days": r[13], "is_developer": bool(r[14]), "expires_at": r[15], "revoked": bool(r[16]),
+               "days_left": int(r[17]) if r[17] is not None else None, "status": "activated"}
         if sub["is_developer"]:
             days_left = "∞"
-        elif sub["expires_at"]:
-            from datetime import datetime
-            exp = _to_datetime(sub["expires_at"])
-            days_left = max(0, (exp - datetime.utcnow()).days) if exp else None
+        elif sub["expires_at"] and r[17] is not None:
+            days_left = int(r[17])
+    elif r[18] is not None:
+        sub = {"code": r[18], "days": r[19], "is_developer": bool(r[20]), "expires_at": None, "revoked": False,
+               "days_left": None, "status": "assigned"}
+        if sub["is_developer"]:
+            days_left = "∞"
+    is_partner = bool(r[3])
     return {
-        "telegram_id": u["telegram_id"],
-        "username": u.get("username") or "",
-        "referred_by": u.get("referred_by"),
-        "referrer": referrer,
-        "is_partner": u.get("is_partner", False),
-        "is_gift": u.get("is_gift", False),
-        "is_blocked": u.get("is_blocked", False),
-        "custom_discount_pct": u.get("custom_discount_pct"),
-        "first_seen": u.get("first_seen"),
-        "ref_count": ref_count,
-        "pending_usd": pending,
-        "percent": pct,
+        "telegram_id": r[0],
+        "username": r[1] or "",
+        "referred_by": r[2],
+        "referrer": f"@{r[11] or r[10]}" if r[10] is not None else None,
+        "is_partner": is_partner,
+        "is_gift": bool(r[6]),
+        "is_blocked": bool(r[7]),
+        "custom_discount_pct": r[4],
+        "first_seen": r[5],
+        "ref_count": int(r[8]),
+        "pending_usd": round(float(r[9]), 2),
+        "percent": float(r[4]) if r[4] is not None else (20.0 if is_partner else 10.0),
         "subscription": sub,
         "days_left": days_left,
         "_assigned_only": False,
@@ -1196,7 +2300,7 @@ def _get_client_info_assigned_only(username: str) -> dict:
 
 
 def list_paid_users() -> list:
-    with get_db() as conn:
+    with get_db(readonly=True) as conn:
         cur = conn.cursor()
         cur.execute("SELECT DISTINCT user_telegram_id FROM payments")
         return [r[0] for r in cur.fetchall()]
@@ -1204,7 +2308,7 @@ def list_paid_users() -> list:
 
 def list_recent_payments(limit: int = 30) -> list:
     """Последние платежи для админ-логов (user_id, amount, days, system, order_id, created)."""
-    with get_db() as conn:
+    with get_db(readonly=True) as conn:
         cur = conn.cursor()
         cur.execute("""
             SELECT user_telegram_id, amount_usd, plan_days, payment_system, merchant_order_id, created_at
@@ -1258,14 +2362,13 @@ def set_setting(key: str, value: str):
 
 
 def get_free_codes(limit: int = 20) -> list:
-    """Коды без привязки (assigned_username пуст), свободные для выдачи."""
+    """Коды без привязки и живой активации, свободные для выдачи (по codes.status, индекс idx_codes_status)."""
     with get_db() as conn:
         cur = conn.cursor()
         cur.execute("""
             SELECT c.code, c.days, c.is_developer
             FROM codes c
-            WHERE (c.assigned_username IS NULL OR c.assigned_username = '')
-            AND NOT EXISTS (SELECT 1 FROM activations a WHERE a.code_id = c.id AND a.revoked = 0)
+            WHERE c.status IN ('free', 'revoked')
             ORDER BY c.id DESC
             LIMIT ?
         """, (limit,))
@@ -1274,36 +2377,108 @@ def get_free_codes(limit: int = 20) -> list:
 
 def get_user_subscription_info(user_id: int, username: str | None = None) -> dict | None:
     """Информация о подписке: код (присвоенный или активированный), срок, статус."""
-    un = (username or "").strip().lstrip("@").lower()
-    with get_db() as conn:
+    un = _norm_username(username)
+    with get_db(readonly=True) as conn:
         cur = conn.cursor()
         # Сначала ищем по активации (user_telegram_id)
-        cur.execute("""
-            SELECT c.code, c.days, c.is_developer, a.expires_at, a.revoked
+        cur.execute(f"""
+            SELECT c.code, c.days, c.is_developer, a.expires_at, a.revoked, {_DAYS_LEFT_SQL}
             FROM activations a JOIN codes c ON c.id = a.code_id
             WHERE a.user_telegram_id = ? AND a.revoked = 0
             ORDER BY a.activated_at DESC LIMIT 1
         """, (user_id,))
         row = cur.fetchone()
         if row:
-            return {"code": row[0], "days": row[1], "is_developer": bool(row[2]), "expires_at": row[3], "revoked": bool(row[4]), "status": "activated"}
+            return {"code": row[0], "days": row[1], "is_developer": bool(row[2]), "expires_at": row[3], "revoked": bool(row[4]),
+                    "days_left": int(row[5]) if row[5] is not None else None, "status": "activated"}
         # Иначе — по assigned_username (код выдан, но не активирован)
         if un:
             cur.execute("""
                 SELECT c.code, c.days, c.is_developer
                 FROM codes c
-                WHERE LOWER(REPLACE(COALESCE(c.assigned_username,''), '@', '')) = ?
-                AND NOT EXISTS (SELECT 1 FROM activations a WHERE a.code_id = c.id AND a.revoked = 0)
+                WHERE c.username_norm = ? AND c.status = 'assigned'
                 ORDER BY c.id DESC LIMIT 1
             """, (un,))
             row = cur.fetchone()
             if row:
-                return {"code": row[0], "days": row[1], "is_developer": bool(row[2]), "expires_at": None, "revoked": False, "status": "assigned"}
+                return {"code": row[0], "days": row[1], "is_developer": bool(row[2]), "expires_at": None, "revoked": False,
+                        "days_left": None, "status": "assigned"}
     return None
 
 
+_CODE_STATUS_SQL = {
+    "free": "a.id IS NULL",
+    "active": "a.id IS NOT NULL AND a.revoked = 0",
+    "revoked": "a.revoked = 1",
+    "expiring": f"a.revoked = 0 AND a.expires_ts BETWEEN {_NOW_TS_SQL} AND {_NOW_TS_SQL} + 7 * 86400",
+}
+
+
+def _like_escape(text: str) -> str:
+    """Экранирование для LIKE ... ESCAPE '\\'."""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def list_codes_page(cursor: str | None = None, limit: int = 10, search: str = "", status: str | None = None) -> dict:
+    """
+    Страница списка кодов (новые сверху) по ключу id, фильтры и сортировка — в SQL.
+    cursor: None — первая страница, "n<id>" — следующая после id, "p<id>" — предыдущая перед id.
+    search — часть @username (assigned_username), status — free|active|revoked|expiring (≤ 7 дней).
+    Возвращает {"rows", "total", "next", "prev"}; next/prev — курсоры соседних страниц или None.
+    """
+    where, params = [], []
+    un = _norm_username(search)
+    if un:
+        where.append("c.username_norm LIKE ? ESCAPE '\\'")
+        params.append("%" + _like_escape(un) + "%")
+    if status in _CODE_STATUS_SQL:
+        where.append(_CODE_STATUS_SQL[status])
+    # Последняя активация кода — через idx_activations_code, без размножения строк
+    base = """
+        FROM codes c
+        LEFT JOIN activations a ON a.id = (SELECT MAX(a2.id) FROM activations a2 WHERE a2.code_id = c.id)
+    """
+    filters = (" WHERE " + " AND ".join(where)) if where else ""
+    backward = bool(cursor) and cursor[0] == "p"
+    key_params = list(params)
+    key_filter = filters
+    if cursor and cursor[1:].isdigit():
+        key_filter += (" AND " if filters else " WHERE ") + ("c.id > ?" if backward else "c.id < ?")
+        key_params.append(int(cursor[1:]))
+    with get_db(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT COUNT(*) {base}{filters}" if where else "SELECT COUNT(*) FROM codes", tuple(params))
+        total = cur.fetchone()[0]
+        cur.execute(f"""
+            SELECT c.id, c.code, c.days, c.is_developer, c.assigned_username, c.created_at,
+                   a.hwid, a.user_telegram_id, a.activated_at, a.expires_at, a.revoked,
+                   {_DAYS_LEFT_SQL}
+            {base}{key_filter}
+            ORDER BY c.id {"ASC" if backward else "DESC"}
+            LIMIT ?
+        """, tuple(key_params) + (limit + 1,))
+        rows = cur.fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    result = [{
+        "id": r[0], "code": r[1], "days": r[2], "is_developer": bool(r[3]), "assigned_username": r[4], "created_at": r[5],
+        "hwid": r[6], "user_telegram_id": r[7], "activated_at": r[8], "expires_at": r[9],
+        "revoked": bool(r[10]) if r[10] is not None else False,
+        "days_left": None if r[3] or r[9] is None or r[11] is None else int(r[11]),
+    } for r in rows]
+    has_newer = (more if backward else bool(cursor)) and bool(result)
+    has_older = (True if backward else more) and bool(result)
+    return {
+        "rows": result, "total": total,
+        "next": f"n{result[-1]['id']}" if has_older else None,
+        "prev": f"p{result[0]['id']}" if has_newer else None,
+    }
+
+
 def list_codes_and_activations() -> list:
-    with get_db() as conn:
+    with get_db(readonly=True) as conn:
         cur = conn.cursor()
         cur.execute("""
             SELECT c.code, c.days, c.is_developer, c.assigned_username, c.created_at,
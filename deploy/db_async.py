@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Асинхронный бэкенд БД для горячих HTTP-путей (/check, /health, webhooks оплаты).
+asyncpg для PostgreSQL, aiosqlite для SQLite. Включается DB_ASYNC=1 — иначе всё идёт через db.py в пуле потоков.
+Логика вердиктов и кэш общие с db.py.
+"""
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+import db
+
+ENABLED = db.DB_ASYNC
+
+_pg_pool = None
+_sqlite_conns: asyncio.Queue | None = None
+_init_lock: asyncio.Lock | None = None
+_pg_sql_cache: dict = {}
+
+
+def _pg_sql(sql: str) -> str:
+    """SQL из реестра db (ON CONFLICT и т.п.), плейсхолдеры %s → $1, $2… (asyncpg)."""
+    out = _pg_sql_cache.get(sql)
+    if out is None:
+        parts = db._compile_sql(sql)[0].split("%s")
+        out = parts[0] + "".join(f"${i}{p}" for i, p in enumerate(parts[1:], 1))
+        _pg_sql_cache[sql] = out
+    return out
+
+
+async def _ensure_pool():
+    global _pg_pool, _sqlite_conns, _init_lock
+    if _pg_pool is not None or _sqlite_conns is not None:
+        return
+    if _init_lock is None:
+        _init_lock = asyncio.Lock()
+    async with _init_lock:
+        if _pg_pool is not None or _sqlite_conns is not None:
+            return
+        if db._USE_PG:
+            import asyncpg
+            size = db.pg_pool_sizes()["async"]  # доля общего бюджета соединений, остальное — у пулов db.py
+            _pg_pool = await asyncpg.create_pool(db._DATABASE_URL, min_size=min(2, size), max_size=size, timeout=15,
+                                                 max_inactive_connection_lifetime=db._PG_CONN_MAX_IDLE)
+        else:
+            import aiosqlite
+            q = asyncio.Queue()
+            for _ in range(int(os.environ.get("DB_ASYNC_SQLITE_CONNS", "4"))):
+                conn = await aiosqlite.connect(db.DB_PATH, timeout=db._SQLITE_BUSY_TIMEOUT_MS / 1000)
+                for pragma in db._SQLITE_PRAGMAS:
+                    await conn.execute(pragma)
+                q.put_nowait(conn)
+            _sqlite_conns = q
+
+
+@asynccontextmanager
+async def _transaction():
+    """Соединение в транзакции: commit при успехе, rollback при ошибке."""
+    await _ensure_pool()
+    if db._USE_PG:
+        async with _pg_pool.acquire() as conn:
+            async with conn.transaction():
+                yield conn
+        return
+    conn = await _sqlite_conns.get()
+    try:
+        yield conn
+        await conn.commit()
+    except BaseException:
+        try:
+            await conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        _sqlite_conns.put_nowait(conn)
+
+
+async def _fetchall(conn, sql: str, *params) -> list:
+    if db._USE_PG:
+        return [tuple(r) for r in await conn.fetch(_pg_sql(sql), *params)]
+    async with conn.execute(sql, params) as cur:
+        return list(await cur.fetchall())
+
+
+async def _execute(conn, sql: str, *params):
+    if db._USE_PG:
+        db.note_session_write()
+        await conn.execute(_pg_sql(sql), *params)
+    else:
+        await conn.execute(sql, params)
+
+
+async def _insert_id(conn, sql: str, *params) -> int:
+    """INSERT с возвратом id новой строки."""
+    if db._USE_PG:
+        db.note_session_write()
+        return await conn.fetchval(_pg_sql(sql) + " RETURNING id", *params)
+    async with conn.execute(sql, params) as cur:
+        return cur.lastrowid
+
+
+async def _try_insert(conn, sql: str, *params, then: tuple = ()) -> bool:
+    """
+    INSERT в savepoint. False — нарушена уникальность, транзакция цела.
+    then — (sql, params) после успешной вставки в том же savepoint: на SQLite без внешней транзакции RELEASE коммитит.
+    """
+    if db._USE_PG:
+        import asyncpg
+        db.note_session_write()
+        try:
+            async with conn.transaction():
+                await conn.execute(_pg_sql(sql), *params)
+                for then_sql, then_params in then:
+                    await conn.execute(_pg_sql(then_sql), *then_params)
+        except asyncpg.UniqueViolationError:
+            return False
+        return True
+    import sqlite3
+    await conn.execute("SAVEPOINT activate")
+    try:
+        await conn.execute(sql, params)
+    except sqlite3.IntegrityError:
+        await conn.execute("ROLLBACK TO SAVEPOINT activate")
+        return False
+    for then_sql, then_params in then:
+        await conn.execute(then_sql, then_params)
+    await conn.execute("RELEASE SAVEPOINT activate")
+    return True
+
+
+async def check_or_activate(code: str, hwid: str, installation_id: str | None = None, user_telegram_id: int | None = None) -> dict:
+    """Асинхронный аналог db.check_or_activate (тот же кэш и та же логика вердикта)."""
+    key = db._license_cache_key(code, hwid, installation_id)
+    cached = db._license_cache_get(key)
+    if cached is not None:
+        return cached
+    epoch = db._license_cache_epoch
+    inserted = False
+    async with _transaction() as conn:
+        verdict, rec = db._resolve_license(await _fetchall(conn, db._LICENSE_ROWS_SQL, code), hwid, installation_id)
+        if verdict.get("error") == "not_activated":
+            expires_at, expires_ts = db._new_expiry(rec)
+            if await _try_insert(conn, db._ACTIVATION_INSERT_SQL, rec["id"], hwid, installation_id or None, user_telegram_id,
+                                 expires_at, expires_ts, then=((db._CODE_ACTIVE_SQL, (rec["id"],)),)):
+                verdict = {"ok": True, "expires_at": expires_at, "expires_ts": expires_ts, "is_developer": rec["is_developer"]}
+                inserted = True
+            else:
+                verdict, _ = db._resolve_license(await _fetchall(conn, db._LICENSE_ROWS_SQL, code), hwid, installation_id)
+                if verdict.get("error") == "not_activated":
+                    verdict = {"ok": False, "error": "code_already_used"}
+    if inserted:
+        db.invalidate_license_cache(code)
+        epoch = db._license_cache_epoch
+    db._license_cache_put(key, verdict, epoch)
+    return verdict
+
+
+async def _db_health_check() -> bool:
+    try:
+        async with _transaction() as conn:
+            await _fetchall(conn, "SELECT 1")
+        db._reset_critical_errors()
+        return True
+    except Exception:
+        return False
+
+
+async def create_code(days: int, is_developer: bool = False) -> str:
+    import secrets
+    code = secrets.token_hex(8).upper()[:16]
+    async with _transaction() as conn:
+        await _execute(conn, "INSERT INTO codes (code, days, is_developer) VALUES (?, ?, ?)",
+                       code, 0 if is_developer else days, 1 if is_developer else 0)
+    db.invalidate_license_cache(code)
+    return code
+
+
+async def _referral_payout(conn, user_telegram_id: int, payment_id: int, amount_usd: float):
+    """Реферальная выплата в текущей транзакции (как db._referral_payout_on_cursor)."""
+    rows = await _fetchall(conn, db._REFERRER_SQL, user_telegram_id)
+    if not rows or not rows[0][0]:
+        return
+    referrer_id, is_partner, custom_pct = rows[0]
+    pct = float(custom_pct) if custom_pct is not None else (20.0 if is_partner else 10.0)
+    amount = round(amount_usd * pct / 100, 2)
+    if amount > 0:
+        await _execute(conn, "INSERT INTO referral_payouts (referrer_id, payment_id, amount_usd, percent) VALUES (?, ?, ?, ?)",
+                       referrer_id, payment_id, amount, pct)
+        await _execute(conn, db._REFERRER_STATS_INIT_SQL, referrer_id)
+        await _execute(conn, db._REFERRER_STATS_ADD_SQL, 0, amount, 0.0, referrer_id)
+
+
+async def add_payment(user_telegram_id: int, amount_usd: float, plan_days: int, code_id: int | None = None,
+                      merchant_order_id: str | None = None, payment_system: str | None = None) -> int:
+    """Платёж и реферальная выплата в одной транзакции."""
+    async with _transaction() as conn:
+        pid = await _insert_id(
+            conn,
+            "INSERT INTO payments (user_telegram_id, amount_usd, plan_days, code_id, merchant_order_id, payment_system) VALUES (?, ?, ?, ?, ?, ?)",
+            user_telegram_id, amount_usd, plan_days, code_id, merchant_order_id, payment_system,
+        )
+        await _referral_payout(conn, user_telegram_id, pid, amount_usd)
+    return pid
+
+
+async def record_paid_order(user_telegram_id: int, amount_usd: float, plan_days: int, merchant_order_id: str,
+                            payment_system: str) -> str | None:
+    """Асинхронный аналог db.record_paid_order: None — заказ уже записан."""
+    import secrets
+    code = secrets.token_hex(8).upper()[:16]
+    params = (user_telegram_id, amount_usd, plan_days, None, merchant_order_id, payment_system)
+    async with _transaction() as conn:
+        if db._USE_PG:
+            pid = await conn.fetchval(_pg_sql(db._PAYMENT_INSERT_ORDER_SQL), *params)
+        else:
+            async with conn.execute(db._PAYMENT_INSERT_ORDER_SQL, params) as cur:
+                pid = cur.lastrowid if cur.rowcount == 1 else None
+        if pid is None:
+            return None
+        await _execute(conn, "INSERT INTO codes (code, days, is_developer) VALUES (?, ?, 0)", code, plan_days)
+        await _execute(conn, "UPDATE payments SET code_id = (SELECT id FROM codes WHERE code = ?) WHERE id = ?", code, pid)
+        await _referral_payout(conn, user_telegram_id, pid, amount_usd)
+    db.invalidate_license_cache(code)
+    return code
+
+
+# Синхронная функция db.py → её асинхронная реализация
+_IMPLS = {
+    db.check_or_activate: check_or_activate,
+    db._db_health_check: _db_health_check,
+    db.create_code: create_code,
+    db.add_payment: add_payment,
+    db.record_paid_order: record_paid_order,
+}
+
+
+def get_impl(func):
+    """Асинхронная версия функции db.py или None, если бэкенд выключен / функции нет."""
+    if not ENABLED:
+        return None
+    return _IMPLS.get(func)
@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 """Обработчики ботов — общая логика для админ и клиент."""
 import os
-import asyncio
 
 # Клиентский бот для рассылок и отправки кодов после оплаты (устанавливается из main.py)
 _client_bot = None
@@ -22,12 +21,15 @@ except ImportError:
     PoolError = type("PoolError", (Exception,), {})
     OperationalError = type("OperationalError", (Exception,), {})
 from telegram.ext import (
-    Application, CommandHandler, ContextTypes, MessageHandler, CallbackQueryHandler,
+    Application, CommandHandler, ContextTypes, MessageHandler, CallbackQueryHandler, TypeHandler,
     filters,
 )
 from queue_pending import add_pending
+import admission
+from admission import db_call, DbOverloaded
 from db import (
-    create_code, create_codes_batch, revoke_code, list_codes_and_activations,
+    start_read_session,
+    create_code, create_codes_batch, create_codes_chunk, bulk_codes_chunk_size, revoke_code, list_codes_page, check_or_activate,
     get_owner_id, get_all_admin_ids, add_admin, remove_admin, list_admins, is_appointed_admin,
     set_code_assigned, delete_code, delete_all_codes, get_free_codes,
     set_pending_code_assign, get_pending_code_assign, clear_pending_code_assign,
@@ -35,8 +37,8 @@ from db import (
     ensure_user, get_user, get_user_by_username, set_partner, set_custom_discount,
     set_gift, set_blocked,
     ensure_pending_user, get_pending_user, set_pending_blocked, set_pending_partner, set_pending_gift, set_pending_discount, merge_pending_to_user,
-    list_referrals, add_payment, get_referral_stats, get_user_payouts, get_user_total_pending,
-    list_all_users, list_paid_users, list_assigned_usernames_not_in_users, list_clients_with_extended,
+    list_referrals, add_payment, get_referral_stats, list_referrer_ids, rebuild_referrer_stats, check_code_status, get_user_payouts, get_user_total_pending,
+    list_all_users, list_paid_users, list_clients_page,
     get_setting, get_setting_cached, set_setting, list_recent_payments,
 )
 
@@ -57,28 +59,15 @@ def _escape_md(s: str) -> str:
     return s
 
 
-def _is_owner(user_id: int) -> bool:
+async def _is_owner(user_id: int) -> bool:
     """Полные права: владелец (первый в ADMIN_USER_IDS) или любой админ из admins."""
     if get_owner_id() is not None and user_id == get_owner_id():
         return True
-    return user_id in get_all_admin_ids() or is_appointed_admin(user_id)
+    return user_id in get_all_admin_ids() or await db_call(is_appointed_admin, user_id)
 
 
-def _is_admin(user_id: int) -> bool:
-    return user_id in get_all_admin_ids() or is_appointed_admin(user_id)
-
-
-async def _retry_db(func, *args, max_attempts=4, delay=3, **kwargs):
-    """Повтор при PoolError/OperationalError — запрос в очереди, не падаем."""
-    last_err = None
-    for attempt in range(max_attempts):
-        try:
-            return await asyncio.to_thread(func, *args, **kwargs)
-        except (PoolError, OperationalError) as e:
-            last_err = e
-            if attempt < max_attempts - 1:
-                await asyncio.sleep(delay)
-    raise last_err
+async def _is_admin(user_id: int) -> bool:
+    return user_id in get_all_admin_ids() or await db_call(is_appointed_admin, user_id)
 
 
 def _main_menu_keyboard(is_owner: bool):
@@ -112,45 +101,114 @@ def _back_to_menu_keyboard(is_owner: bool):
 CODES_LEGEND = "код | тип | @user | ст. | срок\n━━━━━━━━━━━━━━━━\n\n"
 
 
-def _build_codes_list(rows: list, page: int, total_pages: int, search: str, context) -> tuple:
-    from datetime import datetime
-    now = datetime.utcnow()
-    PAGE_SIZE = 10
-    start = page * PAGE_SIZE
-    page_rows = rows[start:start + PAGE_SIZE]
+CODES_PAGE_SIZE = 10
+CLIENTS_PAGE_SIZE = 10
+# Фильтр списка кодов по статусу: кнопка переключает по кругу
+CODES_STATUS_NEXT = {None: "free", "free": "active", "active": "expiring", "expiring": "revoked", "revoked": None}
+CODES_STATUS_LABEL = {None: "все", "free": "свободные", "active": "активные", "expiring": "истекают ≤7д", "revoked": "отозванные"}
+
+
+def _build_codes_list(page: dict, page_no: int, search: str, status: str | None) -> tuple:
+    """Строки и клавиатура страницы из db.list_codes_page (навигация — курсорами next/prev)."""
     kb, lines = [], []
-    for r in page_rows:
+    for r in page["rows"]:
         dev = "DEV" if r["is_developer"] else f"{r['days']}д"
         acc = f"@{r['assigned_username']}" if r.get("assigned_username") else "—"
-        status = "отозван" if r.get("revoked") else ("акт" if r.get("hwid") else "—")
-        exp_raw = r.get("expires_at")
-        if not exp_raw or r["is_developer"]:
+        status_str = "отозван" if r.get("revoked") else ("акт" if r.get("hwid") else "—")
+        if r["is_developer"] or not r.get("expires_at"):
             days_str = "∞"
         else:
-            from db import _to_datetime
-            exp = _to_datetime(exp_raw)
-            days_str = f"{max(0, (exp - now).days)}д" if exp else "?"
+            days_str = f"{r['days_left']}д" if r.get("days_left") is not None else "?"
         rev = " ❌" if r.get("revoked") else ""
-        lines.append(f"`{r['code']}` {dev} {acc} {status} {days_str}{rev}")
+        lines.append(f"`{r['code']}` {dev} {acc} {status_str} {days_str}{rev}")
         # Кнопка привязки только для свободных кодов — иначе перезапишем предыдущего клиента
         assign_btn = [InlineKeyboardButton("🔗", callback_data=f"a_{r['code']}")] if not r.get("assigned_username") else []
         kb.append(assign_btn + [InlineKeyboardButton("🗑", callback_data=f"d_{r['code']}")])
+    total_pages = max(1, (page["total"] + CODES_PAGE_SIZE - 1) // CODES_PAGE_SIZE)
     nav = []
-    if page > 0:
-        nav.append(InlineKeyboardButton("◀️", callback_data=f"list_codes:{page-1}"))
-    nav.append(InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="noop"))
-    if page < total_pages - 1:
-        nav.append(InlineKeyboardButton("▶️", callback_data=f"list_codes:{page+1}"))
+    if page["prev"]:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"list_codes:{max(0, page_no - 1)}:{page['prev']}"))
+    nav.append(InlineKeyboardButton(f"{page_no + 1}/{total_pages}", callback_data="noop"))
+    if page["next"]:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"list_codes:{page_no + 1}:{page['next']}"))
     kb.append(nav)
     footer = [InlineKeyboardButton("🔍 Поиск", callback_data="code_search"), InlineKeyboardButton("🔄", callback_data="list_codes")]
     if search:
         footer.insert(1, InlineKeyboardButton("✖", callback_data="code_search_clear"))
     footer.extend([InlineKeyboardButton("◀️ Меню", callback_data="main_menu")])
     kb.append(footer)
+    kb.append([InlineKeyboardButton(f"🔘 Статус: {CODES_STATUS_LABEL[status]}", callback_data="code_status")])
     kb.append([InlineKeyboardButton("🗑 Удалить ВСЕ", callback_data="del_all_confirm")])
     return lines, kb
 
 
+async def _show_codes_page(query, context, cursor: str | None = None, page_no: int = 0):
+    """Страница списка кодов с текущими поиском и фильтром статуса из user_data."""
+    search = context.user_data.get("code_search") or ""
+    status = context.user_data.get("code_status")
+    page = await db_call(list_codes_page, cursor, CODES_PAGE_SIZE, search, status)
+    if not page["rows"] and cursor:
+        # Страница опустела (коды удалили) — с начала
+        page, page_no = await db_call(list_codes_page, None, CODES_PAGE_SIZE, search, status), 0
+    if not page["rows"]:
+        filters_str = (f"\nПоиск: @{search}" if search else "") + (f"\nСтатус: {CODES_STATUS_LABEL[status]}" if status else "")
+        kb = [
+            [InlineKeyboardButton("🔍 Поиск", callback_data="code_search")],
+            [InlineKeyboardButton("🔄 Обновить", callback_data="list_codes")],
+            [InlineKeyboardButton("◀️ Меню", callback_data="main_menu")],
+        ]
+        if search:
+            kb.insert(1, [InlineKeyboardButton("✖ Сбросить поиск", callback_data="code_search_clear")])
+        if status:
+            kb.insert(1, [InlineKeyboardButton(f"🔘 Статус: {CODES_STATUS_LABEL[status]}", callback_data="code_status")])
+        await query.edit_message_text("📭 Нет кодов." + filters_str, reply_markup=InlineKeyboardMarkup(kb))
+        return
+    lines, kb = _build_codes_list(page, page_no, search, status)
+    header = f"Поиск: @{search}\n\n" if search else ""
+    await query.edit_message_text(f"📋 *Коды* ({page['total']})\n{CODES_LEGEND}{header}" + "\n".join(lines), parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(kb))
+
+
+async def _show_clients_page(query, context, page: int = 0):
+    """Страница «Список клиентов» с сортировкой и поиском из user_data (выборка и счётчики — в db.list_clients_page)."""
+    sort_by = context.user_data.get("client_sort", "date")
+    search = context.user_data.get("client_search") or ""
+    res = await db_call(list_clients_page, page, CLIENTS_PAGE_SIZE, sort_by, search)
+    page, total = res["page"], res["total"]
+    summary = f"👤 {res['clients']} | 🤝 {res['partners']} | 🎁 {res['gifts']} | 💰 {res['paid']} оплатили"
+    total_pages = max(1, (total + CLIENTS_PAGE_SIZE - 1) // CLIENTS_PAGE_SIZE)
+    lines, kb = [], []
+    for u in res["rows"]:
+        un = f"@{u['username']}" if u.get("username") else f"ID:{u['telegram_id']}"
+        un_safe = _escape_md(un)
+        if u.get("is_blocked"): role = "🚫"
+        elif u.get("is_partner"): role = "🤝"
+        elif u.get("is_gift"): role = "🎁"
+        else: role = "👤"
+        pay_mark = "💰" if u["paid"] else "—"
+        lines.append(f"{role} {un_safe} {pay_mark}")
+        cid = u["telegram_id"] if u["telegram_id"] else f"u_{u.get('username','')}"
+        kb.append([InlineKeyboardButton(f"📋 {un}", callback_data=f"client_{cid}")])
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"list_clients:{page-1}:{sort_by}"))
+    nav.append(InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="noop"))
+    if page < total_pages - 1:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"list_clients:{page+1}:{sort_by}"))
+    kb.append(nav)
+    sort_btn = InlineKeyboardButton("📊 Сортировка", callback_data="client_sort_menu")
+    footer = [InlineKeyboardButton("🔍 Поиск", callback_data="client_search"), InlineKeyboardButton("🔄", callback_data="list_clients"), sort_btn]
+    if search:
+        footer.insert(1, InlineKeyboardButton("✖", callback_data="client_search_clear"))
+    footer.append(InlineKeyboardButton("◀️ Меню", callback_data="main_menu"))
+    kb.append(footer)
+    header = f"Поиск: @{search}\n\n" if search else ""
+    text = f"👥 *Список клиентов* ({total})\n\n{summary}\n━━━━━━━━━━━━━━━━\n\n{header}" + "\n".join(lines)
+    try:
+        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(kb))
+    except BadRequest:
+        await query.edit_message_text(text[:4000], reply_markup=InlineKeyboardMarkup(kb))
+
+
 def _admins_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("➕ Добавить админа", callback_data="add_admin")],
@@ -169,11 +227,11 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except (TimedOut, NetworkError):
         return
     user_id = update.effective_user.id
-    if not _is_admin(user_id):
+    if not await _is_admin(user_id):
         await query.edit_message_text("⛔ Доступ запрещён.")
         return
     data = query.data
-    is_owner = _is_owner(user_id)
+    is_owner = await _is_owner(user_id)
 
     if data == "main_menu":
         role = "👑 Владелец" if is_owner else "👤 Админ"
@@ -193,8 +251,8 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "give_code_menu":
         context.user_data.pop("awaiting_give_code_client", None)
         context.user_data.pop("awaiting_give_code_type", None)
-        clear_pending_code_assign(user_id)
-        free = get_free_codes(15)
+        await db_call(clear_pending_code_assign, user_id)
+        free = await db_call(get_free_codes, 15)
         kb = []
         for c in free[:10]:
             dev = "♾" if c["is_developer"] else f"{c['days']}д"
@@ -210,7 +268,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith("gc_") and len(data) > 3:
         code_val = data[3:]
         context.user_data["awaiting_give_code_client"] = code_val
-        set_pending_code_assign(user_id, code_val)
+        await db_call(set_pending_code_assign, user_id, code_val)
         await query.edit_message_text(
             f"🔗 *Привязать код* `{code_val}`\n\nОтправьте @username или ссылку t.me/username клиента:",
             parse_mode="Markdown",
@@ -231,10 +289,10 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     if data == "code_30":
-        code = create_code(days=30)
+        code = await db_call(create_code, days=30)
         if context.user_data.pop("awaiting_give_code_type", None):
             context.user_data["awaiting_give_code_client"] = code
-            set_pending_code_assign(user_id, code)
+            await db_call(set_pending_code_assign, user_id, code)
             await query.edit_message_text(
                 f"✅ *Код создан* `{code}`\n\nОтправьте @username или ссылку t.me/username клиента:",
                 parse_mode="Markdown",
@@ -244,10 +302,10 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text(f"✅ *Код на 30 дней*\n\n`{code}`", parse_mode="Markdown", reply_markup=_back_to_menu_keyboard(is_owner))
         return
     if data == "code_60":
-        code = create_code(days=60)
+        code = await db_call(create_code, days=60)
         if context.user_data.pop("awaiting_give_code_type", None):
             context.user_data["awaiting_give_code_client"] = code
-            set_pending_code_assign(user_id, code)
+            await db_call(set_pending_code_assign, user_id, code)
             await query.edit_message_text(
                 f"✅ *Код создан* `{code}`\n\nОтправьте @username или ссылку t.me/username клиента:",
                 parse_mode="Markdown",
@@ -257,10 +315,10 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text(f"✅ *Код на 60 дней*\n\n`{code}`", parse_mode="Markdown", reply_markup=_back_to_menu_keyboard(is_owner))
         return
     if data == "code_90":
-        code = create_code(days=90)
+        code = await db_call(create_code, days=90)
         if context.user_data.pop("awaiting_give_code_type", None):
             context.user_data["awaiting_give_code_client"] = code
-            set_pending_code_assign(user_id, code)
+            await db_call(set_pending_code_assign, user_id, code)
             await query.edit_message_text(
                 f"✅ *Код создан* `{code}`\n\nОтправьте @username или ссылку t.me/username клиента:",
                 parse_mode="Markdown",
@@ -270,10 +328,10 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text(f"✅ *Код на 90 дней*\n\n`{code}`", parse_mode="Markdown", reply_markup=_back_to_menu_keyboard(is_owner))
         return
     if data == "code_dev_1":
-        code = create_code(days=0, is_developer=True)
+        code = await db_call(create_code, days=0, is_developer=True)
         if context.user_data.pop("awaiting_give_code_type", None):
             context.user_data["awaiting_give_code_client"] = code
-            set_pending_code_assign(user_id, code)
+            await db_call(set_pending_code_assign, user_id, code)
             await query.edit_message_text(
                 f"✅ *Код создан* `{code}`\n\nОтправьте @username или ссылку t.me/username клиента:",
                 parse_mode="Markdown",
@@ -282,45 +340,34 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await query.edit_message_text(f"✅ *Вечный код*\n\n`{code}`", parse_mode="Markdown", reply_markup=_back_to_menu_keyboard(is_owner))
         return
-    if data == "list_codes" or (data.startswith("list_codes:") and len(data) > 11):
-        page = int(data.split(":")[1]) if data.startswith("list_codes:") else 0
-        search = context.user_data.get("code_search") or ""
-        rows = list_codes_and_activations()
-        if search:
-            rows = [r for r in rows if r.get("assigned_username") and search.lower() in (r["assigned_username"] or "").lower()]
-        if not rows:
-            await query.edit_message_text("📭 Нет кодов." + (f"\nПоиск: @{search}" if search else ""), reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔍 Поиск", callback_data="code_search")],
-                [InlineKeyboardButton("🔄 Обновить", callback_data="list_codes")],
-                [InlineKeyboardButton("◀️ Меню", callback_data="main_menu")],
-            ]))
-        else:
-            total_pages = max(1, (len(rows) + 9) // 10)
-            page = max(0, min(page, total_pages - 1))
-            lines, kb = _build_codes_list(rows, page, total_pages, search, context)
-            header = f"Поиск: @{search}\n\n" if search else ""
-            await query.edit_message_text(f"📋 *Коды* ({len(rows)})\n{CODES_LEGEND}{header}" + "\n".join(lines), parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(kb))
+    if data == "list_codes" or data.startswith("list_codes:"):
+        # list_codes:<номер страницы>:<курсор>; старые кнопки list_codes:<N> — на первую страницу
+        parts = data.split(":")
+        page_no = int(parts[1]) if len(parts) == 3 and parts[1].isdigit() else 0
+        await _show_codes_page(query, context, parts[2] if len(parts) == 3 else None, page_no)
         return
     if data == "code_search":
         context.user_data["awaiting_code_search"] = True
         context.user_data["_list_msg"] = (query.message.chat_id, query.message.message_id)
-        await query.edit_message_text("🔍 *Поиск по @username*\n\nОтправьте @username:", parse_mode="Markdown", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="list_codes")]]))
+        await query.edit_message_text("🔍 *Поиск по @username*\n\nОтправьте @username или его часть:", parse_mode="Markdown", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="list_codes")]]))
         return
     if data == "code_search_clear":
         context.user_data.pop("code_search", None)
         context.user_data.pop("awaiting_code_search", None)
-        rows = list_codes_and_activations()
-        lines, kb = _build_codes_list(rows, 0, max(1, (len(rows) + 9) // 10), "", context) if rows else ([], [])
-        await query.edit_message_text("📋 *Коды*\n" + ("\n".join(lines) if lines else "📭 Нет кодов."), parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(kb) if kb else InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Меню", callback_data="main_menu")]]))
+        await _show_codes_page(query, context)
+        return
+    if data == "code_status":
+        context.user_data["code_status"] = CODES_STATUS_NEXT.get(context.user_data.get("code_status"))
+        await _show_codes_page(query, context)
         return
     if data == "del_all_confirm":
-        n = len(list_codes_and_activations())
+        n = (await db_call(list_codes_page, limit=0))["total"]
         await query.edit_message_text(f"🗑 Удалить ВСЕ {n} кодов?", reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("✅ Да", callback_data="del_all_ok"), InlineKeyboardButton("❌ Нет", callback_data="list_codes")],
         ]))
         return
     if data == "del_all_ok":
-        n = delete_all_codes()
+        n = await db_call(delete_all_codes)
         context.user_data.pop("code_search", None)
         await query.edit_message_text(f"✅ Удалено: {n}", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Меню", callback_data="main_menu")]]))
         return
@@ -334,22 +381,17 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ]))
         return
     if data.startswith("del_ok_") and len(data) > 7:
-        delete_code(data[7:])
-        rows = list_codes_and_activations()
-        if not rows:
-            await query.edit_message_text("📭 Кодов не осталось.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Меню", callback_data="main_menu")]]))
-        else:
-            lines, kb = _build_codes_list(rows, 0, max(1, (len(rows) + 9) // 10), "", context)
-            await query.edit_message_text("📋 *Коды*\n" + "\n".join(lines), parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(kb))
+        await db_call(delete_code, data[7:])
+        await _show_codes_page(query, context)
         return
     if data == "list_admins" and is_owner:
         owner_id = get_owner_id()
-        admins = list_admins()
+        admins = await db_call(list_admins)
         lines = [f"👑 Владелец: `{owner_id}`"] + [f"👤 `{a['telegram_id']}`" for a in admins]
         await query.edit_message_text("👥 *Админы*\n\n" + "\n".join(lines), parse_mode="Markdown", reply_markup=_admins_keyboard())
         return
     if data == "payments_log":
-        payments = list_recent_payments(25)
+        payments = await db_call(list_recent_payments, 25)
         if not payments:
             text = "📜 *Логи платежей*\n\n━━━━━━━━━━━━━━━━\n\nПока нет записей."
         else:
@@ -366,59 +408,11 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     if data == "list_clients" or (data.startswith("list_clients") and ":" in data):
         parts = data.split(":")
-        page = int(parts[1]) if len(parts) > 1 else 0
-        sort_by = context.user_data.get("client_sort", "date")
+        page = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
         if len(parts) > 2 and parts[2] in ("date", "name", "status"):
-            sort_by = parts[2]
-            context.user_data["client_sort"] = sort_by
-        search = context.user_data.get("client_search") or ""
+            context.user_data["client_sort"] = parts[2]
         try:
-            users = list_clients_with_extended(sort_by)
-            if search:
-                un = search.lower().lstrip("@")
-                users = [u for u in users if un in (u.get("username") or "").lower() or str(u["telegram_id"]) == search]
-            paid = set(list_paid_users())
-            total = len(users)
-            clients = sum(1 for u in users if not u.get("is_partner") and not u.get("is_gift"))
-            partners = sum(1 for u in users if u.get("is_partner"))
-            gifts = sum(1 for u in users if u.get("is_gift"))
-            summary = f"👤 {clients} | 🤝 {partners} | 🎁 {gifts} | 💰 {len(paid)} оплатили"
-            PAGE_SIZE = 10
-            total_pages = max(1, (total + PAGE_SIZE - 1) // PAGE_SIZE)
-            page = max(0, min(page, total_pages - 1))
-            start = page * PAGE_SIZE
-            page_users = users[start:start + PAGE_SIZE]
-            lines, kb = [], []
-            for u in page_users:
-                un = f"@{u['username']}" if u.get("username") else f"ID:{u['telegram_id']}"
-                un_safe = _escape_md(un)
-                if u.get("is_blocked"): role = "🚫"
-                elif u.get("is_partner"): role = "🤝"
-                elif u.get("is_gift"): role = "🎁"
-                else: role = "👤"
-                pay_mark = "💰" if u["telegram_id"] in paid else "—"
-                lines.append(f"{role} {un_safe} {pay_mark}")
-                cid = u["telegram_id"] if u["telegram_id"] else f"u_{u.get('username','')}"
-                kb.append([InlineKeyboardButton(f"📋 {un}", callback_data=f"client_{cid}")])
-            nav = []
-            if page > 0:
-                nav.append(InlineKeyboardButton("◀️", callback_data=f"list_clients:{page-1}:{sort_by}"))
-            nav.append(InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="noop"))
-            if page < total_pages - 1:
-                nav.append(InlineKeyboardButton("▶️", callback_data=f"list_clients:{page+1}:{sort_by}"))
-            kb.append(nav)
-            sort_btn = InlineKeyboardButton("📊 Сортировка", callback_data="client_sort_menu")
-            footer = [InlineKeyboardButton("🔍 Поиск", callback_data="client_search"), InlineKeyboardButton("🔄", callback_data="list_clients"), sort_btn]
-            if search:
-                footer.insert(1, InlineKeyboardButton("✖", callback_data="client_search_clear"))
-            footer.append(InlineKeyboardButton("◀️ Меню", callback_data="main_menu"))
-            kb.append(footer)
-            header = f"Поиск: @{search}\n\n" if search else ""
-            text = f"👥 *Список клиентов* ({total})\n\n{summary}\n━━━━━━━━━━━━━━━━\n\n{header}" + "\n".join(lines)
-            try:
-                await query.edit_message_text(text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(kb))
-            except BadRequest:
-                await query.edit_message_text(text[:4000], reply_markup=InlineKeyboardMarkup(kb))
+            await _show_clients_page(query, context, page)
         except Exception as e:
             err_msg = "Сервер перегружен" if "перегружен" in str(e) or "pool" in str(e).lower() else "Ошибка загрузки"
             await query.edit_message_text(
@@ -444,45 +438,12 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data.pop("client_search", None)
         context.user_data.pop("awaiting_client_search", None)
         try:
-            users = list_clients_with_extended(context.user_data.get("client_sort", "date"))
+            await _show_clients_page(query, context)
         except Exception:
             await query.edit_message_text(
                 "⚠️ Ошибка загрузки. Подождите минуту.",
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Меню", callback_data="main_menu")]])
             )
-            return
-        paid = set(list_paid_users())
-        total = len(users)
-        clients = sum(1 for u in users if not u.get("is_partner") and not u.get("is_gift"))
-        partners = sum(1 for u in users if u.get("is_partner"))
-        gifts = sum(1 for u in users if u.get("is_gift"))
-        summary = f"👤 {clients} | 🤝 {partners} | 🎁 {gifts} | 💰 {len(paid)} оплатили"
-        PAGE_SIZE = 10
-        total_pages = max(1, (total + PAGE_SIZE - 1) // PAGE_SIZE)
-        page_users = users[:PAGE_SIZE]
-        lines, kb = [], []
-        for u in page_users:
-            un = f"@{u['username']}" if u.get("username") else f"ID:{u['telegram_id']}"
-            un_safe = _escape_md(un)
-            if u.get("is_blocked"): role = "🚫"
-            elif u.get("is_partner"): role = "🤝"
-            elif u.get("is_gift"): role = "🎁"
-            else: role = "👤"
-            pay_mark = "💰" if u["telegram_id"] in paid else "—"
-            lines.append(f"{role} {un_safe} {pay_mark}")
-            cid = u["telegram_id"] if u["telegram_id"] else f"u_{u.get('username','')}"
-            kb.append([InlineKeyboardButton(f"📋 {un}", callback_data=f"client_{cid}")])
-        sort_by = context.user_data.get("client_sort", "date")
-        nav = [InlineKeyboardButton("1/" + str(total_pages), callback_data="noop")]
-        if total_pages > 1:
-            nav.append(InlineKeyboardButton("▶️", callback_data=f"list_clients:1:{sort_by}"))
-        kb.append(nav)
-        kb.append([InlineKeyboardButton("🔍 Поиск", callback_data="client_search"), InlineKeyboardButton("🔄", callback_data="list_clients"), InlineKeyboardButton("📊 Сорт.", callback_data="client_sort_menu"), InlineKeyboardButton("◀️ Меню", callback_data="main_menu")])
-        text = f"👥 *Список клиентов* ({total})\n\n{summary}\n━━━━━━━━━━━━━━━━\n\n" + "\n".join(lines)
-        try:
-            await query.edit_message_text(text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(kb))
-        except BadRequest:
-            await query.edit_message_text(text[:4000], reply_markup=InlineKeyboardMarkup(kb))
         return
     # Сначала проверяем действия (partner/gift/block/pct), иначе client_partner_123_1 попадёт сюда и упадёт
     if data.startswith("client_partner_") and is_owner:
@@ -491,8 +452,8 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parts = rest[2:].rsplit("_", 1)
             if len(parts) == 2:
                 un, is_part = parts[0], int(parts[1])
-                set_pending_partner(un, bool(is_part))
-                info = get_client_full_info(0, un)
+                await db_call(set_pending_partner, un, bool(is_part))
+                info = await db_call(get_client_full_info, 0, un)
                 if info:
                     un_display = f"@{info['username']}" if info.get("username") else un
                     role = "партнёром (20%)" if is_part else "клиентом (10%)"
@@ -501,8 +462,8 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parts = rest.split("_")
             if len(parts) == 2:
                 uid, is_part = int(parts[0]), int(parts[1])
-                set_partner(uid, bool(is_part))
-                info = get_client_full_info(uid)
+                await db_call(set_partner, uid, bool(is_part))
+                info = await db_call(get_client_full_info, uid)
                 if info:
                     un = f"@{info['username']}" if info.get("username") else f"ID:{info['telegram_id']}"
                     role = "партнёром (20%)" if is_part else "клиентом (10%)"
@@ -514,8 +475,8 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parts = rest[2:].rsplit("_", 1)
             if len(parts) == 2:
                 un, is_gift = parts[0], int(parts[1])
-                set_pending_gift(un, bool(is_gift))
-                info = get_client_full_info(0, un)
+                await db_call(set_pending_gift, un, bool(is_gift))
+                info = await db_call(get_client_full_info, 0, un)
                 if info:
                     un_display = f"@{info['username']}" if info.get("username") else un
                     role = "подарком (10%)" if is_gift else "клиентом"
@@ -524,8 +485,8 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parts = rest.split("_")
             if len(parts) == 2:
                 uid, is_gift = int(parts[0]), int(parts[1])
-                set_gift(uid, bool(is_gift))
-                info = get_client_full_info(uid)
+                await db_call(set_gift, uid, bool(is_gift))
+                info = await db_call(get_client_full_info, uid)
                 if info:
                     un = f"@{info['username']}" if info.get("username") else f"ID:{info['telegram_id']}"
                     role = "подарком (10%)" if is_gift else "клиентом"
@@ -535,8 +496,8 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         rest = data.replace("client_block_", "")
         if rest.startswith("u_"):
             un = rest[2:].rsplit("_", 1)[0] if "_" in rest[2:] else rest[2:]
-            set_pending_blocked(un, True)
-            info = get_client_full_info(0, un)
+            await db_call(set_pending_blocked, un, True)
+            info = await db_call(get_client_full_info, 0, un)
             if info:
                 un_display = f"@{info['username']}" if info.get("username") else un
                 await query.edit_message_text(f"✅ {un_display} заблокирован навсегда.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ К клиенту", callback_data=f"client_u_{un}")]]))
@@ -544,8 +505,8 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parts = rest.split("_")
             if len(parts) == 2:
                 uid, is_block = int(parts[0]), int(parts[1])
-                set_blocked(uid, bool(is_block))
-                info = get_client_full_info(uid)
+                await db_call(set_blocked, uid, bool(is_block))
+                info = await db_call(get_client_full_info, uid)
                 if info:
                     un = f"@{info['username']}" if info.get("username") else f"ID:{info['telegram_id']}"
                     await query.edit_message_text(f"✅ {un} заблокирован навсегда.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ К клиенту", callback_data=f"client_{uid}")]]))
@@ -563,7 +524,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             uid = int(rest)
             context.user_data["awaiting_client_pct"] = uid
-            info = get_client_full_info(uid)
+            info = await db_call(get_client_full_info, uid)
             un = f"@{info['username']}" if info and info.get("username") else f"ID:{uid}"
             await query.edit_message_text(
                 f"✏️ Укажите процент рефералки для {un} (0–100):",
@@ -582,8 +543,8 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except ValueError:
                 return
         try:
-            info = await _retry_db(get_client_full_info, uid, un_param) if un_param else await _retry_db(get_client_full_info, uid)
-        except (PoolError, OperationalError):
+            info = await db_call(get_client_full_info, uid, un_param) if un_param else await db_call(get_client_full_info, uid)
+        except (PoolError, OperationalError, DbOverloaded):
             add_pending(update, context.application.update_queue)
             await query.edit_message_text(
                 "⏳ Обрабатываю...",
@@ -604,7 +565,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if sub:
             if sub["status"] == "activated":
                 days = info.get("days_left")
-                sub_block = f"`{sub['code']}` · {'∞' if days == '∞' else f'{days} дн.'}"
+                sub_block = f"`{sub['code']}` · {'∞' if days == '∞' else ('?' if days is None else f'{days} дн.')}"
             else:
                 sub_block = f"`{sub['code']}` (ожидает активации)"
         first_seen = _fmt_date(info.get("first_seen"))
@@ -656,7 +617,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data.pop("awaiting_payment", None)
         context.user_data.pop("awaiting_set_partner", None)
         context.user_data.pop("awaiting_set_discount", None)
-        stats = get_referral_stats()
+        stats = await db_call(get_referral_stats)
         if not stats:
             await query.edit_message_text("📊 *Рефералы*\n\nПока нет рефералов.", parse_mode="Markdown", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Меню", callback_data="main_menu")]]))
             return
@@ -684,16 +645,16 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("➕ *Записать платёж*\n\nОтправьте: сумма долларов, дни\nНапример: `35 30`", parse_mode="Markdown", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="ref_stats")]]))
         return
     if data == "settings_menu" and is_owner:
-        welcome = get_setting("welcome_message", "🎙 *VoiceLab* — озвучка текста\n\nОплатите подписку и напишите «Оплатил».")
-        price_30 = get_setting("price_30", "35")
-        price_60 = get_setting("price_60", "70")
-        price_90 = get_setting("price_90", "100")
-        software_url = get_setting("software_url", "https://drive.google.com/")
-        fk_ok = "✅" if get_setting("fk_merchant_id", "") else "❌"
-        cm_ok = "✅" if get_setting("cryptomus_merchant", "") else "❌"
-        cards_on = get_setting("payments_cards_enabled", "1") == "1"
-        crypto_on = get_setting("payments_crypto_enabled", "1") == "1"
-        manual_contact = get_setting("manual_payment_contact", "@Drykey")
+        welcome = await db_call(get_setting, "welcome_message", "🎙 *VoiceLab* — озвучка текста\n\nОплатите подписку и напишите «Оплатил».")
+        price_30 = await db_call(get_setting, "price_30", "35")
+        price_60 = await db_call(get_setting, "price_60", "70")
+        price_90 = await db_call(get_setting, "price_90", "100")
+        software_url = await db_call(get_setting, "software_url", "https://drive.google.com/")
+        fk_ok = "✅" if await db_call(get_setting, "fk_merchant_id", "") else "❌"
+        cm_ok = "✅" if await db_call(get_setting, "cryptomus_merchant", "") else "❌"
+        cards_on = await db_call(get_setting, "payments_cards_enabled", "1") == "1"
+        crypto_on = await db_call(get_setting, "payments_crypto_enabled", "1") == "1"
+        manual_contact = await db_call(get_setting, "manual_payment_contact", "@Drykey")
         text = (
             f"⚙️ *Настройки*\n\n"
             f"Приветствие: _{welcome[:50]}..._\n\n"
@@ -716,14 +677,14 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(kb))
         return
     if data == "toggle_cards" and is_owner:
-        cur = "1" if get_setting("payments_cards_enabled", "1") != "1" else "0"
-        set_setting("payments_cards_enabled", cur)
+        cur = "1" if await db_call(get_setting, "payments_cards_enabled", "1") != "1" else "0"
+        await db_call(set_setting, "payments_cards_enabled", cur)
         status = "включена" if cur == "1" else "выключена"
         await query.edit_message_text(f"✅ Оплата картой {status}.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Настройки", callback_data="settings_menu")]]))
         return
     if data == "toggle_crypto" and is_owner:
-        cur = "1" if get_setting("payments_crypto_enabled", "1") != "1" else "0"
-        set_setting("payments_crypto_enabled", cur)
+        cur = "1" if await db_call(get_setting, "payments_crypto_enabled", "1") != "1" else "0"
+        await db_call(set_setting, "payments_crypto_enabled", cur)
         status = "включена" if cur == "1" else "выключена"
         await query.edit_message_text(f"✅ Оплата криптой {status}.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Настройки", callback_data="settings_menu")]]))
         return
@@ -735,9 +696,9 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     if data == "broadcast_menu" and is_owner:
-        users = list_all_users()
-        paid = set(list_paid_users())
-        refs = set(u["telegram_id"] for u in get_referral_stats())
+        users = await db_call(list_all_users)
+        paid = set(await db_call(list_paid_users))
+        refs = set(await db_call(list_referrer_ids))
         text = f"📢 *Рассылка*\n\nВсего пользователей: {len(users)}\nКупили: {len(paid)}\nРефералы: {len(refs)}"
         kb = [
             [InlineKeyboardButton("📤 Всем", callback_data="broadcast_all")],
@@ -796,53 +757,128 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not _is_admin(update.effective_user.id):
+    if not await _is_admin(update.effective_user.id):
         await update.message.reply_text("Нет доступа.")
         return
-    role = "👑 Владелец" if _is_owner(update.effective_user.id) else "👤 Админ"
-    await update.message.reply_text(f"🎛 *Панель VoiceLab*\n\nРоль: {role}", parse_mode="Markdown", reply_markup=_main_menu_keyboard(_is_owner(update.effective_user.id)))
+    role = "👑 Владелец" if await _is_owner(update.effective_user.id) else "👤 Админ"
+    await update.message.reply_text(f"🎛 *Панель VoiceLab*\n\nРоль: {role}", parse_mode="Markdown", reply_markup=_main_menu_keyboard(await _is_owner(update.effective_user.id)))
 
 
 async def cmd_newcode(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not _is_admin(update.effective_user.id):
+    if not await _is_admin(update.effective_user.id):
         return
     days = int(context.args[0]) if context.args and str(context.args[0]).isdigit() else 30
     days = max(1, min(365, days))
-    code = create_code(days=days)
+    code = await db_call(create_code, days=days)
     await update.message.reply_text(f"✅ Код: `{code}`", parse_mode="Markdown")
 
 
 async def cmd_devcode(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not _is_admin(update.effective_user.id):
+    if not await _is_admin(update.effective_user.id):
         return
     count = min(20, max(1, int(context.args[0]) if context.args and str(context.args[0]).isdigit() else 1))
-    codes = create_codes_batch(count=count, is_developer=True)
+    codes = await db_call(create_codes_batch, count=count, is_developer=True)
     await update.message.reply_text("✅ " + "\n".join(f"`{c}`" for c in codes), parse_mode="Markdown")
 
 
+BULK_CODES_MAX = int(os.environ.get("BULK_CODES_MAX", "100000"))
+
+
+async def _write_codes_file(count: int, days: int, is_developer: bool) -> tuple:
+    """Партия кодов в текстовый файл (по коду на строку): пачка — отдельный вызов БД со своим слотом допуска."""
+    import asyncio
+    import io
+    buf = io.BytesIO()
+    n, chunk, busy = 0, bulk_codes_chunk_size(), 0
+    while n < count:
+        try:
+            codes = await db_call(create_codes_chunk, min(count - n, chunk), days, is_developer)
+        except DbOverloaded as e:
+            # Уже вставленные пачки не теряем: ждём свободный слот полосы admin, а не бросаем партию
+            busy += 1
+            if busy > 5:
+                raise
+            await asyncio.sleep(e.retry_after)
+            continue
+        busy = 0
+        buf.write("".join(c + "\n" for c in codes).encode())
+        n += len(codes)
+    buf.seek(0)
+    return buf, n
+
+
+async def cmd_bulkcodes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/bulkcodes <кол-во> [дней|dev] — партия кодов файлом (для реселлеров)."""
+    if not await _is_admin(update.effective_user.id):
+        return
+    args = context.args or []
+    if not args or not args[0].isdigit():
+        await update.message.reply_text(f"Использование: /bulkcodes <кол-во до {BULK_CODES_MAX}> [дней|dev]")
+        return
+    count = max(1, min(BULK_CODES_MAX, int(args[0])))
+    is_developer = len(args) > 1 and args[1].lower() == "dev"
+    days = 0 if is_developer else max(1, min(365, int(args[1]) if len(args) > 1 and args[1].isdigit() else 30))
+    msg = await update.message.reply_text(f"⏳ Генерирую {count} кодов…")
+    try:
+        buf, n = await _write_codes_file(count, days, is_developer)
+    except Exception as e:
+        import logging
+        logging.getLogger(__name__).exception("bulkcodes: %s", e)
+        await msg.edit_text("❌ Не удалось сгенерировать коды. Попробуйте позже.")
+        return
+    from datetime import datetime
+    kind = "dev" if is_developer else f"{days}d"
+    filename = f"codes_{kind}_{n}_{datetime.utcnow():%Y%m%d_%H%M%S}.txt"
+    await update.message.reply_document(document=buf, filename=filename, caption=f"✅ {n} кодов ({'вечные' if is_developer else f'{days} дней'})")
+    await msg.delete()
+
+
 async def cmd_codes(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not _is_admin(update.effective_user.id):
+    if not await _is_admin(update.effective_user.id):
         return
-    rows = list_codes_and_activations()
+    rows = (await db_call(list_codes_page, limit=40))["rows"]
     if not rows:
         await update.message.reply_text("📭 Нет кодов.")
         return
-    lines = [f"{r['code']} | {r.get('hwid') or '—'}" for r in rows[:40]]
+    lines = [f"{r['code']} | {r.get('hwid') or '—'}" for r in rows]
     await update.message.reply_text("📋 Коды:\n" + "\n".join(lines))
 
 
 async def cmd_revoke(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not _is_admin(update.effective_user.id) or not context.args:
+    if not await _is_admin(update.effective_user.id) or not context.args:
         return
     code = context.args[0].strip().upper()
-    if revoke_code(code):
+    if await db_call(revoke_code, code):
         await update.message.reply_text(f"✅ `{code}` отозван.", parse_mode="Markdown")
     else:
         await update.message.reply_text("❌ Код не найден.")
 
 
+async def cmd_rebuildrefs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Пересчитать агрегаты referrer_stats (после ручных правок в БД)."""
+    if not await _is_owner(update.effective_user.id):
+        return
+    n = await db_call(rebuild_referrer_stats)
+    await update.message.reply_text(f"✅ Статистика рефералов пересчитана: {n} реферер(ов).")
+
+
+async def cmd_checkstatus(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сверить codes.status с активациями; /checkstatus fix — исправить расхождения."""
+    if not await _is_owner(update.effective_user.id):
+        return
+    fix = bool(context.args) and context.args[0].strip().lower() == "fix"
+    res = await db_call(check_code_status, fix=fix)
+    if not res["mismatched"]:
+        await update.message.reply_text(f"✅ Статусы кодов согласованы ({res['checked']}).")
+        return
+    lines = [f"{k}: {v}" for k, v in sorted(res["by_status"].items())]
+    head = "✅ Исправлено" if fix else "⚠️ Расхождений"
+    tail = "" if fix else "\n\n/checkstatus fix — исправить"
+    await update.message.reply_text(f"{head}: {res['mismatched']} из {res['checked']}\n" + "\n".join(lines) + tail)
+
+
 async def cmd_addadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not _is_owner(update.effective_user.id):
+    if not await _is_owner(update.effective_user.id):
         return
     target_id = None
     if update.message.reply_to_message:
@@ -855,12 +891,12 @@ async def cmd_addadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if target_id == get_owner_id():
         await update.message.reply_text("⚠️ Владелец уже в системе.")
         return
-    add_admin(target_id, None, update.effective_user.id)
+    await db_call(add_admin, target_id, None, update.effective_user.id)
     await update.message.reply_text(f"✅ {target_id} добавлен.")
 
 
 async def cmd_removeadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not _is_owner(update.effective_user.id) or not context.args:
+    if not await _is_owner(update.effective_user.id) or not context.args:
         return
     try:
         target_id = int(context.args[0].strip())
@@ -869,23 +905,23 @@ async def cmd_removeadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if target_id == get_owner_id():
         await update.message.reply_text("⚠️ Владельца нельзя удалить.")
         return
-    if remove_admin(target_id):
+    if await db_call(remove_admin, target_id):
         await update.message.reply_text(f"✅ {target_id} убран.")
     else:
         await update.message.reply_text("❌ Не в списке.")
 
 
 async def cmd_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not _is_owner(update.effective_user.id):
+    if not await _is_owner(update.effective_user.id):
         return
     owner_id = get_owner_id()
-    admins = list_admins()
+    admins = await db_call(list_admins)
     lines = [f"👑 Владелец: {owner_id}"] + [f"👤 {a['telegram_id']}" for a in admins]
     await update.message.reply_text("📋 Админы:\n" + "\n".join(lines))
 
 
 async def on_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not _is_admin(update.effective_user.id):
+    if not await _is_admin(update.effective_user.id):
         return
     text = (update.message.text or "").strip().lower()
 
@@ -909,7 +945,7 @@ async def on_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"Поиск: {context.user_data['client_search']}. Нажмите «Список клиентов» в меню.")
         return
 
-    if context.user_data.get("awaiting_client_pct") and _is_owner(update.effective_user.id):
+    if context.user_data.get("awaiting_client_pct") and await _is_owner(update.effective_user.id):
         target = context.user_data.pop("awaiting_client_pct", None)
         if text in ("отмена", "cancel"):
             await update.message.reply_text("Отменено.", reply_markup=_main_menu_keyboard(True))
@@ -920,12 +956,12 @@ async def on_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 if 0 <= pct <= 100:
                     if isinstance(target, str) and target.startswith("u_"):
                         un = target[2:]
-                        set_pending_discount(un, pct)
+                        await db_call(set_pending_discount, un, pct)
                         un_display = f"@{un}"
                         await update.message.reply_text(f"✅ Реферальный процент для {un_display}: {pct}%", reply_markup=_main_menu_keyboard(True))
                     else:
-                        set_custom_discount(target, pct)
-                        info = get_client_full_info(target)
+                        await db_call(set_custom_discount, target, pct)
+                        info = await db_call(get_client_full_info, target)
                         un = f"@{info['username']}" if info and info.get("username") else f"ID:{target}"
                         await update.message.reply_text(f"✅ Реферальный процент для {un}: {pct}%", reply_markup=_main_menu_keyboard(True))
                 else:
@@ -937,34 +973,34 @@ async def on_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Сначала — явные «ожидаю ввод» (настройки, рассылка и т.д.), иначе «1 10 100» уйдёт в выдачу кода
-    if context.user_data.get("awaiting_setting") and _is_owner(update.effective_user.id):
+    if context.user_data.get("awaiting_setting") and await _is_owner(update.effective_user.id):
         key = context.user_data.pop("awaiting_setting", None)
         if text in ("отмена", "cancel"):
             await update.message.reply_text("Отменено.", reply_markup=_main_menu_keyboard(True))
             return
         try:
             if key == "welcome_message":
-                set_setting("welcome_message", update.message.text)
+                await db_call(set_setting, "welcome_message", update.message.text)
                 await update.message.reply_text("✅ Приветствие обновлено.", reply_markup=_main_menu_keyboard(True))
             elif key == "prices":
                 parts = update.message.text.strip().split()
                 if len(parts) >= 3:
-                    set_setting("price_30", parts[0])
-                    set_setting("price_60", parts[1])
-                    set_setting("price_90", parts[2])
+                    await db_call(set_setting, "price_30", parts[0])
+                    await db_call(set_setting, "price_60", parts[1])
+                    await db_call(set_setting, "price_90", parts[2])
                     await update.message.reply_text("✅ Цены обновлены.", reply_markup=_main_menu_keyboard(True))
                 else:
                     await update.message.reply_text("⚠️ Нужно 3 числа: 30д 60д 90д")
                     context.user_data["awaiting_setting"] = "prices"
             elif key == "software_url":
-                set_setting("software_url", update.message.text.strip())
+                await db_call(set_setting, "software_url", update.message.text.strip())
                 await update.message.reply_text("✅ Ссылка обновлена.", reply_markup=_main_menu_keyboard(True))
             elif key == "freekassa":
                 parts = update.message.text.strip().split()
                 if len(parts) >= 3:
-                    set_setting("fk_merchant_id", parts[0])
-                    set_setting("fk_secret_1", parts[1])
-                    set_setting("fk_secret_2", parts[2])
+                    await db_call(set_setting, "fk_merchant_id", parts[0])
+                    await db_call(set_setting, "fk_secret_1", parts[1])
+                    await db_call(set_setting, "fk_secret_2", parts[2])
                     await update.message.reply_text("✅ FreeKassa настроен.", reply_markup=_main_menu_keyboard(True))
                 else:
                     await update.message.reply_text("⚠️ Нужно 3 значения: merchant_id secret1 secret2")
@@ -972,14 +1008,14 @@ async def on_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             elif key == "cryptomus":
                 parts = update.message.text.strip().split()
                 if len(parts) >= 2:
-                    set_setting("cryptomus_merchant", parts[0])
-                    set_setting("cryptomus_api_key", parts[1])
+                    await db_call(set_setting, "cryptomus_merchant", parts[0])
+                    await db_call(set_setting, "cryptomus_api_key", parts[1])
                     await update.message.reply_text("✅ Cryptomus настроен.", reply_markup=_main_menu_keyboard(True))
                 else:
                     await update.message.reply_text("⚠️ Нужно 2 значения: merchant_uuid api_key")
                     context.user_data["awaiting_setting"] = "cryptomus"
             elif key == "manual_payment_contact":
-                set_setting("manual_payment_contact", update.message.text.strip() or "@Drykey")
+                await db_call(set_setting, "manual_payment_contact", update.message.text.strip() or "@Drykey")
                 await update.message.reply_text("✅ Контакт обновлён.", reply_markup=_main_menu_keyboard(True))
         except Exception as e:
             import logging
@@ -991,18 +1027,18 @@ async def on_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.user_data.get("awaiting_assign_for"):
         code_val = context.user_data.pop("awaiting_assign_for", None)
         if text in ("отмена", "cancel"):
-            await update.message.reply_text("Отменено.", reply_markup=_main_menu_keyboard(_is_owner(update.effective_user.id)))
+            await update.message.reply_text("Отменено.", reply_markup=_main_menu_keyboard(await _is_owner(update.effective_user.id)))
             return
-        if code_val and set_code_assigned(code_val, text):
+        if code_val and await db_call(set_code_assigned, code_val, text):
             await update.message.reply_text(f"✅ Привязано к @{text.lstrip('@')}")
-        await update.message.reply_text("🎛 Меню:", reply_markup=_main_menu_keyboard(_is_owner(update.effective_user.id)))
+        await update.message.reply_text("🎛 Меню:", reply_markup=_main_menu_keyboard(await _is_owner(update.effective_user.id)))
         return
 
-    code_val = context.user_data.pop("awaiting_give_code_client", None) or get_pending_code_assign(update.effective_user.id)
+    code_val = context.user_data.pop("awaiting_give_code_client", None) or await db_call(get_pending_code_assign, update.effective_user.id)
     if code_val:
         if text in ("отмена", "cancel"):
-            clear_pending_code_assign(update.effective_user.id)
-            await update.message.reply_text("Отменено.", reply_markup=_main_menu_keyboard(_is_owner(update.effective_user.id)))
+            await db_call(clear_pending_code_assign, update.effective_user.id)
+            await update.message.reply_text("Отменено.", reply_markup=_main_menu_keyboard(await _is_owner(update.effective_user.id)))
             return
         raw = update.message.text.strip()
         un = raw.lstrip("@")
@@ -1013,11 +1049,11 @@ async def on_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not un:
             await update.message.reply_text("⚠️ Укажите @username или ссылку t.me/username")
             context.user_data["awaiting_give_code_client"] = code_val
-            set_pending_code_assign(update.effective_user.id, code_val)
+            await db_call(set_pending_code_assign, update.effective_user.id, code_val)
             return
-        if set_code_assigned(code_val, un):
-            clear_pending_code_assign(update.effective_user.id)
-            user = get_user_by_username(un)
+        if await db_call(set_code_assigned, code_val, un):
+            await db_call(clear_pending_code_assign, update.effective_user.id)
+            user = await db_call(get_user_by_username, un)
             sent = False
             if user:
                 client_bot = get_client_bot()
@@ -1036,12 +1072,12 @@ async def on_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 msg += " Код отправлен клиенту в бота."
             else:
                 msg += " ЛК и код появятся при первом заходе клиента в бота."
-            await update.message.reply_text(msg, reply_markup=_main_menu_keyboard(_is_owner(update.effective_user.id)))
+            await update.message.reply_text(msg, reply_markup=_main_menu_keyboard(await _is_owner(update.effective_user.id)))
         else:
-            await update.message.reply_text("❌ Ошибка привязки. Проверьте код.", reply_markup=_main_menu_keyboard(_is_owner(update.effective_user.id)))
+            await update.message.reply_text("❌ Ошибка привязки. Проверьте код.", reply_markup=_main_menu_keyboard(await _is_owner(update.effective_user.id)))
         return
 
-    if context.user_data.get("awaiting_admin_id") and _is_owner(update.effective_user.id):
+    if context.user_data.get("awaiting_admin_id") and await _is_owner(update.effective_user.id):
         if text in ("отмена", "cancel"):
             context.user_data.pop("awaiting_admin_id", None)
             return
@@ -1049,22 +1085,22 @@ async def on_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             target_id = int(text)
             context.user_data.pop("awaiting_admin_id", None)
             if target_id != get_owner_id():
-                add_admin(target_id, None, update.effective_user.id)
+                await db_call(add_admin, target_id, None, update.effective_user.id)
                 await update.message.reply_text(f"✅ {target_id} добавлен.")
         return
 
-    if context.user_data.get("awaiting_broadcast") and _is_owner(update.effective_user.id):
+    if context.user_data.get("awaiting_broadcast") and await _is_owner(update.effective_user.id):
         target = context.user_data.pop("awaiting_broadcast", None)
         if text in ("отмена", "cancel"):
             await update.message.reply_text("Отменено.", reply_markup=_main_menu_keyboard(True))
             return
         chat_ids = []
         if target == "all":
-            chat_ids = [u["telegram_id"] for u in list_all_users()]
+            chat_ids = [u["telegram_id"] for u in await db_call(list_all_users)]
         elif target == "paid":
-            chat_ids = list_paid_users()
+            chat_ids = await db_call(list_paid_users)
         elif target == "refs":
-            chat_ids = [s["telegram_id"] for s in get_referral_stats()]
+            chat_ids = await db_call(list_referrer_ids)
         msg_text = update.message.text
         bot_to_use = _client_bot or context.bot
         sent, failed = 0, 0
@@ -1077,22 +1113,22 @@ async def on_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"📢 Рассылка: отправлено {sent}, ошибок {failed}.", reply_markup=_main_menu_keyboard(True))
         return
 
-    if context.user_data.get("awaiting_set_partner") and _is_owner(update.effective_user.id):
+    if context.user_data.get("awaiting_set_partner") and await _is_owner(update.effective_user.id):
         if text in ("отмена", "cancel"):
             context.user_data.pop("awaiting_set_partner", None)
             await update.message.reply_text("Отменено.", reply_markup=_main_menu_keyboard(True))
             return
         txt = update.message.text.strip().lstrip("@")
-        user = get_user_by_username(txt) if not txt.isdigit() else get_user(int(txt))
+        user = await db_call(get_user_by_username, txt) if not txt.isdigit() else await db_call(get_user, int(txt))
         if user:
-            set_partner(user["telegram_id"], True)
+            await db_call(set_partner, user["telegram_id"], True)
             context.user_data.pop("awaiting_set_partner", None)
             await update.message.reply_text(f"✅ {user.get('username') or user['telegram_id']} назначен партнёром (20%).", reply_markup=_main_menu_keyboard(True))
         else:
             await update.message.reply_text("⚠️ Пользователь не найден.")
         return
 
-    if context.user_data.get("awaiting_set_discount") and _is_owner(update.effective_user.id):
+    if context.user_data.get("awaiting_set_discount") and await _is_owner(update.effective_user.id):
         step = context.user_data["awaiting_set_discount"]
         if text in ("отмена", "cancel"):
             context.user_data.pop("awaiting_set_discount", None)
@@ -1100,7 +1136,7 @@ async def on_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         if step == "user":
             txt = update.message.text.strip().lstrip("@")
-            user = get_user_by_username(txt) if not txt.isdigit() else get_user(int(txt))
+            user = await db_call(get_user_by_username, txt) if not txt.isdigit() else await db_call(get_user, int(txt))
             if user:
                 context.user_data["awaiting_set_discount"] = {"user_id": user["telegram_id"]}
                 await update.message.reply_text("Укажите процент скидки (например 15):")
@@ -1110,7 +1146,7 @@ async def on_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 pct = float(update.message.text.strip())
                 if 0 <= pct <= 100:
-                    set_custom_discount(step["user_id"], pct)
+                    await db_call(set_custom_discount, step["user_id"], pct)
                     context.user_data.pop("awaiting_set_discount", None)
                     await update.message.reply_text(f"✅ Скидка {pct}% установлена.", reply_markup=_main_menu_keyboard(True))
                 else:
@@ -1119,11 +1155,11 @@ async def on_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("⚠️ Введите число.")
         return
 
-    if context.user_data.get("awaiting_payment") and _is_admin(update.effective_user.id):
+    if context.user_data.get("awaiting_payment") and await _is_admin(update.effective_user.id):
         payload = context.user_data["awaiting_payment"]
         if text in ("отмена", "cancel"):
             context.user_data.pop("awaiting_payment", None)
-            await update.message.reply_text("Отменено.", reply_markup=_main_menu_keyboard(_is_owner(update.effective_user.id)))
+            await update.message.reply_text("Отменено.", reply_markup=_main_menu_keyboard(await _is_owner(update.effective_user.id)))
             return
         if payload == "amount":
             try:
@@ -1138,11 +1174,11 @@ async def on_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("⚠️ Формат: сумма дни (например 35 30)")
         elif isinstance(payload, dict):
             txt = update.message.text.strip().lstrip("@")
-            user = get_user_by_username(txt) if not txt.isdigit() else get_user(int(txt))
+            user = await db_call(get_user_by_username, txt) if not txt.isdigit() else await db_call(get_user, int(txt))
             if user:
-                add_payment(user["telegram_id"], payload["amount"], payload["days"])
+                await db_call(add_payment, user["telegram_id"], payload["amount"], payload["days"])
                 context.user_data.pop("awaiting_payment", None)
-                await update.message.reply_text(f"✅ Платёж ${payload['amount']} за {payload['days']}д записан.", reply_markup=_main_menu_keyboard(_is_owner(update.effective_user.id)))
+                await update.message.reply_text(f"✅ Платёж ${payload['amount']} за {payload['days']}д записан.", reply_markup=_main_menu_keyboard(await _is_owner(update.effective_user.id)))
             else:
                 await update.message.reply_text("⚠️ Пользователь не найден. Напишите @username или ID.")
         return
@@ -1169,30 +1205,27 @@ async def client_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     user_id = update.effective_user.id
     username = update.effective_user.username or ""
-    u = get_user(user_id)
+    u = await db_call(get_user, user_id)
     if u and u.get("is_blocked"):
         await query.edit_message_text("⛔ Доступ ограничен. Обратитесь к администратору.", reply_markup=InlineKeyboardMarkup([_client_menu_button()]))
         return
     if query.data == "client_cabinet":
-        refs = list_referrals(user_id)
-        payouts = get_user_payouts(user_id)
-        pending = get_user_total_pending(user_id)
+        refs = await db_call(list_referrals, user_id)
+        payouts = await db_call(get_user_payouts, user_id)
+        pending = await db_call(get_user_total_pending, user_id)
         bot_username = context.bot.username or "NeuralVoiceLabBot"
         ref_link = f"https://t.me/{bot_username}?start=ref_{user_id}"
-        u = get_user(user_id)
+        u = await db_call(get_user, user_id)
         role = "🤝 Партнёр (20%)" if (u and u.get("is_partner")) else ("🎁 Подарок (10%)" if (u and u.get("is_gift")) else "👤 Клиент (10%)")
-        sub = get_user_subscription_info(user_id, username)
+        sub = await db_call(get_user_subscription_info, user_id, username)
         sub_block = ""
         if sub:
             if sub["status"] == "activated":
                 if sub["is_developer"]:
                     sub_block = "📦 *Подписка:* ♾ Бессрочная\n"
                 elif sub["expires_at"]:
-                    from datetime import datetime
-                    from db import _to_datetime
-                    exp = _to_datetime(sub["expires_at"])
-                    days_left = max(0, (exp - datetime.utcnow()).days) if exp else 0
-                    sub_block = f"📦 *Подписка:* {days_left} дн. осталось\n"
+                    days = sub["days_left"]
+                    sub_block = f"📦 *Подписка:* {'?' if days is None else days} дн. осталось\n"
                 else:
                     sub_block = "📦 *Подписка:* активна\n"
             else:
@@ -1230,7 +1263,7 @@ async def client_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(kb))
         return
     if query.data == "client_payouts":
-        payouts = get_user_payouts(user_id)
+        payouts = await db_call(get_user_payouts, user_id)
         if not payouts:
             text = "📋 *Мои выплаты*\n\nИстория пуста."
         else:
@@ -1244,7 +1277,7 @@ async def client_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     if query.data in ("client_back", "main_menu"):
         # main_menu — от обработчика ошибок, ведёт в главное меню
-        welcome = get_setting("welcome_message", "🎙 *VoiceLab* — озвучка текста\n\nОплатите подписку и напишите «Оплатил».")
+        welcome = await db_call(get_setting, "welcome_message", "🎙 *VoiceLab* — озвучка текста\n\nОплатите подписку и напишите «Оплатил».")
         await query.edit_message_text(welcome, parse_mode="Markdown", reply_markup=_client_keyboard())
         return
     if query.data == "client_buy":
@@ -1262,8 +1295,8 @@ async def client_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         fk_60 = generate_freekassa_link(user_id, price_60, 60)
         fk_90 = generate_freekassa_link(user_id, price_90, 90)
         has_fk = bool(fk_30 and fk_60 and fk_90)
-        cm_merchant = get_setting("cryptomus_merchant", "") or os.environ.get("CRYPTOMUS_MERCHANT", "")
-        cm_key = get_setting("cryptomus_api_key", "") or os.environ.get("CRYPTOMUS_API_KEY", "")
+        cm_merchant = await db_call(get_setting, "cryptomus_merchant", "") or os.environ.get("CRYPTOMUS_MERCHANT", "")
+        cm_key = await db_call(get_setting, "cryptomus_api_key", "") or os.environ.get("CRYPTOMUS_API_KEY", "")
         has_cm = bool(cm_merchant and cm_key)
         show_cards = has_fk and cards_enabled
         show_crypto = has_cm and crypto_enabled
@@ -1401,7 +1434,7 @@ async def client_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(kb))
         return
     if query.data == "client_mycode":
-        sub = get_user_subscription_info(user_id, username)
+        sub = await db_call(get_user_subscription_info, user_id, username)
         if not sub:
             await query.edit_message_text(
                 "У вас нет кода. Купите подписку и получите код от администратора.",
@@ -1428,20 +1461,20 @@ async def client_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 referred_by = None
         except ValueError:
             pass
-    ensure_user(user_id, username, referred_by)
-    merge_pending_to_user(user_id, username)
-    u = get_user(user_id)
+    await db_call(ensure_user, user_id, username, referred_by)
+    await db_call(merge_pending_to_user, user_id, username)
+    u = await db_call(get_user, user_id)
     if u and u.get("is_blocked"):
         await update.message.reply_text("⛔ Доступ ограничен. Обратитесь к администратору.")
         return
-    welcome = get_setting("welcome_message", "🎙 *VoiceLab* — озвучка текста\n\nОплатите подписку и напишите «Оплатил».")
+    welcome = await db_call(get_setting, "welcome_message", "🎙 *VoiceLab* — озвучка текста\n\nОплатите подписку и напишите «Оплатил».")
     await update.message.reply_text(welcome, parse_mode="Markdown", reply_markup=_client_keyboard())
 
 
 async def client_mycode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     username = update.effective_user.username or ""
-    sub = get_user_subscription_info(user_id, username)
+    sub = await db_call(get_user_subscription_info, user_id, username)
     if not sub:
         await update.message.reply_text("У вас нет кода.")
     else:
@@ -1476,8 +1509,7 @@ async def client_buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if len(parts) >= 2:
             code, hwid = parts[0].strip().upper(), parts[1].strip()
             inst_id = parts[2].strip() if len(parts) > 2 else None
-            from db import activate_code
-            result = activate_code(code, hwid, inst_id)
+            result = await db_call(check_or_activate, code, hwid, inst_id)
             if result.get("ok"):
                 exp = result.get("expires_at") or ""
                 dev = "1" if result.get("is_developer") else "0"
@@ -1501,7 +1533,7 @@ async def client_buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"❌ {result}")
         return
     if "оплатил" in text_lower or "купить" in text_lower:
-        manual_contact = get_setting("manual_payment_contact", "@Drykey")
+        manual_contact = await db_call(get_setting, "manual_payment_contact", "@Drykey")
         await update.message.reply_text(f"По всем вопросам пишите: {manual_contact}\n\nОплатите подписку в меню «Купить подписку» — ключ придёт автоматически.")
 
 
@@ -1513,7 +1545,7 @@ async def _error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     # PoolError / OperationalError (connection pool) — показываем «Обрабатываю», не «Ошибка»
     err = context.error
     err_str = str(err).lower()
-    is_db_overload = isinstance(err, PoolError) or (
+    is_db_overload = isinstance(err, (PoolError, DbOverloaded)) or (
         isinstance(err, OperationalError)
         and any(x in err_str for x in ("connection", "pool", "exhausted", "too many"))
     )
@@ -1547,6 +1579,14 @@ async def _error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     return  # не крашим даже при других ошибках
 
 
+def _lane_handler(lane: str) -> TypeHandler:
+    """Группа -1: до всех обработчиков выставляет полосу приоритета БД и новую сессию чтения для этого апдейта."""
+    async def set_lane(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        admission.set_lane(lane)
+        start_read_session()
+    return TypeHandler(Update, set_lane)
+
+
 def build_admin_app(token: str) -> Application:
     app = (
         Application.builder()
@@ -1561,14 +1601,18 @@ def build_admin_app(token: str) -> Application:
         .build()
     )
     app.add_error_handler(_error_handler)
+    app.add_handler(_lane_handler(admission.LANE_ADMIN), group=-1)
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("newcode", cmd_newcode))
     app.add_handler(CommandHandler("devcode", cmd_devcode))
+    app.add_handler(CommandHandler("bulkcodes", cmd_bulkcodes))
     app.add_handler(CommandHandler("codes", cmd_codes))
     app.add_handler(CommandHandler("revoke", cmd_revoke))
     app.add_handler(CommandHandler("addadmin", cmd_addadmin))
     app.add_handler(CommandHandler("removeadmin", cmd_removeadmin))
     app.add_handler(CommandHandler("admins", cmd_admins))
+    app.add_handler(CommandHandler("rebuildrefs", cmd_rebuildrefs))
+    app.add_handler(CommandHandler("checkstatus", cmd_checkstatus))
     app.add_handler(CallbackQueryHandler(on_callback))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_admin_input))
     return app
@@ -1588,6 +1632,7 @@ def build_client_app(token: str) -> Application:
         .build()
     )
     app.add_error_handler(_error_handler)
+    app.add_handler(_lane_handler(admission.LANE_CLIENT), group=-1)
     app.add_handler(CommandHandler("start", client_start))
     app.add_handler(CommandHandler("mycode", client_mycode))
     app.add_handler(CallbackQueryHandler(client_callback))
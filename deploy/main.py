@@ -26,8 +26,13 @@ from starlette.responses import JSONResponse, Response
 from starlette.routing import Route
 from telegram import Update, BotCommand
 
-from db import init_db, load_settings_cache, check_license, activate_code, create_code, add_payment, payment_exists_by_order_id, get_all_admin_ids, list_admins, get_user, _db_health_check
+from db import init_db, load_settings_cache, mark_expired_codes, backfill_denormalized, check_or_activate, check_or_activate_batch, CHECK_BATCH_MAX, record_paid_order, get_all_admin_ids, list_admins, get_user, _db_health_check, get_license_cache_stats, get_pg_pool_stats, get_revocation_epoch, read_session
+import db_async
+import admission
+from admission import DbOverloaded
+from token_utils import create_lease
 from handlers import build_admin_app, build_client_app, set_client_bot, get_client_bot
+import queue_pending
 from queue_pending import start_pending_processor
 from payment import (
     generate_freekassa_link,
@@ -41,6 +46,7 @@ ADMIN_TOKEN = os.environ.get("ADMIN_BOT_TOKEN", "")
 CLIENT_TOKEN = os.environ.get("CLIENT_BOT_TOKEN", "")
 WEBHOOK_BASE = os.environ.get("WEBHOOK_BASE_URL", "").rstrip("/")
 API_SECRET = os.environ.get("API_SECRET", "")
+CODE_STATUS_SWEEP_SEC = int(os.environ.get("CODE_STATUS_SWEEP_SEC", "3600"))
 
 
 def _check_secret(request: Request) -> bool:
@@ -50,6 +56,37 @@ def _check_secret(request: Request) -> bool:
     return True
 
 
+async def _db_call(func, *args, **kwargs):
+    """Вызов функции db.py из HTTP — через допуск к БД (admission.db_call)."""
+    return await admission.db_call(func, *args, **kwargs)
+
+
+def _busy_response(e: DbOverloaded) -> JSONResponse:
+    """503 при перегрузке БД: клиент повторит через Retry-After, а не повиснет до таймаута."""
+    return JSONResponse({"ok": False, "error": "busy", "retry_after": e.retry_after}, status_code=503,
+                        headers={"Retry-After": str(e.retry_after)})
+
+
+# Single-flight /check: одинаковые (code, hwid, installation_id) в полёте делят один вызов БД
+_check_inflight: dict = {}
+_check_flight_stats = {"calls": 0, "coalesced": 0}
+
+
+async def _check_single_flight(code: str, hwid: str, installation_id: str | None) -> dict:
+    """check_or_activate через _db_call; параллельные одинаковые запросы ждут один и тот же вызов."""
+    key = (code, hwid, installation_id)
+    task = _check_inflight.get(key)
+    if task is None:
+        _check_flight_stats["calls"] += 1
+        task = asyncio.ensure_future(_db_call(check_or_activate, code, hwid, installation_id))
+        _check_inflight[key] = task
+        task.add_done_callback(lambda t: _check_inflight.pop(key, None) if _check_inflight.get(key) is t else None)
+    else:
+        _check_flight_stats["coalesced"] += 1
+    # shield: отключение одного клиента не отменяет вызов для остальных
+    return await asyncio.shield(task)
+
+
 async def api_check(request: Request):
     """POST /check — проверка/активация лицензии."""
     if not _check_secret(request):
@@ -64,28 +101,80 @@ async def api_check(request: Request):
     if not code or not hwid:
         return JSONResponse({"ok": False, "error": "missing_code_or_hwid"}, status_code=400)
     try:
-        result = await asyncio.to_thread(check_license, code, hwid, installation_id)
+        result = await _check_single_flight(code, hwid, installation_id)
+    except DbOverloaded as e:
+        return _busy_response(e)
     except Exception as e:
-        log.error("check_license: %s\n%s", e, traceback.format_exc())
+        log.error("check_or_activate: %s\n%s", e, traceback.format_exc())
         return JSONResponse({"ok": False, "error": "server_error"}, status_code=500)
+    lease = (code, hwid, installation_id) if data.get("lease") is True else None
+    return JSONResponse(_check_response_item(result, lease), status_code=200 if result["ok"] else 400)
+
+
+def _check_response_item(result: dict, lease: tuple | None = None) -> dict:
+    """Тело ответа /check по результату check_or_activate. lease=(code, hwid, installation_id) — приложить подписанный лиз."""
     if result["ok"]:
-        return JSONResponse({"ok": True, "expires_at": result["expires_at"], "is_developer": result["is_developer"]})
-    if result["error"] == "not_activated":
+        item = {"ok": True, "expires_at": result["expires_at"], "is_developer": result.get("is_developer", False)}
+        if lease:
+            item.update(create_lease(*lease, result) or {})
+        return item
+    return {"ok": False, "error": result.get("error", "activation_failed")}
+
+
+async def api_check_epoch(request: Request):
+    """GET /check/epoch — текущая эпоха отзывов (из кэша настроек, без БД): новее "r" в лизе — пора на /check."""
+    if not _check_secret(request):
+        return JSONResponse({"ok": False, "error": "unauthorized"}, status_code=401)
+    epoch, _ = get_revocation_epoch()
+    return JSONResponse({"ok": True, "revocation_epoch": epoch})
+
+
+async def api_check_batch(request: Request):
+    """POST /check/batch — пакетная проверка: [{code, hwid, installation_id}, ...] или {"items": [...]}."""
+    if not _check_secret(request):
+        return JSONResponse({"ok": False, "error": "unauthorized"}, status_code=401)
+    try:
+        data = await request.json()
+    except Exception:
+        return JSONResponse({"ok": False, "error": "invalid_json"}, status_code=400)
+    raw_items = data.get("items") if isinstance(data, dict) else data
+    want_lease = isinstance(data, dict) and data.get("lease") is True
+    if not isinstance(raw_items, list):
+        return JSONResponse({"ok": False, "error": "invalid_items"}, status_code=400)
+    if len(raw_items) > CHECK_BATCH_MAX:
+        return JSONResponse({"ok": False, "error": "batch_too_large", "max": CHECK_BATCH_MAX}, status_code=413)
+    results: list = [None] * len(raw_items)
+    items, positions = [], []
+    for i, it in enumerate(raw_items):
+        it = it if isinstance(it, dict) else {}
+        code = (it.get("code") or "").strip().upper()
+        hwid = (it.get("hwid") or "").strip()
+        installation_id = (it.get("installation_id") or "").strip() or None
+        if not code or not hwid:
+            results[i] = {"ok": False, "error": "missing_code_or_hwid"}
+            continue
+        items.append((code, hwid, installation_id))
+        positions.append(i)
+    if items:
         try:
-            act = await asyncio.to_thread(activate_code, code, hwid, installation_id)
+            checked = await _db_call(check_or_activate_batch, items)
+        except DbOverloaded as e:
+            return _busy_response(e)
         except Exception as e:
-            log.error("activate_code: %s\n%s", e, traceback.format_exc())
+            log.error("check_or_activate_batch: %s\n%s", e, traceback.format_exc())
             return JSONResponse({"ok": False, "error": "server_error"}, status_code=500)
-        if act["ok"]:
-            return JSONResponse({"ok": True, "expires_at": act["expires_at"], "is_developer": act.get("is_developer", False)})
-        return JSONResponse({"ok": False, "error": act.get("error", "activation_failed")}, status_code=400)
-    return JSONResponse({"ok": False, "error": result["error"]}, status_code=400)
+        for i, item, result in zip(positions, items, checked):
+            results[i] = _check_response_item(result, item if want_lease else None)
+    return JSONResponse({"ok": True, "results": results})
 
 
 async def health(request: Request):
     """Health check: 503 если БД недоступна — Railway перезапустит контейнер."""
     try:
-        ok = await asyncio.to_thread(_db_health_check)
+        ok = await _db_call(_db_health_check)
+    except DbOverloaded:
+        # Очередь к БД полна, но БД отвечает — перезапуск контейнера тут не поможет
+        return JSONResponse({"status": "ok", "db": "busy"})
     except Exception:
         ok = False
     if ok:
@@ -93,6 +182,19 @@ async def health(request: Request):
     return JSONResponse({"status": "unhealthy", "db": "fail"}, status_code=503)
 
 
+async def metrics(request: Request):
+    """GET /metrics — счётчики кэшей и очередей (JSON, под X-API-Secret)."""
+    if not _check_secret(request):
+        return JSONResponse({"ok": False, "error": "unauthorized"}, status_code=401)
+    return JSONResponse({
+        "license_cache": get_license_cache_stats(),
+        "check_single_flight": {**_check_flight_stats, "inflight": len(_check_inflight)},
+        "db_admission": admission.get_stats(),
+        "pending_queue": queue_pending.get_stats(),
+        "pg_pool": get_pg_pool_stats(),
+    })
+
+
 async def webhook_admin(request: Request):
     if not ADMIN_TOKEN:
         return Response(status_code=500)
@@ -123,9 +225,6 @@ async def payment_freekassa(request: Request):
     if not verify_freekassa_webhook(merchant_id, amount, order_id, sign_received):
         log.warning("FreeKassa webhook: bad sign")
         return Response("Error: bad sign", status_code=403)
-    if await asyncio.to_thread(payment_exists_by_order_id, order_id):
-        log.info("FreeKassa webhook: duplicate order_id %s", order_id)
-        return Response("YES", status_code=200)
     try:
         user_id = int(user_id)
         days = int(days)
@@ -133,9 +232,11 @@ async def payment_freekassa(request: Request):
     except (ValueError, TypeError):
         return Response("Error: invalid params", status_code=400)
     try:
-        new_code = await asyncio.to_thread(create_code, days=days)
-        await asyncio.to_thread(add_payment, user_telegram_id=user_id, amount_usd=amount_float, plan_days=int(days),
-                               merchant_order_id=order_id, payment_system="freekassa")
+        new_code = await _db_call(record_paid_order, user_telegram_id=user_id, amount_usd=amount_float, plan_days=days,
+                                  merchant_order_id=order_id, payment_system="freekassa")
+        if new_code is None:
+            log.info("FreeKassa webhook: duplicate order_id %s", order_id)
+            return Response("YES", status_code=200)
         bot = get_client_bot()
         if bot:
             msg = f"✅ *Оплата получена!*\n\nВаш ключ на {days} дней:\n`{new_code}`\n\nСкопируйте его и вставьте в программу VoiceLab."
@@ -143,6 +244,9 @@ async def payment_freekassa(request: Request):
         asyncio.create_task(_notify_admin_payment(user_id, amount_float, days, "freekassa", new_code))
         log.info("FreeKassa: payment ok order_id=%s user=%s days=%s", order_id, user_id, days)
         return Response("YES", status_code=200)
+    except DbOverloaded as e:
+        log.warning("FreeKassa webhook: DB busy, order_id=%s — ждём повтор", order_id)
+        return Response("Error: busy", status_code=503, headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         log.error("FreeKassa webhook error: %s\n%s", e, traceback.format_exc())
         return Response("Error processing", status_code=500)
@@ -166,9 +270,6 @@ async def payment_cryptomus(request: Request):
     order_id = body.get("order_id")
     if not order_id:
         return Response("Error: no order_id", status_code=400)
-    if await asyncio.to_thread(payment_exists_by_order_id, order_id):
-        log.info("Cryptomus webhook: duplicate order_id %s", order_id)
-        return Response("OK", status_code=200)
     add_data = body.get("additional_data")
     if add_data:
         try:
@@ -187,9 +288,11 @@ async def payment_cryptomus(request: Request):
     except (ValueError, TypeError):
         amount_float = 0
     try:
-        new_code = await asyncio.to_thread(create_code, days=int(days))
-        await asyncio.to_thread(add_payment, user_telegram_id=int(user_id), amount_usd=amount_float, plan_days=int(days),
-                               merchant_order_id=order_id, payment_system="cryptomus")
+        new_code = await _db_call(record_paid_order, user_telegram_id=int(user_id), amount_usd=amount_float, plan_days=int(days),
+                                  merchant_order_id=order_id, payment_system="cryptomus")
+        if new_code is None:
+            log.info("Cryptomus webhook: duplicate order_id %s", order_id)
+            return Response("OK", status_code=200)
         bot = get_client_bot()
         if bot:
             msg = f"✅ *Оплата получена!*\n\nВаш ключ на {days} дней:\n`{new_code}`\n\nСкопируйте его и вставьте в программу VoiceLab."
@@ -197,6 +300,9 @@ async def payment_cryptomus(request: Request):
         asyncio.create_task(_notify_admin_payment(int(user_id), amount_float, int(days), "cryptomus", new_code))
         log.info("Cryptomus: payment ok order_id=%s user=%s days=%s", order_id, user_id, days)
         return Response("OK", status_code=200)
+    except DbOverloaded as e:
+        log.warning("Cryptomus webhook: DB busy, order_id=%s — ждём повтор", order_id)
+        return Response("Error: busy", status_code=503, headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         log.error("Cryptomus webhook error: %s\n%s", e, traceback.format_exc())
         return Response("Error processing", status_code=500)
@@ -223,7 +329,9 @@ async def _notify_admin_payment(user_id: int, amount: float, days: int, system:
     """Отправляет уведомление о платеже владельцу и админам в админ-бот."""
     if not admin_app or not admin_app.bot:
         return
-    u = get_user(user_id)
+    # Своя задача (create_task) — полоса payment от вебхука здесь ни к чему: уведомление ждёт, а не /check
+    admission.set_lane(admission.LANE_ADMIN)
+    u = await _db_call(get_user, user_id)
     un = (u.get("username") or "").strip().lstrip("@")
     username = f"@{un}" if un else f"ID:{user_id}"
     sys_icon = "💳" if system == "freekassa" else "₿" if system == "cryptomus" else "💰"
@@ -235,7 +343,7 @@ async def _notify_admin_payment(user_id: int, amount: float, days: int, system:
         f"📦 {system}"
     )
     chat_ids = set(get_all_admin_ids())
-    for a in list_admins():
+    for a in await _db_call(list_admins):
         chat_ids.add(a["telegram_id"])
     for cid in chat_ids:
         try:
@@ -244,6 +352,32 @@ async def _notify_admin_payment(user_id: int, amount: float, days: int, system:
             log.warning("Notify admin payment to %s: %s", cid, e)
 
 
+def _in_lane(lane: str, endpoint):
+    """Эндпоинт, вызовы БД которого идут в полосе приоритета lane (admission) и в своей сессии чтения (реплика)."""
+    async def wrapped(request: Request):
+        with admission.in_lane(lane), read_session():
+            return await endpoint(request)
+    return wrapped
+
+
+def _api_routes() -> list:
+    """HTTP API без webhook'ов ботов."""
+    return [
+        Route("/check", _in_lane(admission.LANE_CHECK, api_check), methods=["POST"]),
+        Route("/check/batch", _in_lane(admission.LANE_CHECK, api_check_batch), methods=["POST"]),
+        Route("/check/epoch", api_check_epoch, methods=["GET"]),
+        Route("/health", _in_lane(admission.LANE_CHECK, health), methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+        Route("/payment/freekassa", _in_lane(admission.LANE_PAYMENT, payment_freekassa), methods=["POST"]),
+        Route("/payment/cryptomus", _in_lane(admission.LANE_PAYMENT, payment_cryptomus), methods=["POST"]),
+    ]
+
+
+def build_api_app() -> Starlette:
+    """Starlette-приложение только с HTTP API — без Telegram-ботов (бенчмарки, локальная отладка)."""
+    return Starlette(routes=_api_routes())
+
+
 async def run():
     global admin_app, client_app
     import concurrent.futures
@@ -283,12 +417,7 @@ async def run():
             except Exception as e:
                 print(f"⚠️ Webhook client: {e}. Проверь WEBHOOK_BASE_URL и DNS.")
 
-    routes = [
-        Route("/check", api_check, methods=["POST"]),
-        Route("/health", health, methods=["GET"]),
-        Route("/payment/freekassa", payment_freekassa, methods=["POST"]),
-        Route("/payment/cryptomus", payment_cryptomus, methods=["POST"]),
-    ]
+    routes = _api_routes()
     if admin_app:
         routes.append(Route("/webhook/admin", webhook_admin, methods=["POST"]))
     if client_app:
@@ -300,15 +429,38 @@ async def run():
     import uvicorn
     config = uvicorn.Config(app, host="0.0.0.0", port=port)
 
-    # Очередь при PoolError — раз в 10 сек возвращаем запросы на обработку
+    # Очередь апдейтов ботов при перегрузке БД — возвращаем по мере освобождения слотов допуска
     start_pending_processor()
 
+    # Фоновые задачи — в самой низкой полосе: не отнимают слоты у оплат и /check
     async def _refresh_settings_loop():
+        admission.set_lane(admission.LANE_ADMIN)
         while True:
             await asyncio.sleep(60)
-            load_settings_cache()
+            try:
+                await _db_call(load_settings_cache)
+            except DbOverloaded:
+                pass  # остаётся прежний кэш, обновим через минуту
 
     asyncio.create_task(_refresh_settings_loop())
+
+    # codes.status: active → expired по expires_ts (выборки по статусу не смотрят в activations);
+    # заодно дозаполняем строки, которые записал прежний инстанс во время деплоя (NULL username_norm / expires_ts)
+    async def _code_status_sweep_loop():
+        admission.set_lane(admission.LANE_ADMIN)
+        while True:
+            try:
+                fixed = await _db_call(backfill_denormalized)
+                if any(fixed.values()):
+                    log.info("code status sweep: backfilled %s", fixed)
+                n = await _db_call(mark_expired_codes)
+                if n:
+                    log.info("code status sweep: %d expired", n)
+            except Exception as e:
+                log.warning("code status sweep failed: %s", e)
+            await asyncio.sleep(CODE_STATUS_SWEEP_SEC)
+
+    asyncio.create_task(_code_status_sweep_loop())
     server = uvicorn.Server(config)
     tasks = [server.serve()]
     if admin_app:
@@ -1,43 +1,123 @@
 # -*- coding: utf-8 -*-
-"""Очередь запросов при PoolError — краткосрочная память, БД молотит по мере освобождения."""
+"""
+Очередь апдейтов ботов, упавших на перегрузке БД (PoolError / DbOverloaded), — краткосрочная память.
+Возвращаем их в update_queue, как только у допуска к БД (admission) есть свободные слоты в их полосе, с экспоненциальной
+задержкой и джиттером. Один апдейт на пользователя: новый заменяет ожидающий (последнее действие важнее).
+Размер ограничен PENDING_MAX: при переполнении вытесняется самый старый. После PENDING_MAX_ATTEMPTS повторов апдейт отбрасывается.
+"""
 import asyncio
 import logging
-import queue as queue_module
+import os
+import random
+import time
+from collections import OrderedDict
+
+import admission
 
 log = logging.getLogger(__name__)
 
-# (update, target_update_queue) — куда вернуть для повторной обработки
-_pending: asyncio.Queue = asyncio.Queue()
-_PROCESS_INTERVAL = 10  # секунд
-_INTERVAL_WHEN_BUSY = 15  # при большой очереди — реже, чтобы не перегружать БД
+PENDING_MAX = int(os.environ.get("PENDING_MAX", "500"))
+PENDING_MAX_ATTEMPTS = int(os.environ.get("PENDING_MAX_ATTEMPTS", "8"))
+_BACKOFF_BASE = 0.5  # сек, первая задержка
+_BACKOFF_CAP = 30.0  # сек, потолок задержки
+_POLL_WHEN_BUSY = 0.25  # сек — пересмотр, когда апдейты готовы, но слотов нет
+
+# (id очереди, пользователь) → запись; порядок — порядок постановки (первым вытесняется самый старый)
+_pending: "OrderedDict[tuple, dict]" = OrderedDict()
+# update_id → число уже сделанных повторов (апдейт снова попадает сюда, если повтор тоже упал)
+_attempts: "OrderedDict[int, int]" = OrderedDict()
+_wakeup: asyncio.Event | None = None
+_stats = {"added": 0, "coalesced": 0, "reinjected": 0, "dropped_overflow": 0, "dropped_attempts": 0}
+
+
+def _backoff(attempt: int) -> float:
+    """Экспоненциальная задержка с джиттером: [½, 1] × min(cap, base·2^attempt)."""
+    delay = min(_BACKOFF_CAP, _BACKOFF_BASE * (2 ** attempt))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _user_key(update) -> int | str:
+    user = getattr(update, "effective_user", None)
+    if user is not None:
+        return user.id
+    return f"u{getattr(update, 'update_id', id(update))}"
 
 
 def add_pending(update, target_queue):
-    """Добавить запрос в очередь при исчерпании пула БД."""
+    """Отложить апдейт до освобождения БД (вызывается из обработчиков ошибок ботов, не блокирует)."""
     try:
-        _pending.put_nowait((update, target_queue))
-        log.info("Очередь: +1 (всего ~%d)", _pending.qsize())
+        update_id = getattr(update, "update_id", None)
+        attempt = _attempts.pop(update_id, 0) if update_id is not None else 0
+        if attempt >= PENDING_MAX_ATTEMPTS:
+            _stats["dropped_attempts"] += 1
+            log.warning("Очередь: апдейт %s отброшен после %d повторов", update_id, attempt)
+            return
+        key = (id(target_queue), _user_key(update))
+        now = time.monotonic()
+        old = _pending.pop(key, None)
+        if old is not None:
+            _stats["coalesced"] += 1
+        elif len(_pending) >= PENDING_MAX:
+            _pending.popitem(last=False)
+            _stats["dropped_overflow"] += 1
+        _pending[key] = {
+            "update": update, "queue": target_queue, "attempt": attempt, "lane": admission.current_lane(),
+            "added_at": old["added_at"] if old else now, "due": now + _backoff(attempt),
+        }
+        _stats["added"] += 1
+        if _wakeup is not None:
+            _wakeup.set()
+        log.info("Очередь: +1 (всего %d, повтор %d)", len(_pending), attempt + 1)
     except Exception as e:
         log.warning("Очередь add: %s", e)
 
 
+def _remember_attempt(update_id, attempt: int):
+    _attempts[update_id] = attempt
+    while len(_attempts) > PENDING_MAX * 4:
+        _attempts.popitem(last=False)
+
+
 async def _process_pending_worker():
-    """Раз в N секунд возвращаем один запрос в обработку — БД не перегружается."""
+    """Возвращаем готовые апдейты по числу свободных слотов БД; спим до ближайшего срока или нового апдейта."""
+    global _wakeup
+    _wakeup = asyncio.Event()
     while True:
-        qsize = _pending.qsize()
-        # При большой очереди — реже отдаём, чтобы БД не крашилась
-        interval = _INTERVAL_WHEN_BUSY if qsize > 5 else _PROCESS_INTERVAL
-        await asyncio.sleep(interval)
+        _wakeup.clear()
+        timeout = None
         try:
-            if _pending.empty():
-                continue
-            update, target_queue = _pending.get_nowait()
-            await target_queue.put(update)
-            log.info("Очередь: отправлен на обработку (осталось ~%d)", _pending.qsize())
-        except queue_module.Empty:
-            pass
+            if _pending:
+                now = time.monotonic()
+                due = sorted((e["due"], key) for key, e in _pending.items() if e["due"] <= now)
+                budget = {lane: admission.free_slots(lane) for lane in admission.LANES}
+                for _, key in due:
+                    entry = _pending[key]
+                    if budget[entry["lane"]] <= 0:
+                        continue
+                    budget[entry["lane"]] -= 1
+                    del _pending[key]
+                    update_id = getattr(entry["update"], "update_id", None)
+                    if update_id is not None:
+                        _remember_attempt(update_id, entry["attempt"] + 1)
+                    await entry["queue"].put(entry["update"])
+                    _stats["reinjected"] += 1
+                if _pending:
+                    nearest = min(e["due"] for e in _pending.values())
+                    timeout = max(nearest - time.monotonic(), _POLL_WHEN_BUSY if nearest <= now else 0.0)
         except Exception as e:
             log.warning("Очередь process: %s", e)
+            timeout = _POLL_WHEN_BUSY
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def get_stats() -> dict:
+    """Глубина очереди и возраст самого старого апдейта — для /metrics."""
+    now = time.monotonic()
+    oldest = min((e["added_at"] for e in _pending.values()), default=now)
+    return {**_stats, "depth": len(_pending), "max": PENDING_MAX, "oldest_age_s": round(now - oldest, 1)}
 
 
 def start_pending_processor():
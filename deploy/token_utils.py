@@ -1,15 +1,25 @@
 # -*- coding: utf-8 -*-
-"""Создание токена активации для офлайн-проверки (через Telegram)."""
+"""Подписанные токены для офлайн-проверки: токен активации (Telegram) и лиз /check."""
 import base64
 import hashlib
 import hmac
 import json
 import os
-from datetime import datetime
+import time
+from datetime import datetime, timezone
 
-from db import activate_code
+from db import check_or_activate, get_revocation_epoch
 
 API_SECRET = os.environ.get("API_SECRET", "")
+# Срок лиза (сек): дольше него отозванный код офлайн не живёт, даже если клиент не следит за эпохой отзывов
+LEASE_TTL = int(os.environ.get("LEASE_TTL", "86400"))
+
+
+def _sign(payload: dict) -> str:
+    """base64(json).hmac_sha256_hex"""
+    j = json.dumps(payload, sort_keys=True)
+    sig = hmac.new(API_SECRET.encode(), j.encode(), hashlib.sha256).hexdigest()
+    return base64.b64encode(j.encode()).decode() + "." + sig
 
 
 def create_activation_token(code: str, hwid: str, installation_id: str = "") -> tuple[bool, str]:
@@ -24,7 +34,7 @@ def create_activation_token(code: str, hwid: str, installation_id: str = "") ->
     installation_id = (installation_id or "").strip() or None
     if not code or not hwid:
         return False, "Нужны код и HWID."
-    result = activate_code(code, hwid, installation_id)
+    result = check_or_activate(code, hwid, installation_id)
     if not result.get("ok"):
         err = result.get("error", "unknown")
         msg = {"invalid_code": "Неверный код", "expired": "Срок истёк",
@@ -38,7 +48,39 @@ def create_activation_token(code: str, hwid: str, installation_id: str = "") ->
         "d": result.get("is_developer", False),
         "t": int(datetime.utcnow().timestamp()),
     }
-    j = json.dumps(payload, sort_keys=True)
-    sig = hmac.new(API_SECRET.encode(), j.encode(), hashlib.sha256).hexdigest()
-    token = base64.b64encode(j.encode()).decode() + "." + sig
-    return True, token
+    return True, _sign(payload)
+
+
+def create_lease(code: str, hwid: str, installation_id: str | None, result: dict) -> dict | None:
+    """
+    Лиз для успешного /check: клиент не ходит на сервер до recheck_after.
+    Срок — LEASE_TTL, но не дольше лицензии. В payload — эпоха отзывов "r" (она же revocation_epoch в ответе):
+    клиент сверяет её с GET /check/epoch и при более новой эпохе сервера проверяет код заново, не дожидаясь срока.
+    None, если API_SECRET не задан или лиз выдавать нечего.
+    """
+    if not API_SECRET or not result.get("ok") or LEASE_TTL <= 0:
+        return None
+    now = int(time.time())
+    epoch, _ = get_revocation_epoch()
+    until = now + LEASE_TTL
+    if result.get("expires_ts"):
+        until = min(until, int(result["expires_ts"]))
+    elif result.get("expires_at"):
+        try:
+            until = min(until, int(datetime.fromisoformat(result["expires_at"]).replace(tzinfo=timezone.utc).timestamp()))  # expires_at — naive UTC
+        except ValueError:
+            pass
+    if until <= now:
+        return None
+    payload = {
+        "c": code,
+        "h": hwid,
+        "i": installation_id or "",
+        "e": result.get("expires_at"),
+        "d": result.get("is_developer", False),
+        "t": now,
+        "x": until,
+        "r": epoch,
+    }
+    return {"lease": _sign(payload), "lease_expires_at": until, "recheck_after": now + (until - now) * 4 // 5,
+            "revocation_epoch": epoch}